@@ -0,0 +1,213 @@
+"""analytics.py - Sharded batch analytics over the score kinds and users.
+
+A job runs one analysis from ANALYSES over a whole kind in parallel:
+
+    1. start_job splits the kind's key space into shards at keys sampled
+       through the __scatter__ property.
+    2. Each shard is mapped by a chain of task queue tasks - a batch of
+       entities per task, resuming from a query cursor - adding to the
+       shard's partial aggregate.
+    3. When the last shard is done a merge task adds the partials together
+       into the job's result.
+
+Aggregates are {group: {counter: value}} dicts, so merging is addition, and
+an optional finalize function derives rates from the merged counters. Read
+AnalyticsJob.get_by_id(job_id).result once its status is 'done'.
+tools/run_analytics.py runs jobs locally against the testbed stubs."""
+
+import datetime
+from google.appengine.api import taskqueue
+from google.appengine.datastore.datastore_query import Cursor
+from google.appengine.ext import ndb
+from models import User, ScoreP1, ScoreP2, ConsecutiveTurns
+
+SHARDS = 8  # default shards per job
+SCATTER_SAMPLES = 32  # __scatter__ keys sampled per shard
+MAP_BATCH_SIZE = 200  # entities mapped per task
+SHARD_URL = '/tasks/analytics_shard'
+MERGE_URL = '/tasks/analytics_merge'
+
+
+def _add(totals, group, **counters):
+    group_totals = totals.setdefault(group, {})
+    for name, value in counters.items():
+        group_totals[name] = group_totals.get(name, 0) + value
+
+
+def merge(totals, partial):
+    """Add a partial aggregate into totals"""
+    for group, counters in partial.items():
+        _add(totals, group, **counters)
+
+
+def _map_score_p1(score, totals):
+    _add(totals, str(score.size), games=1, wins=int(score.won),
+         turns=score.turns)
+
+
+def _map_score_p2(score, totals):
+    _add(totals, str(score.size), games=1, wins=int(score.won),
+         ties=int(score.tie), turns=score.turns)
+
+
+def _map_consecutive_turns(score, totals):
+    # histogram of the consecutive turns bonus per board size
+    _add(totals, str(score.size), **{str(score.turns): 1})
+
+
+def _map_user(user, totals):
+    _add(totals, 'all', users=1, games=user.games, wins=user.wins,
+         ties=user.ties, losses=user.losses)
+    # histogram of user_ranking (win / loss ratio x 100) in steps of 50
+    _add(totals, 'ranking', **{str(int(user.user_ranking // 50) * 50): 1})
+
+
+def _rates(totals):
+    """Per group win (and tie) rates and average turns"""
+    for counters in totals.values():
+        games = float(counters['games'])
+        counters['win_rate'] = counters['wins'] / games
+        counters['average_turns'] = counters['turns'] / games
+        if 'ties' in counters:
+            counters['tie_rate'] = counters['ties'] / games
+
+
+# analysis name -> (model, map function, finalize function or None)
+ANALYSES = {
+    'p1_win_rates': (ScoreP1, _map_score_p1, _rates),
+    'p2_outcomes': (ScoreP2, _map_score_p2, _rates),
+    'consecutive_turns': (ConsecutiveTurns, _map_consecutive_turns, None),
+    'users': (User, _map_user, None),
+}
+
+
+class AnalyticsJob(ndb.Model):
+    """A run of an analysis. result holds the merged aggregate once status
+    is 'done'."""
+    analysis = ndb.StringProperty(required=True, indexed=False)
+    shard_count = ndb.IntegerProperty(required=True, indexed=False)
+    shards_done = ndb.IntegerProperty(default=0, indexed=False)
+    status = ndb.StringProperty(default='running', indexed=False)
+    result = ndb.JsonProperty()
+    started = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+    finished = ndb.DateTimeProperty(indexed=False)
+
+
+class AnalyticsShard(ndb.Model):
+    """A key range of a job's kind and its partial aggregate - keyed
+    '<job id>-<shard number>' and not a child of the job, so shards don't
+    share an entity group. start is inclusive, end exclusive, None is open."""
+    job = ndb.KeyProperty(required=True, kind=AnalyticsJob, indexed=False)
+    analysis = ndb.StringProperty(required=True, indexed=False)
+    start = ndb.KeyProperty(indexed=False)
+    end = ndb.KeyProperty(indexed=False)
+    cursor = ndb.StringProperty(indexed=False)
+    partial = ndb.JsonProperty(default={})
+    mapped = ndb.IntegerProperty(default=0, indexed=False)
+    done = ndb.BooleanProperty(default=False, indexed=False)
+
+
+def split_keys(model, shards):
+    """Returns up to shards - 1 keys that split the kind's key space into
+    ranges of roughly equal size. __scatter__ is set on a random ~0.8% of
+    entities, so ordering by it samples keys evenly across the kind."""
+    sample = model.query().order(ndb.GenericProperty('__scatter__')).fetch(
+        shards * SCATTER_SAMPLES, keys_only=True)
+    sample.sort()
+    step = len(sample) / float(shards)
+    splits = []
+    for i in range(1, shards):
+        key = sample[int(step * i)] if sample else None
+        if key and key not in splits:
+            splits.append(key)
+    return splits
+
+
+def start_job(analysis, shards=SHARDS):
+    """Create a job and its shards and queue the first task of each shard.
+    Returns the job.
+    Raises:
+        ValueError: if the analysis doesn't exist."""
+    if analysis not in ANALYSES:
+        raise ValueError('Invalid analysis. Valid values are {0}.'.format(
+            ', '.join(sorted(ANALYSES))))
+    bounds = [None] + split_keys(ANALYSES[analysis][0], shards) + [None]
+    job = AnalyticsJob(analysis=analysis, shard_count=len(bounds) - 1)
+    job.put()
+    shard_entities = [
+        AnalyticsShard(id='{0}-{1}'.format(job.key.id(), i),
+                       job=job.key,
+                       analysis=analysis,
+                       start=bounds[i],
+                       end=bounds[i + 1],
+                       partial={})
+        for i in range(job.shard_count)]
+    ndb.put_multi(shard_entities)
+    taskqueue.Queue().add([
+        taskqueue.Task(url=SHARD_URL, params={'shard': shard.key.id()})
+        for shard in shard_entities])
+    return job
+
+
+def map_shard(shard_id, cursor=''):
+    """Map one batch of a shard from cursor, then save the partial aggregate
+    and queue the next batch (or count the shard done) in the same
+    transaction. A retried task whose batch was already saved finds the
+    shard's cursor moved on and does nothing."""
+    shard = AnalyticsShard.get_by_id(shard_id)
+    if shard is None or shard.done or (shard.cursor or '') != cursor:
+        return
+    model, map_entity, _ = ANALYSES[shard.analysis]
+    query = model.query()
+    if shard.start is not None:
+        query = query.filter(model.key >= shard.start)
+    if shard.end is not None:
+        query = query.filter(model.key < shard.end)
+    entities, next_cursor, more = query.order(model.key).fetch_page(
+        MAP_BATCH_SIZE, start_cursor=Cursor(urlsafe=cursor or None))
+    for entity in entities:
+        map_entity(entity, shard.partial)
+    shard.mapped += len(entities)
+    if more and next_cursor:
+        shard.cursor = next_cursor.urlsafe()
+    else:
+        shard.done = True
+
+    @ndb.transactional(xg=True)
+    def _save():
+        stored = shard.key.get(use_cache=False)
+        if stored.done or (stored.cursor or '') != cursor:
+            return
+        shard.put()
+        if not shard.done:
+            taskqueue.add(url=SHARD_URL,
+                          params={'shard': shard_id, 'cursor': shard.cursor},
+                          transactional=True)
+            return
+        job = shard.job.get()
+        job.shards_done += 1
+        job.put()
+        if job.shards_done == job.shard_count:
+            taskqueue.add(url=MERGE_URL, params={'job': job.key.id()},
+                          transactional=True)
+
+    _save()
+
+
+def merge_job(job_id):
+    """Add the partial aggregates of every shard of a job into its result"""
+    job = AnalyticsJob.get_by_id(job_id)
+    if job is None or job.status == 'done':
+        return
+    shard_keys = [ndb.Key(AnalyticsShard, '{0}-{1}'.format(job_id, i))
+                  for i in range(job.shard_count)]
+    result = {}
+    for shard in ndb.get_multi(shard_keys):
+        merge(result, shard.partial)
+    finalize = ANALYSES[job.analysis][2]
+    if finalize:
+        finalize(result)
+    job.result = result
+    job.status = 'done'
+    job.finished = datetime.datetime.now()
+    job.put()
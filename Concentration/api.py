@@ -2,39 +2,54 @@
 """api.py - Concentration Game API exposing the endpoint resources.
 The API contains both game logic and communication to/from the API."""
 
-import datetime
-import logging
 import endpoints
 import json
 from protorpc import remote, messages
-from protorpc import message_types
-from google.appengine.api import memcache
-from google.appengine.api import taskqueue
-from google.appengine.ext import ndb
 # import ndb (storage) models
 from models import User, GameP1, GameP2, ScoreP1, ScoreP2, ConsecutiveTurns
+from models import GameMP, ScoreMP, MatchRequest
+from models import ConcurrentMoveError, game_etag, save_game_results
 # import message classes
 from messages import (
     NewGameFormP1,
     NewGameFormP2,
+    NewGameFormMP,
     GameFormP1,
     GameFormP2,
+    GameFormMP,
     MakeMoveFormP1,
     MakeMoveFormP2,
+    MakeMoveFormMP,
     ActiveGamesForm,
     ScoreFormP1,
     ScoreFormsP1,
     ScoreFormP2,
     ScoreFormsP2,
+    ScoreFormsMP,
     StringMessage,
     ConsecutiveTurnsForm,
     ConsecutiveTurnsForms,
     UserRanking,
     UserRankings,
     GameHistoryForm,
-    GameHistoryForms
+    GameHistoryForms,
+    ReplayForm,
+    TurnNotificationForm,
+    JoinMatchmakingForm,
+    MatchStatusForm,
+    LeaderboardForm,
+    UserStatsForm,
+    NewTournamentForm,
+    TournamentForm
 )
-from utils import get_by_urlsafe
+from utils import get_by_urlsafe, get_user, get_user_scores
+import idempotency
+import notify
+import ratelimit
+import storage
+import wireformat
+# gamecache, leaderboards, tournament, userstats and writebehind are imported
+# by the endpoints that use them, to keep them out of instance startup
 
 USER_REQUEST = endpoints.ResourceContainer(user_name=messages.StringField(1),
                                            email=messages.StringField(2))
@@ -42,14 +57,126 @@ NEW_GAME_REQUEST_P1 = endpoints.ResourceContainer(NewGameFormP1)
 NEW_GAME_REQUEST_P2 = endpoints.ResourceContainer(NewGameFormP2)
 GET_GAME_REQUEST = endpoints.ResourceContainer(
     urlsafe_game_key=messages.StringField(1),)
+CONDITIONAL_GET_GAME_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    if_none_match=messages.StringField(2),
+    format=messages.StringField(3),)
+HISTORY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    format=messages.StringField(2),)
 MAKE_MOVE_REQUEST_P1 = endpoints.ResourceContainer(
     MakeMoveFormP1,
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    format=messages.StringField(2),)
 MAKE_MOVE_REQUEST_P2 = endpoints.ResourceContainer(
     MakeMoveFormP2,
-    urlsafe_game_key=messages.StringField(1),)
+    urlsafe_game_key=messages.StringField(1),
+    format=messages.StringField(2),)
+NEW_GAME_REQUEST_MP = endpoints.ResourceContainer(NewGameFormMP)
+MAKE_MOVE_REQUEST_MP = endpoints.ResourceContainer(
+    MakeMoveFormMP,
+    urlsafe_game_key=messages.StringField(1),
+    format=messages.StringField(2),)
 USER_RESOURCE_REQUEST = endpoints.ResourceContainer(
     user_name=messages.StringField(1))
+JOIN_MATCHMAKING_REQUEST = endpoints.ResourceContainer(JoinMatchmakingForm)
+NEW_TOURNAMENT_REQUEST = endpoints.ResourceContainer(NewTournamentForm)
+GET_TOURNAMENT_REQUEST = endpoints.ResourceContainer(
+    urlsafe_tournament_key=messages.StringField(1),)
+LEADERBOARD_REQUEST = endpoints.ResourceContainer(
+    board=messages.StringField(1, required=True),
+    window=messages.StringField(2, required=True),
+    size=messages.IntegerField(3, required=True),
+    period=messages.StringField(4))
+WAIT_TURN_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    since=messages.IntegerField(2, default=0),
+    timeout=messages.IntegerField(3, default=notify.MAX_WAIT))
+SPECTATE_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    if_none_match=messages.StringField(2),
+    since=messages.IntegerField(3),
+    timeout=messages.IntegerField(4, default=notify.MAX_WAIT),
+    format=messages.StringField(5),)
+REPLAY_REQUEST = endpoints.ResourceContainer(
+    urlsafe_game_key=messages.StringField(1),
+    turn=messages.IntegerField(2, required=True))
+
+
+def get_game_form(request, load_game, form_class):
+    """Conditional get of a game form. The game version is read from the
+    published turn state, so an unchanged game (etag matches if_none_match)
+    gets a minimal "not modified" reply, and a cached form is shared by
+    everyone asking for the same version - neither touches the datastore.
+    Raises:
+        NotFoundException: if the game doesn't exist."""
+    import gamecache
+    urlsafe_key = request.urlsafe_game_key
+    state = notify.turn_notifier.current(urlsafe_key)
+    if state is None:
+        game = load_game(urlsafe_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        state = game.turn_state()
+        notify.turn_notifier.publish(urlsafe_key, state)
+    else:
+        game = None
+    etag = game_etag(state['version'])
+    if request.if_none_match == etag:
+        form = form_class(urlsafe_key=urlsafe_key,
+                          game_over=state['game_over'],
+                          message='Not modified',
+                          version=state['version'],
+                          etag=etag,
+                          not_modified=True)
+        if form_class is GameFormP2:
+            form.current_turn = state['current_turn']
+        elif form_class is GameFormMP:
+            form.current_seat = state['current_turn']
+        return form
+    form = gamecache.get_form(urlsafe_key, state['version'],
+                              state['game_over'], form_class)
+    if form:
+        return form
+    if game is None:
+        game = load_game(urlsafe_key)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+    if game.game_over:
+        form = game.to_form('Game already over!')
+    else:
+        form = game.to_form('Time to make a move!')
+    gamecache.set_form(urlsafe_key, game.version, form)
+    return form
+
+
+def get_replay_form(request, game):
+    """Replay a game's board to request.turn, from the nearest checkpoint.
+    Raises:
+        NotFoundException: if the game doesn't exist.
+        BadRequestException: if the turn is outside the game history."""
+    if not game:
+        raise endpoints.NotFoundException('Game not found!')
+    try:
+        board, removed, pairs = game.board_at(request.turn)
+    except ValueError as e:
+        raise endpoints.BadRequestException(e.message)
+    form = ReplayForm(urlsafe_key=request.urlsafe_game_key,
+                      turn=request.turn,
+                      turns=len(game.game_history),
+                      cards=[json.dumps({cell: board[cell]})
+                             for cell in board if cell not in removed],
+                      removed=[json.dumps({cell: board[cell]})
+                               for cell in sorted(removed)],
+                      pairs=pairs)
+    if request.turn > 0:
+        move = game.game_history[request.turn - 1]
+        form.move = GameHistoryForm(turn=move[0],
+                                    player=move[1],
+                                    coord1=move[2],
+                                    coord2=move[3],
+                                    result=move[4])
+    return form
 
 
 @endpoints.api(name='concentration', version='v1')
@@ -69,11 +196,11 @@ class ConcentrationGameApi(remote.Service):
             StringMessage with a welcome message!
         Raises:
             ConflictException: when user already exists."""
-        if User.query(User.name == request.user_name).get():
+        if get_user(request.user_name):
             raise endpoints.ConflictException(
                     'A User with that name already exists!')
         user = User(name=request.user_name, email=request.email)
-        user.put()
+        storage.repository.put_multi([user])
         return StringMessage(message='User {} created!'.format(
                 request.user_name))
 
@@ -87,43 +214,45 @@ class ConcentrationGameApi(remote.Service):
         Args:
             user_name: Player user name.
             size: Size of the game board, valid values [2, 4, 8].
+            write_behind: Optional, save moves in batches (see writebehind).
         Returns:
             GameP1 form representation of the game state.
         Raises:
             NotFoundException: when user doesn't exist.
             BadRequestException on invalid size."""
-        user = User.query(User.name == request.user_name).get()
+        user = get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
         try:
-            game = GameP1.new_game(user.key, request.size)
+            game = GameP1.new_game(user.key, request.size,
+                                   write_behind=request.write_behind)
         except ValueError:
             raise endpoints.BadRequestException('Invalid board size. Valid '
                                                 'sizes are 2,4,8.')
+        notify.turn_notifier.publish(game.key.urlsafe(), game.turn_state())
         return game.to_form('Good luck playing Concentration!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=CONDITIONAL_GET_GAME_REQUEST,
                       response_message=GameFormP1,
                       path='gamep1/{urlsafe_game_key}',
                       name='get_game_p1',
                       http_method='GET')
+    @ratelimit.rate_limited
+    @wireformat.negotiated
     def get_game_p1(self, request):
         """Return the current single player game state.
         Args:
             urlsafe_game_key: A urlsafe key string.
+            if_none_match: Optional, etag from the last GameFormP1.
+            format: Optional, json (default) or packed.
         Returns:
-            GameP1 form representation of the game state.
+            GameP1 form representation of the game state, with not_modified
+            set and no board if the etag still matches.
         Raises:
             NotFoundException: if the game doesn't exist."""
-        game = get_by_urlsafe(request.urlsafe_game_key, GameP1)
-        if game:
-            if game.game_over:
-                return game.to_form('Game already over!')
-            else:
-                return game.to_form('Time to make a move!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        import writebehind
+        return get_game_form(request, writebehind.load_game, GameFormP1)
 
     @endpoints.method(request_message=USER_RESOURCE_REQUEST,
                       response_message=ActiveGamesForm,
@@ -138,19 +267,22 @@ class ConcentrationGameApi(remote.Service):
             A list of urlsafe_game_key.
         Raises:
             NotFoundException: if user doesn't exist."""
-        user = User.query(User.name == request.user_name).get()
+        user = get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = GameP1.query(GameP1.user == user.key)
-        return ActiveGamesForm(
-            game=[(g.key).urlsafe() for g in games if g.game_over is False])
+        games = storage.repository.query(
+            GameP1, [('user', '=', user.key), ('game_over', '=', False)])
+        return ActiveGamesForm(game=[g.key.urlsafe() for g in games])
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST_P1,
                       response_message=GameFormP1,
                       path='gamep1/{urlsafe_game_key}',
                       name='make_move_p1',
                       http_method='PUT')
+    @ratelimit.rate_limited
+    @wireformat.negotiated
+    @idempotency.idempotent_move(GameFormP1)
     def make_move_p1(self, request):
         """Makes a move. Returns a game state with message.
         Args:
@@ -158,14 +290,21 @@ class ConcentrationGameApi(remote.Service):
             x2: Second co-ordinate x position
             y1: First co-ordinate y position
             y2: Second co-ordinate y position
+            request_id: Optional, client id of the move - a retry with the
+            same id replays the first response instead of moving again
+            format: Optional, json (default) or packed
         Returns:
-            GameP1 form representation of the game state."""
-        game = get_by_urlsafe(request.urlsafe_game_key, GameP1)
+            GameP1 form representation of the game state.
+        Raises:
+            ConflictException: if a write-behind game's journal changed since
+            it was read, or a move with the same request_id is in progress."""
+        import writebehind
+        game, journal = writebehind.load_game_and_journal(
+            request.urlsafe_game_key)
         if game.game_over:
             return game.to_form('Game already over!')
         # convert card_map from json to dict
         card_map_dict = json.loads(game.card_map)
-        graveyard_dict = json.loads(game.card_graveyard)
         # convert coord tuple to string
         selection1 = str((request.x1, request.y1))
         selection2 = str((request.x2, request.y2))
@@ -178,30 +317,21 @@ class ConcentrationGameApi(remote.Service):
         if selection1 not in card_map_dict or selection2 not in card_map_dict:
             msg = "Invalid selection: {0}, {1}".format(selection1, selection2)
             return game.to_form(msg)
-        # check coord associated values match
-        if card_map_dict[selection1] == card_map_dict[selection2]:
-            msg = "Found a pair!!"
-            game.pairs_won += 1
-            game.consec_turns_temp += 1
-            if game.consec_turns_temp > game.consec_turns:
-                game.consec_turns = game.consec_turns_temp
-            # move the pair of coords to the 'graveyard'
-            for selection in [selection1, selection2]:
-                graveyard_dict[selection] = card_map_dict[selection]
-                del card_map_dict[selection]
-        else:
-            msg = "The pair doesn't match ..."
-            game.consec_turns_temp = 0
-        # update game state
-        game.turns += 1
-        game.card_map = json.dumps(card_map_dict)
-        game.card_graveyard = json.dumps(graveyard_dict)
-        game.update_game_history(1, selection1, selection2, msg)
-        game.put()
+        msg = game.apply_move(selection1, selection2)
         # check the game isn't finished
-        if len(card_map_dict) is 0:
+        if game.pairs_won == game.card_pairs:
             msg = "Congratulations you found the last pair - Game Over!!"
             game.end_game(won=True)
+            if journal:
+                journal.clear()
+        else:
+            try:
+                writebehind.save_move(game, journal, selection1, selection2)
+            except ConcurrentMoveError:
+                raise endpoints.ConflictException(
+                        'Game has changed, refresh the game and try again!')
+        notify.turn_notifier.publish(request.urlsafe_game_key,
+                                     game.turn_state())
         # return game form
         return game.to_form(msg)
 
@@ -218,12 +348,19 @@ class ConcentrationGameApi(remote.Service):
             GameP1 form representation of the game state.
         Raises:
             NotFoundException: if game doesn't exist."""
-        game = get_by_urlsafe(request.urlsafe_game_key, GameP1)
+        import writebehind
+        game, journal = writebehind.load_game_and_journal(
+            request.urlsafe_game_key)
         if game:
             if game.game_over:
                 return game.to_form('Game already over!')
             else:
+                game.version += 1
                 game.end_game()
+                if journal:
+                    journal.clear()
+                notify.turn_notifier.publish(request.urlsafe_game_key,
+                                             game.turn_state())
                 return game.to_form('Game cancelled!!')
         else:
             raise endpoints.NotFoundException('Game not found!')
@@ -239,7 +376,8 @@ class ConcentrationGameApi(remote.Service):
             None.
         Returns:
             List of ScoreP1 - ordered by turns ascending."""
-        scores = ScoreP1.query(ScoreP1.won == True).order(ScoreP1.turns)
+        scores = storage.repository.query(ScoreP1, [('won', '=', True)],
+                                          ['turns'])
         return ScoreFormsP1(items=[s.to_form() for s in scores])
 
     @endpoints.method(request_message=USER_RESOURCE_REQUEST,
@@ -256,11 +394,11 @@ class ConcentrationGameApi(remote.Service):
             List of ScoreP1 - all scores for given user.
         Raises:
             NotFoundException: if user doesn't exist."""
-        user = User.query(User.name == request.user_name).get()
+        user = get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = ScoreP1.query(ScoreP1.user == user.key).order(ScoreP1.turns)
+        scores = get_user_scores(ScoreP1, user.key, ['turns'])
         return ScoreFormsP1(items=[score.to_form() for score in scores])
 
     @endpoints.method(request_message=NEW_GAME_REQUEST_P2,
@@ -279,8 +417,8 @@ class ConcentrationGameApi(remote.Service):
         Raises:
             NotFoundException: if either of the players doesn't exist.
             BadRequestException: when invalid size passed."""
-        user1 = User.query(User.name == request.user_name1).get()
-        user2 = User.query(User.name == request.user_name2).get()
+        user1 = get_user(request.user_name1)
+        user2 = get_user(request.user_name2)
         if not user1 or not user2:
             raise endpoints.NotFoundException(
                 'A User with that name does not exist!')
@@ -289,29 +427,30 @@ class ConcentrationGameApi(remote.Service):
         except ValueError:
             raise endpoints.BadRequestException('Invalid board size. Valid '
                                                 'sizes are 2,4,8.')
+        notify.turn_notifier.publish(game.key.urlsafe(), game.turn_state())
         return game.to_form('Good luck playing Concentration!')
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=CONDITIONAL_GET_GAME_REQUEST,
                       response_message=GameFormP2,
                       path='gamep2/{urlsafe_game_key}',
                       name='get_game_p2',
                       http_method='GET')
+    @ratelimit.rate_limited
+    @wireformat.negotiated
     def get_game_p2(self, request):
         """Get two player game state information.
         Args:
             urlsafe_game_key: A urlsafe key string.
+            if_none_match: Optional, etag from the last GameFormP2.
+            format: Optional, json (default) or packed.
         Returns:
-            GameP2 form representation of the game state.
+            GameP2 form representation of the game state, with not_modified
+            set and no board if the etag still matches.
         Raises:
             NotFoundException: if the game doesn't exist."""
-        game = get_by_urlsafe(request.urlsafe_game_key, GameP2)
-        if game:
-            if game.game_over:
-                return game.to_form('Game already over!')
-            else:
-                return game.to_form('Time to make a move!')
-        else:
-            raise endpoints.NotFoundException('Game not found!')
+        return get_game_form(request,
+                             lambda key: get_by_urlsafe(key, GameP2),
+                             GameFormP2)
 
     @endpoints.method(request_message=USER_RESOURCE_REQUEST,
                       response_message=ActiveGamesForm,
@@ -326,20 +465,24 @@ class ConcentrationGameApi(remote.Service):
             A list of urlsafe_game_key.
         Raises:
             NotFoundException: if user doesn't exist."""
-        user = User.query(User.name == request.user_name).get()
+        user = get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        games = GameP2.query(
-            ndb.OR(GameP2.user1 == user.key, GameP2.user2 == user.key))
-        return ActiveGamesForm(
-            game=[(g.key).urlsafe() for g in games if g.game_over is False])
+        games = []
+        for seat in ('user1', 'user2'):
+            games.extend(storage.repository.query(
+                GameP2, [(seat, '=', user.key), ('game_over', '=', False)]))
+        return ActiveGamesForm(game=[g.key.urlsafe() for g in games])
 
     @endpoints.method(request_message=MAKE_MOVE_REQUEST_P2,
                       response_message=GameFormP2,
                       path='gamep2/{urlsafe_game_key}',
                       name='make_move_p2',
                       http_method='PUT')
+    @ratelimit.rate_limited
+    @wireformat.negotiated
+    @idempotency.idempotent_move(GameFormP2)
     def make_move_p2(self, request):
         """Make move in two player game. Returns game state with message.
         Args:
@@ -348,14 +491,26 @@ class ConcentrationGameApi(remote.Service):
             y1: First co-ordinate y position.
             y2: Second co-ordinate y position.
             user_name: User name string.
+            version: Optional, the game version the move was based on.
+            request_id: Optional, client id of the move - a retry with the
+            same id replays the first response instead of moving again.
+            format: Optional, json (default) or packed.
         Returns:
             GameP2 form representation of the game state.
         Raises:
-            NotFoundException: if user doesn't exist."""
+            NotFoundException: if user doesn't exist.
+            ConflictException: if the game changed since it was read, or a
+            move with the same request_id is in progress."""
+        import gamecache
         game = get_by_urlsafe(request.urlsafe_game_key, GameP2)
         if game.game_over:
             return game.to_form('Game already over!')
-        user = User.query(User.name == request.user_name).get()
+        # the version this move is based on - the save fails if it moves on
+        expected_version = game.version
+        if request.version is not None and request.version != game.version:
+            raise endpoints.ConflictException(
+                    'Game has changed, refresh the game and try again!')
+        user = get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
@@ -414,33 +569,65 @@ class ConcentrationGameApi(remote.Service):
         game.card_map = json.dumps(card_map_dict)
         game.card_graveyard = json.dumps(graveyard_dict)
         game.update_game_history(player, selection1, selection2, msg)
-        game.put()
+        try:
+            game.put_if_version(expected_version)
+        except ConcurrentMoveError:
+            raise endpoints.ConflictException(
+                    'Game has changed, refresh the game and try again!')
         # end the game if all cards are removed from play
         if len(card_map_dict) is 0:
-            user1 = User.query(User.key == game.user1).get()
-            user2 = User.query(User.key == game.user2).get()
-            if not user1 or not user2:
-                raise endpoints.NotFoundException(
-                        'A User with that name does not exist!')
             msg = "Congratulations you found the last pair - Game Over!!"
             # determine winning player - most pairs
             if game.user1_pairs == game.user2_pairs:
                 winner = 0
-                user1.update_user_ranking_info(0)
-                user2.update_user_ranking_info(0)
             else:
                 winner = (1 if game.user1_pairs > game.user2_pairs else 2)
-            # update user stats
-            if winner == 1:
-                user1.update_user_ranking_info(1)
-                user2.update_user_ranking_info(-1)
-            elif winner == 2:
-                user1.update_user_ranking_info(-1)
-                user2.update_user_ranking_info(1)
-            # end game ...
-            game.end_game(winner=winner)
-        # return game form
-        return game.to_form(msg)
+            # end game and update user stats with the scores
+            game.end_game(winner=winner, ranked=True)
+        # let anyone waiting on this game know it has moved on
+        notify.turn_notifier.publish(request.urlsafe_game_key,
+                                     game.turn_state())
+        form = game.to_form(msg)
+        # share the new version's form with get_game_p2 and spectators
+        gamecache.publish_move_form(form, ('Game already over!'
+                                           if game.game_over
+                                           else 'Time to make a move!'))
+        return form
+
+    @endpoints.method(request_message=SPECTATE_REQUEST,
+                      response_message=GameFormP2,
+                      path='gamep2/spectate/{urlsafe_game_key}',
+                      name='spectate_game_p2',
+                      http_method='GET')
+    @wireformat.negotiated
+    def spectate_game_p2(self, request):
+        """Watch a two player game - a read-only view of its state for any
+        number of viewers. The version comes from the published turn state
+        and the form from the shared form cache make_move_p2 fills on every
+        move, so viewers don't read the datastore. Not rate limited per
+        game, as get_game_p2 is.
+        Args:
+            urlsafe_game_key: A urlsafe key string.
+            if_none_match: Optional, etag from the last GameFormP2.
+            since: Optional, the version last seen - waits until the game
+            moves past it (or the timeout runs out) before replying.
+            timeout: Optional, seconds to wait (max 30).
+            format: Optional, json (default) or packed.
+        Returns:
+            GameP2 form representation of the game state, with not_modified
+            set and no board if the etag still matches.
+        Raises:
+            NotFoundException: if the game doesn't exist."""
+        if request.since is not None:
+            state = notify.turn_notifier.current(request.urlsafe_game_key)
+            if state is not None and state['version'] <= request.since \
+                    and not state['game_over']:
+                timeout = max(0, min(request.timeout, notify.MAX_WAIT))
+                notify.turn_notifier.wait(request.urlsafe_game_key,
+                                          request.since, timeout)
+        return get_game_form(request,
+                             lambda key: get_by_urlsafe(key, GameP2),
+                             GameFormP2)
 
     @endpoints.method(request_message=GET_GAME_REQUEST,
                       response_message=GameFormP2,
@@ -454,17 +641,64 @@ class ConcentrationGameApi(remote.Service):
         Returns:
             GameP2 form representation of the game state.
         Raises:
-            NotFoundException: if game doesn't exist."""
+            NotFoundException: if game doesn't exist.
+            ConflictException: if a move was saved since the game was
+            read."""
         game = get_by_urlsafe(request.urlsafe_game_key, GameP2)
         if game:
             if game.game_over:
                 return game.to_form('Game already over!')
             else:
-                game.end_game()
+                # a compare-and-set, so a move saved since the game was read
+                # isn't overwritten
+                game.version += 1
+                if not save_game_results(game.end_game_entities(),
+                                         check_version=True):
+                    raise endpoints.ConflictException(
+                        'Game has changed, refresh the game and try again!')
+                notify.turn_notifier.publish(request.urlsafe_game_key,
+                                             game.turn_state())
                 return game.to_form('Game cancelled!!')
         else:
             raise endpoints.NotFoundException('Game not found!')
 
+    @endpoints.method(request_message=WAIT_TURN_REQUEST,
+                      response_message=TurnNotificationForm,
+                      path='gamep2/wait/{urlsafe_game_key}',
+                      name='wait_for_turn_p2',
+                      http_method='GET')
+    @ratelimit.rate_limited
+    def wait_for_turn_p2(self, request):
+        """Long-poll a two player game - blocks until the game version is
+        greater than since, or the timeout runs out. Waiting is served from
+        the memcache turn state, the datastore is only read if it's missing.
+        Args:
+            urlsafe_game_key: A urlsafe key string.
+            since: The game version the client last saw.
+            timeout: Optional, seconds to wait (max 30).
+        Returns:
+            TurnNotificationForm with the latest version and current_turn.
+        Raises:
+            NotFoundException: if the game doesn't exist."""
+        notifier = notify.turn_notifier
+        timeout = max(0, min(request.timeout, notify.MAX_WAIT))
+        state = notifier.current(request.urlsafe_game_key)
+        if state is None:
+            # not cached (evicted or never published) - prime it once
+            game = get_by_urlsafe(request.urlsafe_game_key, GameP2)
+            if not game:
+                raise endpoints.NotFoundException('Game not found!')
+            state = game.turn_state()
+            notifier.publish(request.urlsafe_game_key, state)
+        if state['version'] <= request.since and not state['game_over']:
+            state = notifier.wait(request.urlsafe_game_key,
+                                  request.since, timeout) or state
+        return TurnNotificationForm(urlsafe_key=request.urlsafe_game_key,
+                                    version=state['version'],
+                                    current_turn=state['current_turn'],
+                                    game_over=state['game_over'],
+                                    changed=state['version'] > request.since)
+
     @endpoints.method(response_message=ScoreFormsP2,
                       path='scoresp2',
                       name='get_high_scores_p2',
@@ -476,7 +710,7 @@ class ConcentrationGameApi(remote.Service):
         Returns:
             List of ScoreP2 - ordered by pairs descending then by date
             descending."""
-        scores = ScoreP2.query().order(-ScoreP2.pairs).order(-ScoreP2.date)
+        scores = storage.repository.query(ScoreP2, order=['-pairs', '-date'])
         return ScoreFormsP2(items=[s.to_form() for s in scores])
 
     @endpoints.method(request_message=USER_RESOURCE_REQUEST,
@@ -493,28 +727,335 @@ class ConcentrationGameApi(remote.Service):
             List of ScoreP2 - all scores for given user.
         Raises:
             NotFoundException: if user doesn't exist."""
-        user = User.query(User.name == request.user_name).get()
+        user = get_user(request.user_name)
         if not user:
             raise endpoints.NotFoundException(
                     'A User with that name does not exist!')
-        scores = ScoreP2.query(ScoreP2.user == user.key).order(ScoreP2.pairs)
+        scores = get_user_scores(ScoreP2, user.key, ['pairs'])
         return ScoreFormsP2(items=[score.to_form() for score in scores])
 
+    @endpoints.method(request_message=JOIN_MATCHMAKING_REQUEST,
+                      response_message=MatchStatusForm,
+                      path='matchmaking',
+                      name='join_matchmaking',
+                      http_method='POST')
+    def join_matchmaking(self, request):
+        """Join the two player matchmaking queue. Players are paired with
+        others waiting for the same board size with a similar user_ranking,
+        and a GameP2 is created for them.
+        Args:
+            user_name: Player user name.
+            size: Size of the game board, valid values [2, 4, 8].
+        Returns:
+            MatchStatusForm - poll get_match_status for the game key. A
+            player already matched to a game still in play gets that match.
+        Raises:
+            NotFoundException: when user doesn't exist.
+            BadRequestException: when invalid size passed."""
+        # rarely used - imported here to keep it out of instance startup
+        import matchmaking
+        user = get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        try:
+            match_request = matchmaking.join_queue(user, request.size)
+        except ValueError:
+            raise endpoints.BadRequestException('Invalid board size. Valid '
+                                                'sizes are 2,4,8.')
+        matchmaking.request_match(request.size)
+        return match_request.to_form(user.name)
+
+    @endpoints.method(request_message=USER_RESOURCE_REQUEST,
+                      response_message=MatchStatusForm,
+                      path='matchmaking/{user_name}',
+                      name='get_match_status',
+                      http_method='GET')
+    def get_match_status(self, request):
+        """Get a player's matchmaking status.
+        Args:
+            user_name: User name string.
+        Returns:
+            MatchStatusForm - with the urlsafe_game_key once matched.
+        Raises:
+            NotFoundException: if the user doesn't exist or isn't queued."""
+        user = get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        match_request = MatchRequest.get_by_id(user.key.id())
+        if not match_request:
+            raise endpoints.NotFoundException(
+                    'User is not waiting for a match!')
+        return match_request.to_form(user.name)
+
+    @endpoints.method(request_message=NEW_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament',
+                      name='new_tournament',
+                      http_method='POST')
+    def new_tournament(self, request):
+        """Create a single elimination tournament of two player games and
+        start its first round.
+        Args:
+            name: Tournament name.
+            user_names: List of player user names, in seed order.
+            size: Size of the game boards, valid values [2, 4, 8].
+        Returns:
+            TournamentForm with the bracket and the first round game keys.
+        Raises:
+            NotFoundException: if any of the players doesn't exist.
+            BadRequestException: when invalid size passed, or fewer than two
+            different players."""
+        import tournament
+        try:
+            created = tournament.create_tournament(
+                request.name, request.user_names, request.size)
+        except ValueError as e:
+            raise endpoints.BadRequestException(e.message)
+        except LookupError as e:
+            raise endpoints.NotFoundException(e.message)
+        return created.to_form('Tournament started!')
+
+    @endpoints.method(request_message=GET_TOURNAMENT_REQUEST,
+                      response_message=TournamentForm,
+                      path='tournament/{urlsafe_tournament_key}',
+                      name='get_tournament',
+                      http_method='GET')
+    def get_tournament(self, request):
+        """Tournament standings - the whole bracket with results.
+        Args:
+            urlsafe_tournament_key: A urlsafe key string.
+        Returns:
+            TournamentForm with every round's matches, game keys and winners.
+        Raises:
+            NotFoundException: if the tournament doesn't exist."""
+        import tournament
+        standings = get_by_urlsafe(request.urlsafe_tournament_key,
+                                   tournament.Tournament)
+        if not standings:
+            raise endpoints.NotFoundException('Tournament not found!')
+        bracket = standings.get_bracket()
+        if standings.status == 'done':
+            return standings.to_form('Tournament over!', bracket)
+        return standings.to_form('Round {0} in play.'.format(
+            tournament.current_round(bracket)), bracket)
+
+    @endpoints.method(request_message=NEW_GAME_REQUEST_MP,
+                      response_message=GameFormMP,
+                      path='newgamemp',
+                      name='new_game_mp',
+                      http_method='POST')
+    def new_game_mp(self, request):
+        """Create a new multiplayer game for 2 to 8 players.
+        Args:
+            user_names: List of player user names, in seat order.
+            size: Size of the game board, valid values [2, 4, 8].
+        Returns:
+            GameMP form representation of the game state.
+        Raises:
+            NotFoundException: if any of the players doesn't exist.
+            BadRequestException: when an invalid size or number of players
+            is passed, or a player is listed twice."""
+        if len(set(request.user_names)) != len(request.user_names):
+            raise endpoints.BadRequestException(
+                'Each player can only take one seat!')
+        users = [get_user(name) for name in request.user_names]
+        if None in users:
+            raise endpoints.NotFoundException(
+                'A User with that name does not exist!')
+        try:
+            game = GameMP.new_game([user.key for user in users], request.size)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+        notify.turn_notifier.publish(game.key.urlsafe(), game.turn_state())
+        return game.to_form('Good luck playing Concentration!')
+
+    @endpoints.method(request_message=CONDITIONAL_GET_GAME_REQUEST,
+                      response_message=GameFormMP,
+                      path='gamemp/{urlsafe_game_key}',
+                      name='get_game_mp',
+                      http_method='GET')
+    @ratelimit.rate_limited
+    @wireformat.negotiated
+    def get_game_mp(self, request):
+        """Get multiplayer game state information.
+        Args:
+            urlsafe_game_key: A urlsafe key string.
+            if_none_match: Optional, etag from the last GameFormMP.
+            format: Optional, json (default) or packed.
+        Returns:
+            GameMP form representation of the game state, with not_modified
+            set and no board if the etag still matches.
+        Raises:
+            NotFoundException: if the game doesn't exist."""
+        return get_game_form(request,
+                             lambda key: get_by_urlsafe(key, GameMP),
+                             GameFormMP)
+
+    @endpoints.method(request_message=USER_RESOURCE_REQUEST,
+                      response_message=ActiveGamesForm,
+                      path='activegamesmp',
+                      name='active_games_mp',
+                      http_method='GET')
+    def active_games_mp(self, request):
+        """List all active multiplayer games for a user.
+        Args:
+            user_name: User name string.
+        Returns:
+            A list of urlsafe_game_key.
+        Raises:
+            NotFoundException: if user doesn't exist."""
+        user = get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        games = storage.repository.query(
+            GameMP, [('users', '=', user.key), ('game_over', '=', False)])
+        return ActiveGamesForm(game=[g.key.urlsafe() for g in games])
+
+    @endpoints.method(request_message=USER_RESOURCE_REQUEST,
+                      response_message=ScoreFormsMP,
+                      path='scoresmp/user/{user_name}',
+                      name='get_user_scores_mp',
+                      http_method='GET')
+    def get_user_scores_mp(self, request):
+        """Returns all multiplayer game scores for a user - most recent
+        first.
+        Args:
+            user_name: User name string.
+        Returns:
+            List of ScoreMP - all scores for given user.
+        Raises:
+            NotFoundException: if user doesn't exist."""
+        user = get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        # ScoreMP has no indexed properties - sorted here, not in the query
+        scores = sorted(get_user_scores(ScoreMP, user.key),
+                        key=lambda score: score.date, reverse=True)
+        return ScoreFormsMP(items=[score.to_form() for score in scores])
+
+    @endpoints.method(request_message=MAKE_MOVE_REQUEST_MP,
+                      response_message=GameFormMP,
+                      path='gamemp/{urlsafe_game_key}',
+                      name='make_move_mp',
+                      http_method='PUT')
+    @ratelimit.rate_limited
+    @wireformat.negotiated
+    @idempotency.idempotent_move(GameFormMP)
+    def make_move_mp(self, request):
+        """Make move in a multiplayer game. Returns game state with message.
+        Args:
+            x1: First co-ordinate x position.
+            x2: Second co-ordinate x position.
+            y1: First co-ordinate y position.
+            y2: Second co-ordinate y position.
+            user_name: User name string.
+            version: Optional, the game version the move was based on.
+            request_id: Optional, client id of the move - a retry with the
+            same id replays the first response instead of moving again.
+            format: Optional, json (default) or packed.
+        Returns:
+            GameMP form representation of the game state.
+        Raises:
+            NotFoundException: if the game or user doesn't exist.
+            ConflictException: if the game changed since it was read, or a
+            move with the same request_id is in progress."""
+        game = get_by_urlsafe(request.urlsafe_game_key, GameMP)
+        if not game:
+            raise endpoints.NotFoundException('Game not found!')
+        if game.game_over:
+            return game.to_form('Game already over!')
+        expected_version = game.version
+        if request.version is not None and request.version != game.version:
+            raise endpoints.ConflictException(
+                    'Game has changed, refresh the game and try again!')
+        user = get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        if user.key not in game.users:
+            return game.to_form('You are not playing in this game!!')
+        seat = game.users.index(user.key)
+        if seat != game.current_seat:
+            return game.to_form('Not your turn yet!!')
+        card_map_dict = json.loads(game.card_map)
+        selection1 = str((request.x1, request.y1))
+        selection2 = str((request.x2, request.y2))
+        # sanity checks - don't count as a turn
+        if selection1 == selection2:
+            msg = "Invalid selection - choose 2 different pairs!!"
+            return game.to_form(msg)
+        if selection1 not in card_map_dict or selection2 not in card_map_dict:
+            msg = "Invalid selection: {0}, {1}".format(selection1, selection2)
+            return game.to_form(msg)
+        msg = game.apply_move(seat, selection1, selection2)
+        try:
+            game.put_if_version(expected_version)
+        except ConcurrentMoveError:
+            raise endpoints.ConflictException(
+                    'Game has changed, refresh the game and try again!')
+        # end the game if all cards are removed from play
+        if sum(game.seat_pairs) == game.card_pairs:
+            msg = "Congratulations you found the last pair - Game Over!!"
+            game.end_game(ranked=True)
+        notify.turn_notifier.publish(request.urlsafe_game_key,
+                                     game.turn_state())
+        return game.to_form(msg)
+
     @endpoints.method(request_message=GET_GAME_REQUEST,
+                      response_message=GameFormMP,
+                      path='gamemp/cancel/{urlsafe_game_key}',
+                      name='cancel_game_mp',
+                      http_method='PUT')
+    def cancel_game_mp(self, request):
+        """Cancel a multiplayer game.
+        Args:
+            urlsafe: A urlsafe key string.
+        Returns:
+            GameMP form representation of the game state.
+        Raises:
+            NotFoundException: if game doesn't exist.
+            ConflictException: if a move was saved since the game was
+            read."""
+        game = get_by_urlsafe(request.urlsafe_game_key, GameMP)
+        if game:
+            if game.game_over:
+                return game.to_form('Game already over!')
+            else:
+                # a compare-and-set, so a move saved since the game was read
+                # isn't overwritten
+                game.version += 1
+                if not save_game_results(game.end_game_entities(),
+                                         check_version=True):
+                    raise endpoints.ConflictException(
+                        'Game has changed, refresh the game and try again!')
+                notify.turn_notifier.publish(request.urlsafe_game_key,
+                                             game.turn_state())
+                return game.to_form('Game cancelled!!')
+        else:
+            raise endpoints.NotFoundException('Game not found!')
+
+    @endpoints.method(request_message=HISTORY_REQUEST,
                       response_message=GameHistoryForms,
                       path='historyp1/{urlsafe_game_key}',
                       name='get_game_history_p1',
                       http_method='GET')
+    @wireformat.negotiated
     def get_game_history_p1(self, request):
         """Game history - get a list of game moves (single player games).
         Args:
             urlsafe: A urlsafe key string.
+            format: Optional, json (default) or packed.
         Returns:
             A list of GameHistoryForm -
                 (turns, player, coord1, coord2, move_result)
         Raises:
             NotFoundException: if the game doesn't exist."""
-        game = get_by_urlsafe(request.urlsafe_game_key, GameP1)
+        import writebehind
+        game = writebehind.load_game(request.urlsafe_game_key)
         if not game:
             raise endpoints.NotFoundException('Game not found!')
         return GameHistoryForms(
@@ -524,15 +1065,17 @@ class ConcentrationGameApi(remote.Service):
                                      coord2=h[3],
                                      result=h[4]) for h in game.game_history])
 
-    @endpoints.method(request_message=GET_GAME_REQUEST,
+    @endpoints.method(request_message=HISTORY_REQUEST,
                       response_message=GameHistoryForms,
                       path='historyp2/{urlsafe_game_key}',
                       name='get_game_history_p2',
                       http_method='GET')
+    @wireformat.negotiated
     def get_game_history_p2(self, request):
         """Game history - get a list of game moves (two player games).
         Args:
             urlsafe: A urlsafe key string.
+            format: Optional, json (default) or packed.
         Returns:
             A list of GameHistoryForm -
                 (turns, player, coord1, coord2, move_result)
@@ -550,6 +1093,64 @@ class ConcentrationGameApi(remote.Service):
                                      coord2=h[3],
                                      result=h[4]) for h in game.game_history])
 
+    @endpoints.method(request_message=REPLAY_REQUEST,
+                      response_message=ReplayForm,
+                      path='replayp1/{urlsafe_game_key}/{turn}',
+                      name='replay_game_p1',
+                      http_method='GET')
+    def replay_game_p1(self, request):
+        """Game replay - the board of a single player game at a turn.
+        Args:
+            urlsafe: A urlsafe key string.
+            turn: Number of moves to replay, 0 for the starting board.
+        Returns:
+            ReplayForm - cards in play and removed, pairs won and the move
+            that led to the turn.
+        Raises:
+            NotFoundException: if the game doesn't exist.
+            BadRequestException: if the turn is outside the game history."""
+        import writebehind
+        return get_replay_form(
+            request, writebehind.load_game(request.urlsafe_game_key))
+
+    @endpoints.method(request_message=REPLAY_REQUEST,
+                      response_message=ReplayForm,
+                      path='replayp2/{urlsafe_game_key}/{turn}',
+                      name='replay_game_p2',
+                      http_method='GET')
+    def replay_game_p2(self, request):
+        """Game replay - the board of a two player game at a turn.
+        Args:
+            urlsafe: A urlsafe key string.
+            turn: Number of moves to replay, 0 for the starting board.
+        Returns:
+            ReplayForm - cards in play and removed, pairs won per player and
+            the move that led to the turn.
+        Raises:
+            NotFoundException: if the game doesn't exist.
+            BadRequestException: if the turn is outside the game history."""
+        return get_replay_form(
+            request, get_by_urlsafe(request.urlsafe_game_key, GameP2))
+
+    @endpoints.method(request_message=REPLAY_REQUEST,
+                      response_message=ReplayForm,
+                      path='replaymp/{urlsafe_game_key}/{turn}',
+                      name='replay_game_mp',
+                      http_method='GET')
+    def replay_game_mp(self, request):
+        """Game replay - the board of a multiplayer game at a turn.
+        Args:
+            urlsafe: A urlsafe key string.
+            turn: Number of moves to replay, 0 for the starting board.
+        Returns:
+            ReplayForm - cards in play and removed, pairs won per seat and
+            the move that led to the turn.
+        Raises:
+            NotFoundException: if the game doesn't exist.
+            BadRequestException: if the turn is outside the game history."""
+        return get_replay_form(
+            request, get_by_urlsafe(request.urlsafe_game_key, GameMP))
+
     @endpoints.method(response_message=ConsecutiveTurnsForms,
                       path='consecutiveturns',
                       name='get_consecutive_turn_scores',
@@ -561,12 +1162,62 @@ class ConcentrationGameApi(remote.Service):
         Returns:
             A list of ConsecutiveTurns (forms) - ordered by turns descending
             then by size descending."""
-        consec_turns = ConsecutiveTurns.query()\
-            .order(-ConsecutiveTurns.turns)\
-            .order(-ConsecutiveTurns.size)
+        consec_turns = storage.repository.query(ConsecutiveTurns,
+                                                order=['-turns', '-size'])
         return ConsecutiveTurnsForms(
             items=[ct.to_form() for ct in consec_turns])
 
+    @endpoints.method(request_message=LEADERBOARD_REQUEST,
+                      response_message=LeaderboardForm,
+                      path='leaderboard/{board}/{window}/{size}',
+                      name='get_leaderboard',
+                      http_method='GET')
+    def get_leaderboard(self, request):
+        """Daily, weekly or monthly leaderboard for a board size, read from
+        pre-aggregated rollups.
+        Args:
+            board: p1 (fewest turns), p2 (most pairs) or consec (most
+                consecutive turns).
+            window: daily, weekly or monthly.
+            size: Size of the game board.
+            period: Optional, e.g. 2016-05-31, 2016-W22 or 2016-05. Defaults
+                to the current period.
+        Returns:
+            LeaderboardForm with the top 25 entries, best first.
+        Raises:
+            BadRequestException: for an invalid board or window."""
+        import leaderboards
+        try:
+            return leaderboards.get_leaderboard(request.board, request.window,
+                                                request.size, request.period)
+        except ValueError as e:
+            raise endpoints.BadRequestException(str(e))
+
+    @endpoints.method(request_message=USER_RESOURCE_REQUEST,
+                      response_message=UserStatsForm,
+                      path='stats/{user_name}',
+                      name='get_user_stats',
+                      http_method='GET')
+    def get_user_stats(self, request):
+        """Statistics summary for a user - games played, win rate, average
+        and best turns per game mode and board size, and best consecutive
+        turns. Kept up to date as games end, so it is a single get.
+        Args:
+            user_name: User name string.
+        Returns:
+            UserStatsForm.
+        Raises:
+            NotFoundException: if user doesn't exist."""
+        import userstats
+        user = get_user(request.user_name)
+        if not user:
+            raise endpoints.NotFoundException(
+                    'A User with that name does not exist!')
+        stats = userstats.UserStats.get_by_id(user.key.id())
+        if not stats:
+            return UserStatsForm(user_name=user.name, best_consec_turns=0)
+        return stats.to_form(user.name)
+
     @endpoints.method(response_message=UserRankings,
                       path='rankings',
                       name='get_user_rankings',
@@ -579,7 +1230,8 @@ class ConcentrationGameApi(remote.Service):
             None.
         Returns:
             A list of UserRanking (form) ordered by user_ranking descending."""
-        user_rankings = User.query().order(-User.user_ranking)
+        user_rankings = storage.repository.query(User,
+                                                 order=['-user_ranking'])
         return UserRankings(
             rankings=[ur.to_user_ranking_form() for ur in user_rankings])
 
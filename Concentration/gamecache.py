@@ -0,0 +1,88 @@
+"""gamecache.py - Shared cache of serialized game forms. A game's form only
+changes when its version changes - or when the last move of a two player or
+multiplayer game is saved and the game is then ended at the same version -
+so forms are cached per (game key, version, game over) and every client
+polling the same game at the same state shares one serialized copy.
+
+make_move_p2 publishes the form of every move it saves, so players reading
+the game and spectators don't rebuild it. Each instance also keeps the
+forms it has seen in a small LRU in front of memcache - many spectators of
+one game on an instance then cost no memcache call either."""
+
+import collections
+import threading
+from protorpc import protojson
+from google.appengine.api import memcache
+
+FORM_CACHE_TTL = 600  # seconds
+LOCAL_CACHE_SIZE = 500  # forms kept per instance - 0 turns the LRU off
+
+
+class LocalFormCache(object):
+    """Per instance LRU of encoded forms. Entries are never stale, as the
+    form of a game version and game over flag doesn't change - they're only
+    evicted. Encoded
+    forms are kept, so every caller decodes its own message to modify."""
+
+    def __init__(self, size):
+        self.size = size
+        self._forms = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the encoded form or None"""
+        with self._lock:
+            encoded = self._forms.pop(key, None)
+            if encoded is not None:
+                self._forms[key] = encoded
+            return encoded
+
+    def set(self, key, encoded):
+        """Store an encoded form, evicting the least recently used"""
+        if not self.size:
+            return
+        with self._lock:
+            self._forms.pop(key, None)
+            self._forms[key] = encoded
+            while len(self._forms) > self.size:
+                self._forms.popitem(last=False)
+
+
+local_forms = LocalFormCache(LOCAL_CACHE_SIZE)
+
+
+def _cache_key(urlsafe_game_key, version, game_over):
+    return 'form:{0}:{1}:{2}'.format(urlsafe_game_key, version,
+                                     int(bool(game_over)))
+
+
+def get_form(urlsafe_game_key, version, game_over, form_class):
+    """Returns the cached form_class message for the game version and game
+    over flag, or None"""
+    key = _cache_key(urlsafe_game_key, version, game_over)
+    encoded = local_forms.get(key)
+    if encoded is None:
+        encoded = memcache.get(key)
+        if encoded is None:
+            return None
+        local_forms.set(key, encoded)
+    return protojson.decode_message(form_class, encoded)
+
+
+def set_form(urlsafe_game_key, version, form):
+    """Cache a form for the game version (and the form's game over flag)"""
+    key = _cache_key(urlsafe_game_key, version, form.game_over)
+    encoded = protojson.encode_message(form)
+    memcache.set(key, encoded, time=FORM_CACHE_TTL)
+    local_forms.set(key, encoded)
+
+
+def publish_move_form(form, message):
+    """Cache the form a move returned for the game's new version, with
+    message (what get_game says) in place of the move's result"""
+    move_message = form.message
+    form.message = message
+    try:
+        set_form(form.urlsafe_key, form.version, form)
+    finally:
+        form.message = move_message
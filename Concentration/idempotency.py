@@ -0,0 +1,99 @@
+"""idempotency.py - De-duplication of retried move requests.
+
+Clients can send a request_id with a move. The first request with that id
+claims it in memcache, and its response is stored in a MoveResponse entity
+(kept for RESPONSE_RETENTION) and in memcache for MOVE_RESPONSE_TTL seconds.
+A retry with the same id gets the stored response back without touching the
+game, so a retried move is never applied twice - memcache answers most
+retries, and the entity still answers them once memcache has evicted the
+response or flushed. A retry that arrives while the first request is still
+running gets a ConflictException. The claim lasts as long as a cached
+response would, so a retry of a request that died keeps getting the
+ConflictException rather than moving again - after that the game's own
+version check (make_move_p2 / make_move_mp) is the guard.
+
+A move with a request_id costs one extra datastore get and put. Expired
+responses are deleted by a daily cron job (purge_responses)."""
+
+import datetime
+import functools
+import logging
+import endpoints
+from protorpc import protojson
+from google.appengine.api import memcache
+from google.appengine.ext import ndb
+
+MOVE_RESPONSE_TTL = 600  # seconds a claim or cached response is kept for
+RESPONSE_RETENTION = datetime.timedelta(days=1)  # stored responses
+_PENDING = 'pending'
+
+
+class MoveResponse(ndb.Model):
+    """The response of a move sent with a request_id - keyed by the memcache
+    key ('move:<urlsafe game key>:<request_id>'), a root entity so saving it
+    doesn't contend with the game's own writes"""
+    response = ndb.TextProperty(required=True)
+    expires = ndb.DateTimeProperty(required=True)
+
+
+def _cache_key(urlsafe_game_key, request_id):
+    return 'move:{0}:{1}'.format(urlsafe_game_key, request_id)
+
+
+def _stored_response(cache_key):
+    """Returns the encoded response saved for cache_key, or None"""
+    stored = MoveResponse.get_by_id(cache_key)
+    if stored is None or stored.expires < datetime.datetime.now():
+        return None
+    return stored.response
+
+
+def purge_responses():
+    """Delete expired MoveResponses. Returns the number deleted."""
+    expired = MoveResponse.query(
+        MoveResponse.expires < datetime.datetime.now()).fetch(keys_only=True)
+    ndb.delete_multi(expired)
+    return len(expired)
+
+
+def idempotent_move(form_class):
+    """Decorator for move endpoint methods whose request has an optional
+    request_id and urlsafe_game_key, and whose response is a form_class"""
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, request):
+            if not request.request_id:
+                return method(self, request)
+            cache_key = _cache_key(request.urlsafe_game_key,
+                                   request.request_id)
+            if not memcache.add(cache_key, _PENDING,
+                                time=MOVE_RESPONSE_TTL):
+                stored = memcache.get(cache_key)
+                if stored == _PENDING:
+                    raise endpoints.ConflictException(
+                        'Move is still being processed (or its result was '
+                        'lost), retry shortly or reload the game!')
+                if stored is not None:
+                    return protojson.decode_message(form_class, stored)
+                # expired between add and get - treat as a new move
+            # memcache may have lost the response of a move that was made
+            stored = _stored_response(cache_key)
+            if stored is not None:
+                memcache.set(cache_key, stored, time=MOVE_RESPONSE_TTL)
+                return protojson.decode_message(form_class, stored)
+            try:
+                response = method(self, request)
+            except Exception:
+                memcache.delete(cache_key)
+                raise
+            encoded = protojson.encode_message(response)
+            MoveResponse(id=cache_key, response=encoded,
+                         expires=datetime.datetime.now() +
+                         RESPONSE_RETENTION).put()
+            if not memcache.set(cache_key, encoded, time=MOVE_RESPONSE_TTL):
+                # the claim stays, so a retry is refused rather than replayed
+                logging.warning('Could not cache the response of move %s',
+                                cache_key)
+            return response
+        return wrapper
+    return decorator
@@ -0,0 +1,195 @@
+"""leaderboards.py - Daily, weekly and monthly leaderboards per board size.
+
+Leaderboards are pre-aggregated into LeaderboardRollup entities when games
+end, so reading one touches ROLLUP_SHARDS rollups plus the users on it, no
+matter how many scores there are. Each leaderboard is split over a few
+shards (picked by a hash of the score key) to spread the write load, and a
+daily cron compacts the rollups and deletes expired ones.
+
+Recording is idempotent, as the result tasks that record scores run at
+least once: every entry keeps its score key, and a score is only added to
+its shard if no entry there has its key. A retried score hashes to the same
+shard, and an entry trimmed from a shard ranked below every entry kept, so
+it can't come back into the shard's top entries either.
+
+Boards:
+    p1: won single player games - fewest turns first.
+    p2: two player games - most pairs first, then newest.
+    consec: consecutive turn scores - most turns first."""
+
+import datetime
+import zlib
+from google.appengine.ext import ndb
+from messages import LeaderboardForm, LeaderboardEntryForm
+
+BOARDS = ('p1', 'p2', 'consec')
+WINDOWS = ('daily', 'weekly', 'monthly')
+LEADERBOARD_SIZE = 25  # entries returned per leaderboard
+ROLLUP_SHARDS = 4
+ROLLUP_MAX_ENTRIES = 100  # a shard is trimmed inline once it grows past this
+RETENTION = {'daily': datetime.timedelta(days=31),
+             'weekly': datetime.timedelta(weeks=26),
+             'monthly': datetime.timedelta(days=730)}
+
+
+def window_period(window, date):
+    """Returns the period name of the window containing date, e.g.
+    2016-05-31 (daily), 2016-W22 (weekly), 2016-05 (monthly)"""
+    if window == 'daily':
+        return date.strftime('%Y-%m-%d')
+    elif window == 'weekly':
+        year, week, _ = date.isocalendar()
+        return '{0}-W{1:02d}'.format(year, week)
+    elif window == 'monthly':
+        return date.strftime('%Y-%m')
+    raise ValueError('Invalid window. Valid windows are daily, weekly, '
+                     'monthly.')
+
+
+def sort_entries(board, entries):
+    """Sorts [value, date, urlsafe user key, urlsafe score key] entries best
+    first"""
+    if board == 'p1':
+        return sorted(entries, key=lambda e: (e[0], e[1]))
+    newest_first = sorted(entries, key=lambda e: e[1], reverse=True)
+    return sorted(newest_first, key=lambda e: e[0], reverse=True)
+
+
+def score_entries(entities):
+    """Yields (board, size, date, entry) for the score entities in a list of
+    saved entities - other entities are skipped"""
+    for entity in entities:
+        kind = entity._get_kind()
+        key = entity.key.urlsafe()
+        if kind == 'ScoreP1' and entity.won:
+            yield ('p1', entity.size, entity.date,
+                   [entity.turns, str(entity.date), entity.user.urlsafe(),
+                    key])
+        elif kind == 'ScoreP2':
+            yield ('p2', entity.size, entity.date,
+                   [entity.pairs, str(entity.date), entity.user.urlsafe(),
+                    key])
+        elif kind == 'ConsecutiveTurns':
+            # scores saved before they had a date count from now
+            date = entity.date or datetime.datetime.now()
+            yield ('consec', entity.size, date,
+                   [entity.turns, str(date), entity.user.urlsafe(), key])
+
+
+def score_shard(urlsafe_score_key):
+    """The rollup shard a score is recorded in"""
+    return zlib.crc32(urlsafe_score_key) % ROLLUP_SHARDS
+
+
+class LeaderboardRollup(ndb.Model):
+    """Top scores for one shard of a leaderboard, window period and board
+    size. Keyed by board:window:period:size:shard"""
+    board = ndb.StringProperty(required=True, indexed=False)
+    window = ndb.StringProperty(required=True, indexed=False)
+    period = ndb.StringProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    # [[value, date, user key, score key]] - older entries have no score key
+    entries = ndb.JsonProperty(default=[])
+    expires = ndb.DateTimeProperty(required=True)
+    updated = ndb.DateTimeProperty(auto_now=True)
+
+    @staticmethod
+    def rollup_id(board, window, period, size, shard):
+        return '{0}:{1}:{2}:{3}:{4}'.format(board, window, period, size,
+                                            shard)
+
+    def compact(self):
+        """Drop everything but the top LEADERBOARD_SIZE entries"""
+        self.entries = sort_entries(
+            self.board, self.entries)[:LEADERBOARD_SIZE]
+
+
+def record_scores(entities):
+    """Add the scores in a list of saved entities to every window's
+    leaderboard - one small transaction per rollup shard, run in parallel.
+    Scores already recorded are skipped."""
+    grouped = {}
+    for board, size, date, entry in score_entries(entities):
+        for window in WINDOWS:
+            period = window_period(window, date)
+            rollup = (board, window, period, size, score_shard(entry[3]))
+            grouped.setdefault(rollup, []).append(entry)
+    futures = [_add_entries_async(rollup, new_entries)
+               for rollup, new_entries in grouped.items()]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+@ndb.tasklet
+def _add_entries_async(rollup, new_entries):
+    board, window, period, size, shard = rollup
+    key = ndb.Key(LeaderboardRollup, LeaderboardRollup.rollup_id(
+        board, window, period, size, shard))
+
+    @ndb.tasklet
+    def _txn():
+        entity = yield key.get_async()
+        if entity is None:
+            entity = LeaderboardRollup(
+                key=key, board=board, window=window, period=period,
+                size=size, entries=[],
+                expires=datetime.datetime.now() + RETENTION[window])
+        recorded = set(entry[3] for entry in entity.entries
+                       if len(entry) > 3)
+        added = [entry for entry in new_entries if entry[3] not in recorded]
+        if not added:
+            return
+        entity.entries = entity.entries + added
+        if len(entity.entries) > ROLLUP_MAX_ENTRIES:
+            entity.compact()
+        yield entity.put_async()
+
+    yield ndb.transaction_async(_txn)
+
+
+def get_leaderboard(board, window, size, period=None):
+    """Returns a LeaderboardForm for the window period (the current one if
+    period is None). Raises ValueError for an invalid board or window."""
+    if board not in BOARDS:
+        raise ValueError('Invalid board. Valid boards are p1, p2, consec.')
+    current_period = window_period(window, datetime.datetime.now())
+    period = period or current_period
+    keys = [ndb.Key(LeaderboardRollup, LeaderboardRollup.rollup_id(
+        board, window, period, size, shard))
+        for shard in range(ROLLUP_SHARDS)]
+    entries = []
+    for rollup in ndb.get_multi(keys):
+        if rollup:
+            entries.extend(rollup.entries)
+    entries = sort_entries(board, entries)[:LEADERBOARD_SIZE]
+    users = ndb.get_multi([ndb.Key(urlsafe=e[2]) for e in entries])
+    return LeaderboardForm(
+        board=board, window=window, period=period, size=size,
+        entries=[LeaderboardEntryForm(user_name=user.name if user else '',
+                                      value=entry[0],
+                                      date=entry[1])
+                 for entry, user in zip(entries, users)])
+
+
+def compact_rollups():
+    """Compact rollups updated in the last day and delete expired ones.
+    Returns (compacted, deleted) counts."""
+    now = datetime.datetime.now()
+    expired = LeaderboardRollup.query(
+        LeaderboardRollup.expires < now).fetch(keys_only=True)
+    ndb.delete_multi(expired)
+    compacted = 0
+    for key in LeaderboardRollup.query(
+            LeaderboardRollup.updated > now - datetime.timedelta(days=1)
+            ).iter(keys_only=True):
+        ndb.transaction(lambda: _compact(key))
+        compacted += 1
+    return compacted, len(expired)
+
+
+def _compact(key):
+    rollup = key.get()
+    if rollup and len(rollup.entries) > LEADERBOARD_SIZE:
+        rollup.compact()
+        rollup.put()
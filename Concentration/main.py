@@ -2,11 +2,37 @@
 
 """main.py - This file contains handlers that are called by taskqueue and/or
 cronjobs."""
+import collections
+import datetime
+import json
+import logging
 import webapp2
-from google.appengine.api import mail, app_identity
+from google.appengine.api import mail, app_identity, memcache, taskqueue
+from google.appengine.datastore.datastore_query import Cursor
 from google.appengine.ext import ndb
-from api import ConcentrationGameApi
-from models import User, GameP1, GameP2
+# the API layer (endpoints) isn't imported here - cron and task instances
+# only load the models, the warmup request loads the API
+from models import User, GameP1, GameP2, GameMP, save_game_results
+from models import SCORE_KINDS, LEGACY_SCORES, merge_legacy_scores
+from models import warm_board_pool, record_results, ReplayCheckpoint
+import leaderboards
+import userstats
+import notify
+
+STALE_GAME_DAYS = 30  # games with no move for this long get cancelled
+REAP_BATCH_SIZE = 100  # games cancelled (or backfilled) per task
+STATS_BATCH_SIZE = 50  # users recomputed per task
+VERIFY_BATCH_SIZE = 100  # finished games replayed per task
+# games that ended more recently are left for the next verification run, so
+# the last_move index has caught up with every game the run covers
+VERIFY_LAG = datetime.timedelta(hours=1)
+MIGRATE_BATCH_SIZE = 20  # users whose scores are moved per task
+MIGRATE_SCORES_PER_USER = 100  # scores moved per user per task
+# seconds between writes to one entity group - the datastore sustains about
+# one write a second per group
+GROUP_WRITE_INTERVAL = 1
+GAME_KINDS = {'GameP1': GameP1, 'GameP2': GameP2, 'GameMP': GameMP}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S.%f'  # datetimes passed in task params
 
 
 class SendReminderEmail(webapp2.RequestHandler):
@@ -60,6 +86,384 @@ class SendReminderEmail(webapp2.RequestHandler):
                            subject,
                            body)
 
+
+class ReapStaleGames(webapp2.RequestHandler):
+    def get(self):
+        """Start cancelling games with no move for STALE_GAME_DAYS days (or
+        the days parameter) - one task chain per game kind. Called every day
+        using a cron job"""
+        days = int(self.request.get('days', STALE_GAME_DAYS))
+        for kind in GAME_KINDS:
+            taskqueue.add(url='/tasks/reap_stale_games',
+                          params={'kind': kind, 'days': days})
+
+
+class ReapStaleGamesTask(webapp2.RequestHandler):
+    def post(self):
+        """Cancel one batch of stale games the same way cancel_game_p1/p2
+        does - saving each game with its scores and result tasks, if no move
+        was saved since it was read. Chains another task with the query
+        cursor while there are more."""
+        model = GAME_KINDS[self.request.get('kind')]
+        days = int(self.request.get('days', STALE_GAME_DAYS))
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        cutoff = datetime.datetime.now() - datetime.timedelta(days=days)
+        query = model.query(model.game_over == False,
+                            model.last_move < cutoff).order(model.last_move)
+        games, next_cursor, more = query.fetch_page(REAP_BATCH_SIZE,
+                                                    start_cursor=cursor)
+        entities = []
+        for game in games:
+            game.version += 1
+            entities.extend(game.end_game_entities())
+        # a game with a move saved since the query is skipped
+        cancelled = save_game_results(entities, check_version=True)
+        for game in cancelled:
+            notify.turn_notifier.publish(game.key.urlsafe(),
+                                         game.turn_state())
+        logging.info('Cancelled %d stale %s games', len(cancelled),
+                     model.__name__)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/reap_stale_games',
+                          params={'kind': self.request.get('kind'),
+                                  'days': days,
+                                  'cursor': next_cursor.urlsafe()})
+
+
+class BackfillLastMoveTask(webapp2.RequestHandler):
+    def post(self):
+        """Set last_move on one batch of unfinished games saved before games
+        had it - the reaper's query can't see them. last_move becomes now, so
+        a backfilled game is reaped once it has had no move for
+        STALE_GAME_DAYS from the backfill. Chains another task with the
+        query cursor while there are more. Run it once per game kind by
+        queueing /tasks/backfill_last_move with the kind parameter"""
+        model = GAME_KINDS[self.request.get('kind')]
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        games, next_cursor, more = model.query(
+            model.game_over == False).fetch_page(REAP_BATCH_SIZE,
+                                                 start_cursor=cursor)
+
+        @ndb.transactional
+        def _backfill(key):
+            game = key.get()
+            if game and game.last_move is None:
+                game.put()  # last_move is auto_now
+                return True
+            return False
+
+        backfilled = [game.key for game in games
+                      if game.last_move is None and _backfill(game.key)]
+        logging.info('Backfilled last_move of %d %s games', len(backfilled),
+                     model.__name__)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/backfill_last_move',
+                          params={'kind': self.request.get('kind'),
+                                  'cursor': next_cursor.urlsafe()})
+
+
+class MatchPlayers(webapp2.RequestHandler):
+    def get(self):
+        """Run the two player matcher for every board size. Called every
+        minute using a cron job"""
+        import matchmaking
+        for size in [2, 4, 8]:
+            matchmaking.match_players(size)
+
+
+class MatchPlayersTask(webapp2.RequestHandler):
+    def post(self):
+        """On demand matcher run for one board size, queued when a player
+        joins the matchmaking queue"""
+        import matchmaking
+        matchmaking.match_players(int(self.request.get('size')))
+
+
+class CompactLeaderboards(webapp2.RequestHandler):
+    def get(self):
+        """Trim leaderboard rollups updated in the last day and delete expired
+        ones. Called every day using a cron job"""
+        compacted, deleted = leaderboards.compact_rollups()
+        logging.info('Compacted %d and deleted %d leaderboard rollups',
+                     compacted, deleted)
+
+
+class PurgeMoveResponses(webapp2.RequestHandler):
+    def get(self):
+        """Delete the stored responses of retried moves once they expire.
+        Called every day using a cron job"""
+        # imported here - it loads endpoints, which task instances don't
+        # need otherwise
+        import idempotency
+        logging.info('Deleted %d move responses',
+                     idempotency.purge_responses())
+
+
+class RecomputeUserStatsTask(webapp2.RequestHandler):
+    def post(self):
+        """Rebuild the stats summary of a batch of users from their full
+        score history, then chain another task with the query cursor while
+        there are more users. Start it by queueing /tasks/recompute_user_stats
+        with no cursor"""
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        users, next_cursor, more = User.query().fetch_page(
+            STATS_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+        stats = []
+        for user in users:
+            futures = [model.query(ancestor=user).fetch_async()
+                       for model in SCORE_KINDS]
+            if LEGACY_SCORES:
+                legacy = [model.query(model.user == user).fetch_async()
+                          for model in SCORE_KINDS]
+            scores = [score for future in futures
+                      for score in future.get_result()]
+            if LEGACY_SCORES:
+                scores = merge_legacy_scores(
+                    scores, [score for future in legacy
+                             for score in future.get_result()])
+            stats.append(userstats.rebuild(user, scores))
+        ndb.put_multi(stats)
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/recompute_user_stats',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+def _migrate_user_scores(user, kind=0, cursor=None):
+    """Move a page of a user's root scores under the user, keeping their ids
+    - reading up to MIGRATE_SCORES_PER_USER score keys, from
+    SCORE_KINDS[kind] on and starting at cursor. Returns (scores moved,
+    (kind, cursor) to carry on from or None once every kind was read).
+
+    Paging with the cursor always moves on, even past index entries of
+    scores moved already, which the eventually consistent user query can
+    keep returning for a while."""
+    keys = []
+    while kind < len(SCORE_KINDS) and len(keys) < MIGRATE_SCORES_PER_USER:
+        model = SCORE_KINDS[kind]
+        page, next_cursor, more = model.query(model.user == user).fetch_page(
+            MIGRATE_SCORES_PER_USER - len(keys), start_cursor=cursor,
+            keys_only=True)
+        keys.extend(page)
+        if more and next_cursor:
+            cursor = next_cursor
+        else:
+            kind, cursor = kind + 1, None
+    old_keys = [key for key in keys if key.parent() is None]
+    scores = [score for score in ndb.get_multi(old_keys) if score]
+    # save the copies before deleting the originals - a retried task writes
+    # the same keys again
+    ndb.put_multi([type(score)(parent=user, id=score.key.id(),
+                               **score.to_dict())
+                   for score in scores])
+    ndb.delete_multi([score.key for score in scores])
+    return len(scores), (kind, cursor) if kind < len(SCORE_KINDS) else None
+
+
+class MigrateScoresTask(webapp2.RequestHandler):
+    def post(self):
+        """Move a batch of users' root score entities (saved before scores
+        had their user as parent) under the user, keeping their ids. Each
+        user's new scores are saved with one put_multi, so a task writes each
+        user's entity group once; a user with more than
+        MIGRATE_SCORES_PER_USER scores gets a chain of tasks of their own,
+        GROUP_WRITE_INTERVAL apart, paging through their scores with a
+        cursor. Chains another task with the query cursor while there are
+        more users. Start it by queueing /tasks/migrate_scores with no
+        cursor"""
+        if self.request.get('user'):
+            score_cursor = self.request.get('score_cursor')
+            users, next_cursor, more = [
+                ndb.Key(urlsafe=self.request.get('user'))], None, False
+            start = (int(self.request.get('kind', 0)),
+                     Cursor(urlsafe=score_cursor) if score_cursor else None)
+        else:
+            cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+            users, next_cursor, more = User.query().fetch_page(
+                MIGRATE_BATCH_SIZE, start_cursor=cursor, keys_only=True)
+            start = (0, None)
+        moved = 0
+        for user in users:
+            user_moved, resume = _migrate_user_scores(user, *start)
+            moved += user_moved
+            if resume:
+                kind, score_cursor = resume
+                taskqueue.add(url='/tasks/migrate_scores',
+                              params={'user': user.urlsafe(), 'kind': kind,
+                                      'score_cursor': score_cursor.urlsafe()
+                                      if score_cursor else ''},
+                              countdown=GROUP_WRITE_INTERVAL)
+        logging.info('Moved %d scores of %d users', moved, len(users))
+        if more and next_cursor:
+            taskqueue.add(url='/tasks/migrate_scores',
+                          params={'cursor': next_cursor.urlsafe()})
+
+
+class VerifyReplays(webapp2.RequestHandler):
+    def get(self):
+        """Start re-simulating the games finished since the last run - one
+        task chain per game kind. Called every week using a cron job"""
+        until = datetime.datetime.now() - VERIFY_LAG
+        checkpoints = ndb.get_multi([ndb.Key(ReplayCheckpoint, kind)
+                                     for kind in GAME_KINDS])
+        for kind, checkpoint in zip(GAME_KINDS, checkpoints):
+            params = {'kind': kind, 'until': until.strftime(TIME_FORMAT)}
+            if checkpoint:
+                params['since'] = checkpoint.verified_until.strftime(
+                    TIME_FORMAT)
+            taskqueue.add(url='/tasks/verify_replays', params=params)
+
+
+class VerifyReplaysTask(webapp2.RequestHandler):
+    def post(self):
+        """Replay one batch of the games that finished (last_move) after
+        since (if given) and up to until from their starting board and log
+        every game whose recorded results or checkpoints don't match the
+        replay. Chains another task with the query cursor while there are
+        more, and the last task moves the kind's ReplayCheckpoint on to
+        until - a chain that doesn't finish is picked up again by the next
+        run."""
+        kind = self.request.get('kind')
+        model = GAME_KINDS[kind]
+        since = self.request.get('since')
+        until = datetime.datetime.strptime(self.request.get('until'),
+                                           TIME_FORMAT)
+        cursor = Cursor(urlsafe=self.request.get('cursor') or None)
+        query = model.query(model.game_over == True,
+                            model.last_move <= until)
+        if since:
+            query = query.filter(model.last_move > datetime.datetime.strptime(
+                since, TIME_FORMAT))
+        games, next_cursor, more = query.order(model.last_move).fetch_page(
+            VERIFY_BATCH_SIZE, start_cursor=cursor)
+        failed = 0
+        for game in games:
+            errors = game.replay_errors()
+            if errors:
+                failed += 1
+                logging.error('Replay of %s %s failed: %s', kind,
+                              game.key.urlsafe(), '; '.join(errors))
+        logging.info('Verified %d %s games, %d failed', len(games), kind,
+                     failed)
+        if more and next_cursor:
+            params = {'kind': kind,
+                      'until': self.request.get('until'),
+                      'cursor': next_cursor.urlsafe()}
+            if since:
+                params['since'] = since
+            taskqueue.add(url='/tasks/verify_replays', params=params)
+        else:
+            ReplayCheckpoint(id=kind, verified_until=until).put()
+
+
+class StartAnalyticsTask(webapp2.RequestHandler):
+    def post(self):
+        """Start a sharded analytics job - queue /tasks/start_analytics with
+        the analysis name (see analytics.ANALYSES) and optionally shards"""
+        import analytics
+        job = analytics.start_job(
+            self.request.get('analysis'),
+            int(self.request.get('shards', analytics.SHARDS)))
+        logging.info('Started %s analytics job %d with %d shards',
+                     job.analysis, job.key.id(), job.shard_count)
+
+
+class AnalyticsShardTask(webapp2.RequestHandler):
+    def post(self):
+        """Map the next batch of an analytics shard"""
+        import analytics
+        analytics.map_shard(self.request.get('shard'),
+                            self.request.get('cursor'))
+
+
+class AnalyticsMergeTask(webapp2.RequestHandler):
+    def post(self):
+        """Merge the shards of a finished analytics job into its result"""
+        import analytics
+        analytics.merge_job(int(self.request.get('job')))
+
+
+class RecordResultsTask(webapp2.RequestHandler):
+    def post(self):
+        """Add the scores of an ended game to the leaderboards or to the
+        players' stats summaries (the updater parameter) - queued by
+        save_game_results. A contended rollup fails the task, so it is
+        retried."""
+        record_results(self.request.get('updater'),
+                       self.request.get_all('key'))
+
+
+class AdvanceTournamentTask(webapp2.RequestHandler):
+    def post(self):
+        """Move the winners of ended tournament games (the game parameters)
+        into their next matches - queued by save_game_results"""
+        import tournament
+        for urlsafe_game_key in self.request.get_all('game'):
+            tournament.advance(urlsafe_game_key)
+
+
+class ImportUsers(webapp2.RequestHandler):
+    def post(self):
+        """Bulk import users from a newline delimited JSON body of
+        {"name": ..., "email": ...} records (userimport.py). Replies with
+        JSON - a result per record, counts per result and next_offset. If
+        next_offset isn't null the time budget ran out: post the same body
+        again with ?offset=next_offset to carry on."""
+        import userimport
+        try:
+            offset = int(self.request.GET.get('offset') or 0)
+        except ValueError:
+            self.abort(400, detail='offset must be a line number')
+        results, next_offset = userimport.import_users(
+            self.request.body_file, max(0, offset))
+        counts = collections.Counter(result['result'] for result in results)
+        logging.info('Imported users from line %d: %s', offset, dict(counts))
+        self.response.content_type = 'application/json'
+        self.response.write(json.dumps({'results': results,
+                                        'counts': counts,
+                                        'next_offset': next_offset}))
+
+
+class FlushJournalTask(webapp2.RequestHandler):
+    def post(self):
+        """Save the journalled moves of a write-behind game that hasn't had
+        a move since its journal was started - queued by writebehind when a
+        journal starts. A move in the way fails the task, so it is
+        retried."""
+        import writebehind
+        writebehind.flush_abandoned(self.request.get('game'))
+
+
+class Warmup(webapp2.RequestHandler):
+    def get(self):
+        """Warmup request - does the instance start up work before it is sent
+        any traffic: loads the API module (endpoints, protorpc and the
+        resource containers), builds the board pool and opens the memcache
+        and datastore connections"""
+        import api  # noqa
+        warm_board_pool()
+        memcache.get('warmup')
+        User.query().get(keys_only=True)
+
+
 app = webapp2.WSGIApplication([
-    ('/crons/send_reminder', SendReminderEmail)
+    ('/crons/send_reminder', SendReminderEmail),
+    ('/crons/reap_stale_games', ReapStaleGames),
+    ('/tasks/reap_stale_games', ReapStaleGamesTask),
+    ('/tasks/backfill_last_move', BackfillLastMoveTask),
+    ('/crons/match_players', MatchPlayers),
+    ('/tasks/match_players', MatchPlayersTask),
+    ('/crons/compact_leaderboards', CompactLeaderboards),
+    ('/crons/purge_move_responses', PurgeMoveResponses),
+    ('/tasks/recompute_user_stats', RecomputeUserStatsTask),
+    ('/tasks/migrate_scores', MigrateScoresTask),
+    ('/crons/verify_replays', VerifyReplays),
+    ('/tasks/verify_replays', VerifyReplaysTask),
+    ('/tasks/start_analytics', StartAnalyticsTask),
+    ('/tasks/analytics_shard', AnalyticsShardTask),
+    ('/tasks/analytics_merge', AnalyticsMergeTask),
+    ('/tasks/record_results', RecordResultsTask),
+    ('/tasks/advance_tournament', AdvanceTournamentTask),
+    ('/tasks/flush_journal', FlushJournalTask),
+    ('/admin/import_users', ImportUsers),
+    ('/_ah/warmup', Warmup)
 ], debug=True)
@@ -0,0 +1,133 @@
+"""matchmaking.py - Rating based matchmaking queue for two player games.
+
+Players join with their user_ranking and board size. Each request is stored
+with a rating bucket, and the matcher reads a batch of waiting players in
+bucket order and pairs neighbours inside each bucket (sorted by rating). An
+unpaired player is carried into the next bucket if it is adjacent, otherwise
+it waits for the next tick. A tick over n waiting players costs one query
+and O(n log n) work rather than comparing every pair of players.
+
+Ticks can overlap (the cron and on-demand tasks) and the waiting query is
+eventually consistent, so a pair is only matched by claiming it: a
+transaction re-reads both requests by key, and saves the game and both
+requests only if neither is matched yet. Pairs that lose the claim are left
+for a later tick."""
+
+import logging
+import time
+from google.appengine.api import datastore_errors, taskqueue
+from google.appengine.ext import ndb
+from models import GameP2, MatchRequest
+import notify
+
+BUCKET_WIDTH = 50.0  # user_ranking points per bucket
+MATCH_BATCH = 1000  # waiting players read per tick and board size
+MATCH_INTERVAL = 10  # seconds - on demand ticks are de-duplicated per interval
+
+
+def rating_bucket(rating):
+    """Returns the bucket number for a rating"""
+    return int(rating // BUCKET_WIDTH)
+
+
+def join_queue(user, size):
+    """Adds (or replaces) the user's match request and returns it. A
+    request already matched to a game still in play is kept and returned as
+    it is. Raises ValueError for an invalid board size."""
+    if size not in [2, 4, 8]:
+        raise ValueError('Invalid board size. Valid sizes are 2,4,8.')
+
+    @ndb.transactional(xg=True)
+    def _join():
+        match_request = MatchRequest.get_by_id(user.key.id())
+        if match_request and match_request.matched and match_request.game:
+            game = match_request.game.get()
+            if game and not game.game_over:
+                return match_request
+        match_request = MatchRequest(id=user.key.id(),
+                                     user=user.key,
+                                     rating=user.user_ranking,
+                                     size=size,
+                                     bucket=rating_bucket(user.user_ranking))
+        match_request.put()
+        return match_request
+
+    return _join()
+
+
+def request_match(size):
+    """Queue an on-demand matcher run - at most one per size per interval"""
+    tick = int(time.time() // MATCH_INTERVAL)
+    try:
+        taskqueue.add(url='/tasks/match_players',
+                      name='match-{0}-{1}'.format(size, tick),
+                      params={'size': size})
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+        pass
+
+
+def pair_requests(requests):
+    """Pairs match requests (in bucket order) by rating. Returns a list of
+    (request1, request2) tuples - unpaired requests are left out."""
+    buckets = {}
+    for match_request in requests:
+        buckets.setdefault(match_request.bucket, []).append(match_request)
+    pairs = []
+    carried = None
+    for bucket in sorted(buckets):
+        waiting = sorted(buckets[bucket], key=lambda r: r.rating)
+        if carried is not None:
+            if carried.bucket == bucket - 1:
+                waiting.insert(0, carried)
+            carried = None
+        for i in range(0, len(waiting) - 1, 2):
+            pairs.append((waiting[i], waiting[i + 1]))
+        if len(waiting) % 2:
+            carried = waiting[-1]
+    return pairs
+
+
+@ndb.transactional_tasklet(xg=True)
+def claim_pair(key1, key2, size):
+    """Matches two requests if both are still waiting for size - saves a
+    new GameP2 and both requests pointing at it. Returns the game, or None if
+    either request was matched (or changed) meanwhile."""
+    requests = yield ndb.get_multi_async([key1, key2])
+    if not all(match_request and not match_request.matched and
+               match_request.size == size for match_request in requests):
+        raise ndb.Return(None)
+    r1, r2 = requests
+    first, _ = yield GameP2.allocate_ids_async(1)
+    game = GameP2.build_game(r1.user, r2.user, size)
+    game.key = ndb.Key(GameP2, first)
+    for match_request in requests:
+        match_request.matched = True
+        match_request.game = game.key
+    yield ndb.put_multi_async([game, r1, r2])
+    raise ndb.Return(game)
+
+
+def match_players(size):
+    """Runs one matcher tick for a board size - claims every pair (in
+    parallel transactions) and creates a GameP2 for each pair claimed.
+    Returns the number of games created."""
+    waiting = MatchRequest.query(
+        MatchRequest.matched == False,
+        MatchRequest.size == size).order(MatchRequest.bucket).fetch(
+            MATCH_BATCH)
+    pairs = pair_requests(waiting)
+    futures = [claim_pair(r1.key, r2.key, size) for r1, r2 in pairs]
+    games = []
+    for future in futures:
+        try:
+            game = future.get_result()
+        except datastore_errors.TransactionFailedError:
+            # contention with another tick or a join - retried next tick
+            game = None
+        if game:
+            games.append(game)
+    for game in games:
+        notify.turn_notifier.publish(game.key.urlsafe(), game.turn_state())
+    logging.info('Matched %d games of size %d from %d waiting players',
+                 len(games), size, len(waiting))
+    return len(games)
@@ -9,6 +9,7 @@ class NewGameFormP1(messages.Message):
     """Inbound form for creating a new single player game"""
     user_name = messages.StringField(1, required=True)
     size = messages.IntegerField(2, required=True)
+    write_behind = messages.BooleanField(3, default=False)
 
 
 class NewGameFormP2(messages.Message):
@@ -18,36 +19,89 @@ class NewGameFormP2(messages.Message):
     size = messages.IntegerField(3, required=True)
 
 
+class NewGameFormMP(messages.Message):
+    """Inbound form for creating a new multiplayer game"""
+    user_names = messages.StringField(1, repeated=True)
+    size = messages.IntegerField(2, required=True)
+
+
 class GameFormP1(messages.Message):
-    """GameForm for outbound single player game state information"""
+    """GameForm for outbound single player game state information. A "not
+    modified" reply only carries the key, version, etag and game_over"""
     urlsafe_key = messages.StringField(1, required=True)
-    user_name = messages.StringField(2, required=True)
-    size = messages.IntegerField(3, required=True)
-    turns = messages.IntegerField(4, required=True)
+    user_name = messages.StringField(2)
+    size = messages.IntegerField(3)
+    turns = messages.IntegerField(4)
     game_over = messages.BooleanField(5, required=True)
     message = messages.StringField(6, required=True)
     cards = messages.StringField(7, repeated=True)  # array of json
-    pairs_won = messages.IntegerField(8, required=True)
-    consec_turns = messages.IntegerField(9, required=True)
+    pairs_won = messages.IntegerField(8)
+    consec_turns = messages.IntegerField(9)
+    version = messages.IntegerField(10)
+    etag = messages.StringField(11)
+    not_modified = messages.BooleanField(12, default=False)
+    packed_cards = messages.BytesField(13)  # format=packed, see wireformat
 
 
 class GameFormP2(messages.Message):
-    """GameForm for outbound two player game state information"""
+    """GameForm for outbound two player game state information. A "not
+    modified" reply only carries the key, version, etag, current_turn and
+    game_over"""
     urlsafe_key = messages.StringField(1, required=True)
-    user_name1 = messages.StringField(2, required=True)
-    user_name1_turns = messages.IntegerField(3, required=True)
-    user_name1_pairs = messages.IntegerField(4, required=True)
-    user_name1_consec_turns = messages.IntegerField(5, required=True)
-    user_name2 = messages.StringField(6, required=True)
-    user_name2_turns = messages.IntegerField(7, required=True)
-    user_name2_pairs = messages.IntegerField(8, required=True)
-    user_name2_consec_turns = messages.IntegerField(9, required=True)
-    turns = messages.IntegerField(10, required=True)
-    current_turn = messages.IntegerField(11, required=True)
-    size = messages.IntegerField(12, required=True)
+    user_name1 = messages.StringField(2)
+    user_name1_turns = messages.IntegerField(3)
+    user_name1_pairs = messages.IntegerField(4)
+    user_name1_consec_turns = messages.IntegerField(5)
+    user_name2 = messages.StringField(6)
+    user_name2_turns = messages.IntegerField(7)
+    user_name2_pairs = messages.IntegerField(8)
+    user_name2_consec_turns = messages.IntegerField(9)
+    turns = messages.IntegerField(10)
+    current_turn = messages.IntegerField(11)
+    size = messages.IntegerField(12)
     cards = messages.StringField(13, repeated=True)  # array of json
     game_over = messages.BooleanField(14, required=True)
     message = messages.StringField(15, required=True)
+    version = messages.IntegerField(16)
+    etag = messages.StringField(17)
+    not_modified = messages.BooleanField(18, default=False)
+    packed_cards = messages.BytesField(19)  # format=packed, see wireformat
+
+
+class PlayerStateForm(messages.Message):
+    """Outbound per player state of a multiplayer game"""
+    seat = messages.IntegerField(1, required=True)
+    user_name = messages.StringField(2, required=True)
+    turns = messages.IntegerField(3, required=True)
+    pairs = messages.IntegerField(4, required=True)
+    consec_turns = messages.IntegerField(5, required=True)
+
+
+class GameFormMP(messages.Message):
+    """GameForm for outbound multiplayer game state information. A "not
+    modified" reply only carries the key, version, etag, current_seat and
+    game_over"""
+    urlsafe_key = messages.StringField(1, required=True)
+    players = messages.MessageField(PlayerStateForm, 2, repeated=True)
+    turns = messages.IntegerField(3)
+    current_seat = messages.IntegerField(4)
+    size = messages.IntegerField(5)
+    cards = messages.StringField(6, repeated=True)  # array of json
+    game_over = messages.BooleanField(7, required=True)
+    message = messages.StringField(8, required=True)
+    version = messages.IntegerField(9)
+    etag = messages.StringField(10)
+    not_modified = messages.BooleanField(11, default=False)
+    packed_cards = messages.BytesField(12)  # format=packed, see wireformat
+
+
+class TurnNotificationForm(messages.Message):
+    """Outbound turn state returned when waiting for a turn"""
+    urlsafe_key = messages.StringField(1, required=True)
+    version = messages.IntegerField(2, required=True)
+    current_turn = messages.IntegerField(3, required=True)
+    game_over = messages.BooleanField(4, required=True)
+    changed = messages.BooleanField(5, required=True)
 
 
 class MakeMoveFormP1(messages.Message):
@@ -56,6 +110,7 @@ class MakeMoveFormP1(messages.Message):
     y1 = messages.IntegerField(2, required=True)
     x2 = messages.IntegerField(3, required=True)
     y2 = messages.IntegerField(4, required=True)
+    request_id = messages.StringField(5)  # optional, for safe retries
 
 
 class MakeMoveFormP2(messages.Message):
@@ -65,6 +120,66 @@ class MakeMoveFormP2(messages.Message):
     x2 = messages.IntegerField(3, required=True)
     y2 = messages.IntegerField(4, required=True)
     user_name = messages.StringField(5, required=True)
+    version = messages.IntegerField(6)  # optional, game version last seen
+    request_id = messages.StringField(7)  # optional, for safe retries
+
+
+class MakeMoveFormMP(messages.Message):
+    """Used to make a move in an existing multiplayer game"""
+    x1 = messages.IntegerField(1, required=True)
+    y1 = messages.IntegerField(2, required=True)
+    x2 = messages.IntegerField(3, required=True)
+    y2 = messages.IntegerField(4, required=True)
+    user_name = messages.StringField(5, required=True)
+    version = messages.IntegerField(6)  # optional, game version last seen
+    request_id = messages.StringField(7)  # optional, for safe retries
+
+
+class JoinMatchmakingForm(messages.Message):
+    """Inbound form to join the two player matchmaking queue"""
+    user_name = messages.StringField(1, required=True)
+    size = messages.IntegerField(2, required=True)
+
+
+class MatchStatusForm(messages.Message):
+    """Outbound matchmaking status - the game key is set once matched"""
+    user_name = messages.StringField(1, required=True)
+    size = messages.IntegerField(2, required=True)
+    matched = messages.BooleanField(3, required=True)
+    urlsafe_game_key = messages.StringField(4)
+
+
+class NewTournamentForm(messages.Message):
+    """Inbound form for creating a tournament - user_names in seed order"""
+    name = messages.StringField(1, required=True)
+    user_names = messages.StringField(2, repeated=True)
+    size = messages.IntegerField(3, required=True)
+
+
+class TournamentMatchForm(messages.Message):
+    """A bracket match - players are unset until they are known"""
+    player1 = messages.StringField(1)
+    player2 = messages.StringField(2)
+    urlsafe_game_key = messages.StringField(3)
+    winner = messages.StringField(4)
+
+
+class TournamentRoundForm(messages.Message):
+    """The matches of a tournament round"""
+    round = messages.IntegerField(1, required=True)
+    matches = messages.MessageField(TournamentMatchForm, 2, repeated=True)
+
+
+class TournamentForm(messages.Message):
+    """Outbound tournament standings - the whole bracket"""
+    urlsafe_key = messages.StringField(1, required=True)
+    name = messages.StringField(2, required=True)
+    size = messages.IntegerField(3, required=True)
+    status = messages.StringField(4, required=True)
+    current_round = messages.IntegerField(5, required=True)
+    champion = messages.StringField(6)
+    rounds = messages.MessageField(TournamentRoundForm, 7, repeated=True)
+    message = messages.StringField(8)
 
 
 class ActiveGamesForm(messages.Message):
@@ -93,6 +208,19 @@ class ScoreFormP2(messages.Message):
     size = messages.IntegerField(7, required=True)
 
 
+class ScoreFormMP(messages.Message):
+    """ScoreForm for multiplayer outbound Score information"""
+    user_name = messages.StringField(1, required=True)
+    date = messages.StringField(2, required=True)
+    won = messages.BooleanField(3, required=True)
+    tie = messages.BooleanField(4, required=True)
+    rank = messages.IntegerField(5, required=True)
+    players = messages.IntegerField(6, required=True)
+    turns = messages.IntegerField(7, required=True)
+    pairs = messages.IntegerField(8, required=True)
+    size = messages.IntegerField(9, required=True)
+
+
 class ScoreFormsP1(messages.Message):
     """Return multiple ScoreForms"""
     items = messages.MessageField(ScoreFormP1, 1, repeated=True)
@@ -103,6 +231,11 @@ class ScoreFormsP2(messages.Message):
     items = messages.MessageField(ScoreFormP2, 1, repeated=True)
 
 
+class ScoreFormsMP(messages.Message):
+    """Return multiple ScoreForms"""
+    items = messages.MessageField(ScoreFormMP, 1, repeated=True)
+
+
 class StringMessage(messages.Message):
     """StringMessage - outbound (single) string message"""
     message = messages.StringField(1, required=True)
@@ -120,6 +253,42 @@ class ConsecutiveTurnsForms(messages.Message):
     items = messages.MessageField(ConsecutiveTurnsForm, 1, repeated=True)
 
 
+class LeaderboardEntryForm(messages.Message):
+    """One leaderboard entry - value is turns, pairs or consecutive turns
+    depending on the board"""
+    user_name = messages.StringField(1, required=True)
+    value = messages.IntegerField(2, required=True)
+    date = messages.StringField(3, required=True)
+
+
+class LeaderboardForm(messages.Message):
+    """Time windowed leaderboard (outbound)"""
+    board = messages.StringField(1, required=True)
+    window = messages.StringField(2, required=True)
+    period = messages.StringField(3, required=True)
+    size = messages.IntegerField(4, required=True)
+    entries = messages.MessageField(LeaderboardEntryForm, 5, repeated=True)
+
+
+class ModeStatsForm(messages.Message):
+    """A user's stats for one game mode (p1, p2, mp) and board size"""
+    mode = messages.StringField(1, required=True)
+    size = messages.IntegerField(2, required=True)
+    games = messages.IntegerField(3, required=True)
+    wins = messages.IntegerField(4, required=True)
+    ties = messages.IntegerField(5, required=True)
+    win_rate = messages.FloatField(6, required=True)
+    average_turns = messages.FloatField(7, required=True)
+    best_turns = messages.IntegerField(8)
+
+
+class UserStatsForm(messages.Message):
+    """User statistics summary (outbound)"""
+    user_name = messages.StringField(1, required=True)
+    best_consec_turns = messages.IntegerField(2, required=True)
+    modes = messages.MessageField(ModeStatsForm, 3, repeated=True)
+
+
 class UserRanking(messages.Message):
     """User ranking information"""
     user_name = messages.StringField(1, required=True)
@@ -142,3 +311,15 @@ class GameHistoryForm(messages.Message):
 
 class GameHistoryForms(messages.Message):
     history = messages.MessageField(GameHistoryForm, 1, repeated=True)
+    packed_history = messages.BytesField(2)  # format=packed, see wireformat
+
+
+class ReplayForm(messages.Message):
+    """Board state of a game replayed to a turn"""
+    urlsafe_key = messages.StringField(1, required=True)
+    turn = messages.IntegerField(2, required=True)
+    turns = messages.IntegerField(3, required=True)  # moves in the history
+    cards = messages.StringField(4, repeated=True)  # cards still in play
+    removed = messages.StringField(5, repeated=True)  # pairs found so far
+    pairs = messages.IntegerField(6, repeated=True)  # per player, in order
+    move = messages.MessageField(GameHistoryForm, 7)  # move that made turn
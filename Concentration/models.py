@@ -8,16 +8,319 @@ User, Game, Score & related message classes."""
 import datetime
 import json
 import random
-from protorpc import message_types
+from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from messages import (
     GameFormP1,
     GameFormP2,
+    GameFormMP,
+    PlayerStateForm,
+    MatchStatusForm,
     UserRanking,
     ScoreFormP1,
     ScoreFormP2,
+    ScoreFormMP,
     ConsecutiveTurnsForm
 )
+import storage
+
+
+class ConcurrentMoveError(Exception):
+    """Raised when a game was saved by another request after it was read"""
+
+
+def game_etag(version):
+    """Returns the etag token for a game at the given version"""
+    return '"{0}"'.format(version)
+
+
+RESULT_UPDATERS = ('leaderboards', 'userstats')  # see RecordResultsTask
+XG_GROUPS = 25  # entity groups a cross-group transaction can write
+
+
+def save_game_results(entities, check_version=False, ranked=False):
+    """Saves ended games and their scores (from end_game_entities). The games
+    are saved in batches - each batch in one transaction, with as many games
+    as fit in XG_GROUPS entity groups - and the transaction also queues the
+    tasks that add the batch's scores to the time windowed leaderboards and
+    the players' stats summaries, and advance its tournament games' brackets.
+    A saved game's results are always recorded, and a contended rollup is
+    retried by its task rather than failing the request that ended the game.
+
+    With check_version, ending a game is a compare-and-set like a move: the
+    caller bumps game.version by one, and a game whose stored copy isn't at
+    the version before (a move got in first) is left as it is. Returns the
+    games saved.
+
+    With ranked, the same transaction also updates the players' ranking
+    stats from their two player and multiplayer scores - the users are in
+    the batch's entity groups already, so each is written once."""
+    saved = []
+    for batch in _batch_games(_split_games(entities)):
+        saved.extend(storage.repository.transaction(
+            lambda batch=batch: _save_game_results(batch, check_version,
+                                                   ranked)))
+    return saved
+
+
+def _split_games(entities):
+    """Yields the entities of each game - a game followed by its scores"""
+    group = []
+    for entity in entities:
+        if isinstance(entity, ReplayableGame) and group:
+            yield group
+            group = []
+        group.append(entity)
+    if group:
+        yield group
+
+
+def _batch_games(games):
+    """Yields batches of games' entity lists writing at most XG_GROUPS
+    entity groups each - the game's and its players' (scores are saved under
+    their user)"""
+    batch = []
+    groups = set()
+    for game_entities in games:
+        roots = set(entity.key.root() for entity in game_entities)
+        if batch and len(groups | roots) > XG_GROUPS:
+            yield batch
+            batch = []
+            groups = set()
+        batch.append(game_entities)
+        groups |= roots
+    if batch:
+        yield batch
+
+
+def _save_game_results(batch, check_version=False, ranked=False):
+    """Save a batch of games with their scores (and with ranked, their
+    players' updated ranking stats) and queue their result tasks - call in a
+    transaction. Returns the games saved: with check_version, games whose
+    stored copy changed are left out."""
+    if check_version:
+        stored = storage.repository.get_multi([game_entities[0].key
+                                               for game_entities in batch])
+        batch = [game_entities for game_entities, game in zip(batch, stored)
+                 if game is not None and
+                 game.version == game_entities[0].version - 1]
+    if not batch:
+        return []
+    entities = [entity for game_entities in batch
+                for entity in game_entities]
+    if ranked:
+        entities.extend(_ranked_users(entities))
+    storage.repository.put_multi(entities)
+    games = [game_entities[0] for game_entities in batch]
+    keys = [entity.key.urlsafe() for game_entities in batch
+            for entity in game_entities[1:]]
+    for updater in RESULT_UPDATERS:
+        storage.repository.queue_task('/tasks/record_results',
+                                      {'updater': updater, 'key': keys})
+    tournament_games = [game.key.urlsafe() for game in games
+                        if getattr(game, 'tournament', None)]
+    if tournament_games:
+        # tournament.advance does nothing for a game already advanced
+        storage.repository.queue_task('/tasks/advance_tournament',
+                                      {'game': tournament_games})
+    return games
+
+
+def _ranked_users(entities):
+    """Returns the users of the two player and multiplayer scores among
+    entities with their ranking stats updated - call in a transaction"""
+    results = [(score.user, 0 if score.tie else 1 if score.won else -1)
+               for score in entities
+               if isinstance(score, (ScoreP2, ScoreMP))]
+    users = {}
+    for user in storage.repository.get_multi(
+            list(set(user_key for user_key, _ in results))):
+        if user:
+            users[user.key] = user
+    for user_key, result in results:
+        if user_key in users:
+            users[user_key].update_user_ranking_info(result)
+    return users.values()
+
+
+def record_results(updater, urlsafe_keys):
+    """Add saved scores to the leaderboards or to the players' stats
+    summaries - updater is one of RESULT_UPDATERS"""
+    # only run by the result tasks - imported here to keep them out of
+    # instance startup
+    import leaderboards
+    import userstats
+    scores = [score for score in ndb.get_multi(
+        [ndb.Key(urlsafe=key) for key in urlsafe_keys]) if score]
+    if updater == 'leaderboards':
+        leaderboards.record_scores(scores)
+    elif updater == 'userstats':
+        userstats.record_scores(scores)
+    else:
+        raise ValueError('Invalid updater. Valid updaters are {0}.'.format(
+            ', '.join(RESULT_UPDATERS)))
+
+
+# board pool - the cell keys str((x, y)) of every board size, built once per
+# instance (or by the warmup request) and copied for each new game
+_BOARD_CELLS = {}
+
+
+def warm_board_pool():
+    """Build the cell keys for every board size"""
+    for size in [2, 4, 8]:
+        board_cells(size)
+
+
+def board_cells(size):
+    """Returns the list of cell keys of a size x size board. Don't modify the
+    list, it is shared. Raises ValueError for an invalid size."""
+    if size not in [2, 4, 8]:
+        raise ValueError('Invalid board size. Valid sizes are 2,4,8.')
+    if size not in _BOARD_CELLS:
+        _BOARD_CELLS[size] = [
+            str((x, y)) for x in range(size) for y in range(size)]
+    return _BOARD_CELLS[size]
+
+
+def new_card_map(size):
+    """Returns a shuffled card map {str((x, y)): pair} for a size x size
+    board. Raises ValueError for an invalid size."""
+    # copy the coords for all possible cells on board
+    coords = list(board_cells(size))
+    # shuffle the coords and randomly create matching pair
+    random.shuffle(coords)
+    return dict((cell, index / 2) for index, cell in enumerate(coords))
+
+
+class VersionedGame(object):
+    """Mixin for game models with a version property - saves moves with a
+    compare-and-set on the version"""
+
+    def put_if_version(self, expected_version):
+        """Saves the game only if the stored copy is still at expected_version,
+        then bumps the version. Doesn't retry - a lost race is reported to the
+        caller straight away.
+        Raises:
+            ConcurrentMoveError: if another request saved the game first."""
+        def _compare_and_set():
+            stored = storage.repository.get(self.key)
+            if stored is None or stored.version != expected_version:
+                raise ConcurrentMoveError()
+            self.version = expected_version + 1
+            storage.repository.put_multi([self])
+        try:
+            storage.repository.transaction(_compare_and_set, retries=0)
+        except datastore_errors.TransactionFailedError:
+            self.version = expected_version
+            raise ConcurrentMoveError()
+
+
+CHECKPOINT_EVERY = 10  # moves between board checkpoints
+FOUND_PAIR = "Found a pair!!"
+
+
+class ReplayableGame(object):
+    """Mixin for game models with a move history. Every CHECKPOINT_EVERY
+    moves a checkpoint of the board is kept with the history -
+    {'turn': moves played, 'removed': [cells], 'pairs': [pairs per player]} -
+    so the board at any turn is rebuilt from the nearest checkpoint rather
+    than from the first move. Players in the history are numbered from
+    FIRST_PLAYER."""
+    FIRST_PLAYER = 1
+
+    def player_pairs(self):
+        """Returns the pairs won per player, in player order"""
+        raise NotImplementedError
+
+    def update_game_history(self, player, coord1, coord2, result):
+        """Add a move to the game history list - call after counting the move
+        in turns, so a move's turn is its position in the history, from 1"""
+        move = (self.turns, player, coord1, coord2, result)
+        self.game_history.append(move)
+        self.add_checkpoint()
+        # if put is called here, the game object would get saved twice
+        # self.put()
+
+    def add_checkpoint(self):
+        """Checkpoint the board if the last move recorded is due one"""
+        moves = len(self.game_history)
+        if moves and moves % CHECKPOINT_EVERY == 0:
+            # assign a new list - the property default is shared
+            self.checkpoints = self.checkpoints + [
+                {'turn': moves,
+                 'removed': sorted(json.loads(self.card_graveyard)),
+                 'pairs': self.player_pairs()}]
+
+    def initial_board(self):
+        """Returns the card map the game started with"""
+        board = json.loads(self.card_map)
+        board.update(json.loads(self.card_graveyard))
+        return board
+
+    def board_at(self, turn):
+        """Returns (initial board, set of removed cells, pairs per player)
+        after the first turn moves of the game
+        Raises:
+            ValueError: if turn is outside the history."""
+        if not 0 <= turn <= len(self.game_history):
+            raise ValueError('Invalid turn. Valid values are 0 to {0}.'.format(
+                len(self.game_history)))
+        start = {'turn': 0, 'removed': [],
+                 'pairs': [0] * len(self.player_pairs())}
+        for checkpoint in self.checkpoints:
+            if checkpoint['turn'] > turn:
+                break
+            start = checkpoint
+        board = self.initial_board()
+        removed = set(start['removed'])
+        pairs = list(start['pairs'])
+        for move in self.game_history[start['turn']:turn]:
+            self._replay_move(board, removed, pairs, move)
+        return board, removed, pairs
+
+    def _replay_move(self, board, removed, pairs, move):
+        """Applies a recorded move to a replayed board. Returns True if the
+        move found a pair."""
+        turn, player, coord1, coord2, result = move
+        found = (coord1 != coord2 and
+                 coord1 not in removed and coord2 not in removed and
+                 board[coord1] == board[coord2])
+        if found:
+            removed.update([coord1, coord2])
+            pairs[player - self.FIRST_PLAYER] += 1
+        return found
+
+    def replay_errors(self):
+        """Re-simulates the whole game from the initial board and returns a
+        list of differences from the recorded results and checkpoints - empty
+        if everything agrees"""
+        errors = []
+        board = self.initial_board()
+        removed = set()
+        pairs = [0] * len(self.player_pairs())
+        checkpoints = dict((c['turn'], c) for c in self.checkpoints)
+        for number, move in enumerate(self.game_history, 1):
+            found = self._replay_move(board, removed, pairs, move)
+            if found != (move[4] == FOUND_PAIR):
+                errors.append('move {0}: recorded {1!r}'.format(number,
+                                                               move[4]))
+            checkpoint = checkpoints.pop(number, None)
+            if checkpoint and (set(checkpoint['removed']) != removed or
+                               checkpoint['pairs'] != pairs):
+                errors.append('move {0}: checkpoint differs'.format(number))
+        if checkpoints:
+            errors.append('checkpoints past the last move: {0}'.format(
+                sorted(checkpoints)))
+        if set(json.loads(self.card_graveyard)) != removed:
+            errors.append('removed cards differ from the replay')
+        if self.player_pairs() != pairs:
+            errors.append('pairs won {0}, replayed {1}'.format(
+                self.player_pairs(), pairs))
+        if self.turns != len(self.game_history):
+            errors.append('turns {0}, moves recorded {1}'.format(
+                self.turns, len(self.game_history)))
+        return errors
 
 
 """ Storage Classes """
@@ -27,10 +330,10 @@ class User(ndb.Model):
     """User profile"""
     name = ndb.StringProperty(required=True)
     email = ndb.StringProperty()
-    games = ndb.IntegerProperty(default=0)
-    wins = ndb.IntegerProperty(default=0)
-    ties = ndb.IntegerProperty(default=0)
-    losses = ndb.IntegerProperty(default=0)
+    games = ndb.IntegerProperty(default=0, indexed=False)
+    wins = ndb.IntegerProperty(default=0, indexed=False)
+    ties = ndb.IntegerProperty(default=0, indexed=False)
+    losses = ndb.IntegerProperty(default=0, indexed=False)
     user_ranking = ndb.FloatProperty(default=0.0)
 
     def update_user_ranking_info(self, result):
@@ -47,77 +350,109 @@ class User(ndb.Model):
                 self.wins += 1
             elif result == -1:
                 self.losses += 1
-            self.put()
             # calculate user ranking
             self.calculate_user_ranking()
 
     def calculate_user_ranking(self):
-        # calculate the users two player user ranking
-        if self.losses != 0:
+        # calculate the users two player user ranking - the caller puts the
+        # user, in the transaction that saves the score it came from
+        if self.losses == 0:
             self.user_ranking = (float(self.wins) / float(1)) * 100.0
         else:
             self.user_ranking = (float(self.wins) / float(self.losses)) * 100.0
-        self.put()
 
     def to_user_ranking_form(self):
         return UserRanking(user_name=self.name,
                            user_ranking=self.user_ranking)
 
 
-class GameP1(ndb.Model):
+NAME_BATCH = 30  # user names per IN query
+
+
+def users_by_name(user_names):
+    """Returns {name: User} for the users with the given names - one IN
+    query per NAME_BATCH names, run in parallel"""
+    futures = [User.query(User.name.IN(user_names[i:i + NAME_BATCH]))
+               .fetch_async()
+               for i in range(0, len(user_names), NAME_BATCH)]
+    return dict((user.name, user) for future in futures
+                for user in future.get_result())
+
+
+class GameP1(ReplayableGame, ndb.Model):
     """Single player game object"""
     user = ndb.KeyProperty(required=True, kind='User')
-    size = ndb.IntegerProperty(required=True)
-    card_pairs = ndb.IntegerProperty(required=True)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    card_pairs = ndb.IntegerProperty(required=True, indexed=False)
     card_map = ndb.JsonProperty(required=True)
     card_graveyard = ndb.JsonProperty(required=True)
-    pairs_won = ndb.IntegerProperty(required=True, default=0)
-    turns = ndb.IntegerProperty(required=True, default=0)
-    consec_turns = ndb.IntegerProperty(required=True, default=0)
-    consec_turns_temp = ndb.IntegerProperty(required=True, default=0)
+    pairs_won = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    turns = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    consec_turns = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    consec_turns_temp = ndb.IntegerProperty(required=True, default=0,
+                                            indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     game_history = ndb.PickleProperty(required=True, default=[])
+    # board checkpoints for replays (ReplayableGame)
+    checkpoints = ndb.JsonProperty(default=[])
+    # bumped on every saved move - used as the game state etag
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    last_move = ndb.DateTimeProperty(auto_now=True)
+    # moves are journalled in memcache and saved in batches (writebehind.py)
+    write_behind = ndb.BooleanProperty(default=False, indexed=False)
 
     @classmethod
-    def new_game(cls, user, size):
+    def new_game(cls, user, size, write_behind=False):
         """Creates and returns a new game"""
-        if size not in [2, 4, 8]:
-            raise ValueError('Invalid board size. Valid sizes are 2,4,8.')
         # Build a list of co-ordinate pairs
-        card_map = {}
-        card_pairs = ((size * size) / 2)  # 2,8,32 pairs
-        # create coord for all possible cells on board
-        coords = [(x, y) for x in range(size) for y in range(size)]
-        # shuffle the coords and randomly create matching pair
-        random.shuffle(coords)
-        for pair in range(card_pairs):
-            card_map[str(coords.pop())] = pair
-            card_map[str(coords.pop())] = pair
-        # save json with an array of coord: value pairs
-        card_map_json = json.dumps(card_map)
-        card_graveyard_json = json.dumps({})
+        card_map = new_card_map(size)
         # Create the game
         game = GameP1(user=user,
                       size=size,
-                      card_pairs=card_pairs,
-                      card_map=card_map_json,
-                      card_graveyard=card_graveyard_json)
-        game.put()
+                      card_pairs=len(card_map) / 2,  # 2,8,32 pairs
+                      card_map=json.dumps(card_map),
+                      card_graveyard=json.dumps({}),
+                      write_behind=write_behind)
+        storage.repository.put_multi([game])
         return game
 
-    def update_game_history(self, player, coord1, coord2, result):
-        """Add a move to the game history list"""
-        move = (self.turns, player, coord1, coord2, result)
-        self.game_history.append(move)
-        # if put is called here, the game object would get saved twice
-        # self.put()
+    def apply_move(self, selection1, selection2):
+        """Applies a move of two valid, different selections to the game
+        state without saving it. Returns the move result message."""
+        # convert card_map from json to dict
+        card_map_dict = json.loads(self.card_map)
+        graveyard_dict = json.loads(self.card_graveyard)
+        # check coord associated values match
+        if card_map_dict[selection1] == card_map_dict[selection2]:
+            msg = "Found a pair!!"
+            self.pairs_won += 1
+            self.consec_turns_temp += 1
+            if self.consec_turns_temp > self.consec_turns:
+                self.consec_turns = self.consec_turns_temp
+            # move the pair of coords to the 'graveyard'
+            for selection in [selection1, selection2]:
+                graveyard_dict[selection] = card_map_dict[selection]
+                del card_map_dict[selection]
+        else:
+            msg = "The pair doesn't match ..."
+            self.consec_turns_temp = 0
+        # update game state
+        self.turns += 1
+        self.version += 1
+        self.card_map = json.dumps(card_map_dict)
+        self.card_graveyard = json.dumps(graveyard_dict)
+        self.update_game_history(1, selection1, selection2, msg)
+        return msg
+
+    def player_pairs(self):
+        return [self.pairs_won]
 
     def to_form(self, message):
         """Returns a GameForm representation of the Game"""
         card_map_dict = json.loads(self.card_map)
         form = GameFormP1()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name = self.user.get().name
+        form.user_name = storage.repository.get(self.user).name
         form.size = self.size
         form.turns = self.turns
         form.game_over = self.game_over
@@ -127,99 +462,121 @@ class GameP1(ndb.Model):
             for key in card_map_dict.keys()]
         form.pairs_won = self.pairs_won
         form.consec_turns = self.consec_turns
+        form.version = self.version
+        form.etag = game_etag(self.version)
         return form
 
+    def turn_state(self):
+        """Small summary of the game version - published on every move"""
+        return {'version': self.version,
+                'current_turn': 1,
+                'game_over': self.game_over}
+
     def end_game(self, won=False):
         """Ends the game - if won is True, the player won. - if won is False,
         the player lost."""
+        save_game_results(self.end_game_entities(won=won))
+
+    def end_game_entities(self, won=False):
+        """Marks the game over and returns the game and its new score entities
+        unsaved, so several games can be ended together"""
         self.game_over = True
-        self.put()
         # Add the game to the score 'board'
-        score = ScoreP1(user=self.user,
+        score = ScoreP1(parent=self.user,
+                        user=self.user,
                         date=datetime.datetime.now(),
                         won=won,
                         turns=self.turns,
                         pairs=self.pairs_won,
                         size=self.size)
-        consec_turns = ConsecutiveTurns(user=self.user,
+        consec_turns = ConsecutiveTurns(parent=self.user,
+                                        user=self.user,
                                         turns=self.consec_turns,
                                         size=self.size)
-        score.put()
-        consec_turns.put()
+        return [self, score, consec_turns]
 
 
-class GameP2(ndb.Model):
+class GameP2(VersionedGame, ReplayableGame, ndb.Model):
     """Two player game object"""
     # player 1 variables
     user1 = ndb.KeyProperty(required=True, kind='User')
-    user1_turns = ndb.IntegerProperty(required=True, default=0)
-    user1_pairs = ndb.IntegerProperty(required=True, default=0)
-    user1_consec_turns = ndb.IntegerProperty(required=True, default=0)
-    user1_consec_temp = ndb.IntegerProperty(required=True, default=0)
+    user1_turns = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    user1_pairs = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    user1_consec_turns = ndb.IntegerProperty(required=True, default=0,
+                                             indexed=False)
+    user1_consec_temp = ndb.IntegerProperty(required=True, default=0,
+                                            indexed=False)
     # player 2 variables
     user2 = ndb.KeyProperty(required=True, kind='User')
-    user2_turns = ndb.IntegerProperty(required=True, default=0)
-    user2_pairs = ndb.IntegerProperty(required=True, default=0)
-    user2_consec_turns = ndb.IntegerProperty(required=True, default=0)
-    user2_consec_temp = ndb.IntegerProperty(required=True, default=0)
+    user2_turns = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    user2_pairs = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    user2_consec_turns = ndb.IntegerProperty(required=True, default=0,
+                                             indexed=False)
+    user2_consec_temp = ndb.IntegerProperty(required=True, default=0,
+                                            indexed=False)
     # game object variables
-    turns = ndb.IntegerProperty(required=True, default=0)
-    card_pairs = ndb.IntegerProperty(required=True)
+    turns = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    card_pairs = ndb.IntegerProperty(required=True, indexed=False)
     card_map = ndb.JsonProperty(required=True)
     card_graveyard = ndb.JsonProperty(required=True)
-    size = ndb.IntegerProperty(required=True)
-    current_turn = ndb.IntegerProperty(required=True)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    current_turn = ndb.IntegerProperty(required=True, indexed=False)
     game_over = ndb.BooleanProperty(required=True, default=False)
     game_history = ndb.PickleProperty(required=True, default=[])
+    # board checkpoints for replays (ReplayableGame)
+    checkpoints = ndb.JsonProperty(default=[])
+    # bumped on every saved move - used for compare-and-set saves
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    last_move = ndb.DateTimeProperty(auto_now=True)
+    # set when the game ends - 0 = tie (or cancelled), otherwise 1 || 2
+    winner = ndb.IntegerProperty(indexed=False)
+    # tournament bracket games (tournament.py)
+    tournament = ndb.KeyProperty(kind='Tournament', indexed=False)
+    tournament_match = ndb.KeyProperty(kind='TournamentMatch', indexed=False)
 
     @classmethod
     def new_game(cls, user1, user2, size):
         """Creates and returns a new game"""
-        if size not in [2, 4, 8]:
-            raise ValueError('Invalid board size. Valid sizes are 2,4,8.')
+        game = cls.build_game(user1, user2, size)
+        storage.repository.put_multi([game])
+        return game
+
+    @classmethod
+    def build_game(cls, user1, user2, size):
+        """Returns a new, unsaved game - so many games can be saved with one
+        put_multi"""
         # Build a list of co-ordinate pairs
-        card_map = {}
-        card_pairs = ((size * size) / 2)  # 2,8,32 pairs
-        # create coord for all possible cells on board
-        coords = [(x, y) for x in range(size) for y in range(size)]
-        # shuffle the coords and randomly create matching pair
-        random.shuffle(coords)
-        for pair in range(card_pairs):
-            card_map[str(coords.pop())] = pair
-            card_map[str(coords.pop())] = pair
-        # save json with an array of coord: value pairs
-        card_map_json = json.dumps(card_map)
-        card_graveyard_json = json.dumps({})
+        card_map = new_card_map(size)
         # Randomly choose which player goes first
         start_player = random.choice([1, 2])
-        game = GameP2(
+        return GameP2(
             user1=user1,
             user2=user2,
-            card_pairs=card_pairs,
-            card_map=card_map_json,
-            card_graveyard=card_graveyard_json,
+            card_pairs=len(card_map) / 2,
+            card_map=json.dumps(card_map),
+            card_graveyard=json.dumps({}),
             size=size,
             current_turn=start_player)
-        game.put()
-        return game
 
-    def update_game_history(self, player, coord1, coord2, result):
-        """Add a move to the game history list"""
-        move = (self.turns, player, coord1, coord2, result)
-        self.game_history.append(move)
-        # if put is called here, the game object would get saved twice
-        # self.put()
+    def player_pairs(self):
+        return [self.user1_pairs, self.user2_pairs]
+
+    def turn_state(self):
+        """Small summary of whose turn it is - published to turn waiters"""
+        return {'version': self.version,
+                'current_turn': self.current_turn,
+                'game_over': self.game_over}
 
     def to_form(self, message):
         """Returns a GameForm representation of the Game"""
         card_map_dict = json.loads(self.card_map)
         form = GameFormP2()
         form.urlsafe_key = self.key.urlsafe()
-        form.user_name1 = self.user1.get().name
+        form.user_name1 = storage.repository.get(self.user1).name
         form.user_name1_turns = self.user1_turns
         form.user_name1_pairs = self.user1_pairs
         form.user_name1_consec_turns = self.user1_consec_turns
-        form.user_name2 = self.user2.get().name
+        form.user_name2 = storage.repository.get(self.user2).name
         form.user_name2_turns = self.user2_turns
         form.user_name2_pairs = self.user2_pairs
         form.user_name2_consec_turns = self.user2_consec_turns
@@ -231,24 +588,36 @@ class GameP2(ndb.Model):
             for key in card_map_dict.keys()]
         form.game_over = self.game_over
         form.message = message
+        form.version = self.version
+        form.etag = game_etag(self.version)
         return form
 
-    def end_game(self, winner=0):
-        """Ends the game - winner 0 = tied game, otherwise winner = 1 || 2"""
+    def end_game(self, winner=0, ranked=False):
+        """Ends the game - winner 0 = tied game, otherwise winner = 1 || 2.
+        With ranked, the players' ranking stats are updated too"""
+        save_game_results(self.end_game_entities(winner=winner),
+                          ranked=ranked)
+
+    def end_game_entities(self, winner=0):
+        """Marks the game over and returns the game and its new score entities
+        unsaved, so several games can be ended together"""
         if winner not in [0, 1, 2]:
             raise ValueError(
                 'Invalid player selection number. Valid values are 0,1,2.')
         self.game_over = True
-        self.put()
+        self.winner = winner
+        entities = [self]
         # Add the game to the score 'board' for each player
-        score1 = ScoreP2(user=self.user1,
+        score1 = ScoreP2(parent=self.user1,
+                         user=self.user1,
                          date=datetime.datetime.now(),
                          won=False,
                          turns=self.user1_turns,
                          pairs=self.user1_pairs,
                          tie=False,
                          size=self.size)
-        score2 = ScoreP2(user=self.user2,
+        score2 = ScoreP2(parent=self.user2,
+                         user=self.user2,
                          date=datetime.datetime.now(),
                          won=False,
                          turns=self.user2_turns,
@@ -263,32 +632,227 @@ class GameP2(ndb.Model):
             score1.won = True
         if winner is 2:
             score2.won = True
-        score1.put()
-        score2.put()
+        entities.extend([score1, score2])
         # Record consecutive turn scores
         if self.user1_consec_turns > 0:
-            consec_turns1 = ConsecutiveTurns(user=self.user1,
+            consec_turns1 = ConsecutiveTurns(parent=self.user1,
+                                             user=self.user1,
                                              turns=self.user1_consec_turns,
                                              size=self.size)
-            consec_turns1.put()
+            entities.append(consec_turns1)
         if self.user2_consec_turns > 0:
-            consec_turns2 = ConsecutiveTurns(user=self.user2,
+            consec_turns2 = ConsecutiveTurns(parent=self.user2,
+                                             user=self.user2,
                                              turns=self.user2_consec_turns,
                                              size=self.size)
-            consec_turns2.put()
+            entities.append(consec_turns2)
+        return entities
+
+
+class GameMP(VersionedGame, ReplayableGame, ndb.Model):
+    """Multiplayer (2-8 players) game object. Per player counters are kept
+    in parallel lists indexed by seat - a player's position in users."""
+    users = ndb.KeyProperty(repeated=True, kind='User')
+    seat_turns = ndb.IntegerProperty(repeated=True, indexed=False)
+    seat_pairs = ndb.IntegerProperty(repeated=True, indexed=False)
+    seat_consec_turns = ndb.IntegerProperty(repeated=True, indexed=False)
+    seat_consec_temp = ndb.IntegerProperty(repeated=True, indexed=False)
+    # game object variables
+    turns = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    card_pairs = ndb.IntegerProperty(required=True, indexed=False)
+    card_map = ndb.JsonProperty(required=True)
+    card_graveyard = ndb.JsonProperty(required=True)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    current_seat = ndb.IntegerProperty(required=True, indexed=False)
+    game_over = ndb.BooleanProperty(required=True, default=False)
+    game_history = ndb.PickleProperty(required=True, default=[])
+    # board checkpoints for replays (ReplayableGame)
+    checkpoints = ndb.JsonProperty(default=[])
+    version = ndb.IntegerProperty(required=True, default=0, indexed=False)
+    last_move = ndb.DateTimeProperty(auto_now=True)
+
+    MIN_PLAYERS = 2
+    MAX_PLAYERS = 8
+    FIRST_PLAYER = 0  # the history records seats
+
+    @classmethod
+    def new_game(cls, users, size):
+        """Creates and returns a new game for a list of 2-8 user keys"""
+        if not cls.MIN_PLAYERS <= len(users) <= cls.MAX_PLAYERS:
+            raise ValueError('Invalid number of players. Valid values are '
+                             '2 to 8.')
+        card_map = new_card_map(size)
+        seats = len(users)
+        game = GameMP(users=users,
+                      seat_turns=[0] * seats,
+                      seat_pairs=[0] * seats,
+                      seat_consec_turns=[0] * seats,
+                      seat_consec_temp=[0] * seats,
+                      card_pairs=len(card_map) / 2,
+                      card_map=json.dumps(card_map),
+                      card_graveyard=json.dumps({}),
+                      size=size,
+                      current_seat=random.randrange(seats))
+        storage.repository.put_multi([game])
+        return game
+
+    def apply_move(self, seat, selection1, selection2):
+        """Applies a move of two valid, different selections by the player
+        in seat to the game state without saving it. Returns the move result
+        message."""
+        card_map_dict = json.loads(self.card_map)
+        graveyard_dict = json.loads(self.card_graveyard)
+        self.seat_turns[seat] += 1
+        if card_map_dict[selection1] == card_map_dict[selection2]:
+            # move the pair of coords to the 'graveyard'
+            for selection in [selection1, selection2]:
+                graveyard_dict[selection] = card_map_dict[selection]
+                del card_map_dict[selection]
+            msg = "Found a pair!!"
+            self.seat_pairs[seat] += 1
+            self.seat_consec_temp[seat] += 1
+            if self.seat_consec_temp[seat] > self.seat_consec_turns[seat]:
+                self.seat_consec_turns[seat] = self.seat_consec_temp[seat]
+            # the player takes another turn
+        else:
+            msg = "The pair doesn't match ..."
+            self.seat_consec_temp[seat] = 0
+            # next seat round the table takes the next turn
+            self.current_seat = (seat + 1) % len(self.users)
+        self.turns += 1
+        self.card_map = json.dumps(card_map_dict)
+        self.card_graveyard = json.dumps(graveyard_dict)
+        self.update_game_history(seat, selection1, selection2, msg)
+        return msg
+
+    def player_pairs(self):
+        return list(self.seat_pairs)
+
+    def seat_ranks(self):
+        """Returns the finishing rank of each seat - 1 + the number of seats
+        with more pairs, so tied seats share a rank"""
+        ordered = sorted(self.seat_pairs, reverse=True)
+        return [ordered.index(pairs) + 1 for pairs in self.seat_pairs]
+
+    def turn_state(self):
+        """Small summary of whose turn it is - published to turn waiters"""
+        return {'version': self.version,
+                'current_turn': self.current_seat,
+                'game_over': self.game_over}
+
+    def to_form(self, message):
+        """Returns a GameFormMP representation of the Game"""
+        card_map_dict = json.loads(self.card_map)
+        users = storage.repository.get_multi(self.users)
+        form = GameFormMP()
+        form.urlsafe_key = self.key.urlsafe()
+        form.players = [
+            PlayerStateForm(seat=seat,
+                            user_name=users[seat].name,
+                            turns=self.seat_turns[seat],
+                            pairs=self.seat_pairs[seat],
+                            consec_turns=self.seat_consec_turns[seat])
+            for seat in range(len(users))]
+        form.turns = self.turns
+        form.current_seat = self.current_seat
+        form.size = self.size
+        form.cards = [
+            json.dumps({key: card_map_dict[key]})
+            for key in card_map_dict.keys()]
+        form.game_over = self.game_over
+        form.message = message
+        form.version = self.version
+        form.etag = game_etag(self.version)
+        return form
+
+    def end_game(self, ranked=False):
+        """Ends the game - seats with the most pairs win. With ranked, the
+        players' ranking stats are updated too"""
+        save_game_results(self.end_game_entities(), ranked=ranked)
+
+    def end_game_entities(self):
+        """Marks the game over and returns the game and its new score entities
+        unsaved, so several games can be ended together"""
+        self.game_over = True
+        entities = [self]
+        ranks = self.seat_ranks()
+        tie = ranks.count(1) > 1
+        now = datetime.datetime.now()
+        for seat, user in enumerate(self.users):
+            entities.append(ScoreMP(parent=user,
+                                    user=user,
+                                    date=now,
+                                    won=ranks[seat] == 1 and not tie,
+                                    tie=tie and ranks[seat] == 1,
+                                    rank=ranks[seat],
+                                    players=len(self.users),
+                                    turns=self.seat_turns[seat],
+                                    pairs=self.seat_pairs[seat],
+                                    size=self.size))
+            if self.seat_consec_turns[seat] > 0:
+                entities.append(
+                    ConsecutiveTurns(parent=user,
+                                     user=user,
+                                     turns=self.seat_consec_turns[seat],
+                                     size=self.size))
+        return entities
+
+
+class MatchRequest(ndb.Model):
+    """A player waiting to be matched for a two player game. Keyed by the
+    user's key id, so a user only has one request at a time."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    rating = ndb.FloatProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True)
+    # rating bucket - the matcher reads waiting players in bucket order
+    bucket = ndb.IntegerProperty(required=True)
+    matched = ndb.BooleanProperty(required=True, default=False)
+    game = ndb.KeyProperty(kind='GameP2', indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    def to_form(self, user_name):
+        return MatchStatusForm(
+            user_name=user_name,
+            size=self.size,
+            matched=self.matched,
+            urlsafe_game_key=self.game.urlsafe() if self.game else None)
+
+
+class ReplayCheckpoint(ndb.Model):
+    """How far the weekly replay verification has got for a game kind -
+    games that ended (last_move) up to verified_until have been replayed.
+    Keyed by the game kind name."""
+    verified_until = ndb.DateTimeProperty(required=True, indexed=False)
+
+
+# Scores are saved under their user's key - one entity group per user - so a
+# user's score history is a strongly consistent ancestor query. Scores saved
+# before that are root entities until /tasks/migrate_scores moves them; set
+# LEGACY_SCORES to False once it has run.
+LEGACY_SCORES = True
+
+
+def merge_legacy_scores(scores, legacy):
+    """Returns a user's scores (from an ancestor query) plus the root scores
+    among legacy (from a user filter) not moved under the user yet. A score
+    caught mid-move keeps its id, so it is only listed once."""
+    moved = set((score.key.kind(), score.key.id()) for score in scores)
+    return scores + [score for score in legacy
+                     if score.key.parent() is None and
+                     (score.key.kind(), score.key.id()) not in moved]
 
 
 class ScoreP1(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
-    date = ndb.DateTimeProperty(required=True)
+    date = ndb.DateTimeProperty(required=True, indexed=False)
     won = ndb.BooleanProperty(required=True)
     turns = ndb.IntegerProperty(required=True)
-    pairs = ndb.IntegerProperty(required=True)
-    size = ndb.IntegerProperty(required=True)
+    pairs = ndb.IntegerProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True, indexed=False)
 
     def to_form(self):
-        return ScoreFormP1(user_name=self.user.get().name,
+        return ScoreFormP1(user_name=storage.repository.get(self.user).name,
                            date=str(self.date),
                            won=self.won,
                            turns=self.turns,
@@ -300,14 +864,14 @@ class ScoreP2(ndb.Model):
     """Score object"""
     user = ndb.KeyProperty(required=True, kind='User')
     date = ndb.DateTimeProperty(required=True)
-    won = ndb.BooleanProperty(required=True)
-    turns = ndb.IntegerProperty(required=True)
+    won = ndb.BooleanProperty(required=True, indexed=False)
+    turns = ndb.IntegerProperty(required=True, indexed=False)
     pairs = ndb.IntegerProperty(required=True)
-    tie = ndb.BooleanProperty(required=True)
-    size = ndb.IntegerProperty(required=True)
+    tie = ndb.BooleanProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True, indexed=False)
 
     def to_form(self):
-        return ScoreFormP2(user_name=self.user.get().name,
+        return ScoreFormP2(user_name=storage.repository.get(self.user).name,
                            date=str(self.date),
                            won=self.won,
                            turns=self.turns,
@@ -316,13 +880,44 @@ class ScoreP2(ndb.Model):
                            size=self.size)
 
 
+class ScoreMP(ndb.Model):
+    """Multiplayer score object - one per player per game. Like ScoreP2, a
+    tie is won=False, tie=True - only a sole top seat wins."""
+    user = ndb.KeyProperty(required=True, kind='User')
+    date = ndb.DateTimeProperty(required=True, indexed=False)
+    won = ndb.BooleanProperty(required=True, indexed=False)
+    tie = ndb.BooleanProperty(required=True, indexed=False)
+    rank = ndb.IntegerProperty(required=True, indexed=False)
+    players = ndb.IntegerProperty(required=True, indexed=False)
+    turns = ndb.IntegerProperty(required=True, indexed=False)
+    pairs = ndb.IntegerProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+
+    def to_form(self):
+        return ScoreFormMP(user_name=storage.repository.get(self.user).name,
+                           date=str(self.date),
+                           won=self.won,
+                           tie=self.tie,
+                           rank=self.rank,
+                           players=self.players,
+                           turns=self.turns,
+                           pairs=self.pairs,
+                           size=self.size)
+
+
 class ConsecutiveTurns(ndb.Model):
     """Consecutive turns bonus score object"""
     user = ndb.KeyProperty(required=True, kind='User')
     turns = ndb.IntegerProperty(required=True)
     size = ndb.IntegerProperty(required=True)
+    # when the game ended - None for scores saved before it was recorded
+    date = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
 
     def to_form(self):
-        return ConsecutiveTurnsForm(user_name=self.user.get().name,
-                                    turns=self.turns,
-                                    board_size=self.size)
+        return ConsecutiveTurnsForm(
+            user_name=storage.repository.get(self.user).name,
+            turns=self.turns,
+            board_size=self.size)
+
+
+SCORE_KINDS = [ScoreP1, ScoreP2, ScoreMP, ConsecutiveTurns]
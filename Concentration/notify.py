@@ -0,0 +1,113 @@
+"""notify.py - Turn notifications for games. Every saved move publishes a
+small turn state (version, current_turn, game_over) keyed by the urlsafe game
+key, so clients waiting for their turn, or checking if a game has changed, are
+served from memcache without reading the game from the datastore.
+
+A publish never replaces a newer state - a slow publish that lost a race with
+a later move (or a cancel) is dropped, so the published version only goes
+forward. States expire after TURN_STATE_TTL, and a publish that can't be
+stored drops the state. If a publish is missed (the instance died after
+saving the move, or memcache kept failing) the stale state is served for
+at most TURN_STATE_TTL - then a read of the game from the datastore
+re-publishes it."""
+
+import logging
+import threading
+import time
+from google.appengine.api import memcache
+
+POLL_INTERVAL = 0.5  # seconds between memcache checks while waiting
+MAX_WAIT = 30  # seconds - keeps a wait well inside the request deadline
+CAS_RETRIES = 5  # compare-and-set attempts per publish
+TURN_STATE_TTL = 60  # seconds - the longest a missed publish goes unseen
+
+
+def is_newer(state, stored):
+    """True if state is later than stored - a higher version, or the same
+    version once the game is over (the last move ends the game without a new
+    version)"""
+    return ((state['version'], state['game_over']) >
+            (stored['version'], stored['game_over']))
+
+
+class MemcacheTurnNotifier(object):
+    """Turn states kept in memcache - shared by all instances"""
+    prefix = 'turn:'
+
+    def publish(self, urlsafe_game_key, state):
+        """Store the turn state for a game unless a newer one is stored -
+        compare-and-set, so concurrent publishes can't move it backwards"""
+        client = memcache.Client()
+        key = self.prefix + urlsafe_game_key
+        for _ in range(CAS_RETRIES):
+            stored = client.gets(key)
+            if stored is None:
+                if client.add(key, state, time=TURN_STATE_TTL):
+                    return
+            elif not is_newer(state, stored):
+                return
+            elif client.cas(key, state, time=TURN_STATE_TTL):
+                return
+        # readers fall back to the datastore rather than a stale state
+        client.delete(key)
+        logging.warning('Turn state of %s not published after %d attempts',
+                        urlsafe_game_key, CAS_RETRIES)
+
+    def current(self, urlsafe_game_key):
+        """Returns the latest turn state or None if it isn't cached"""
+        return memcache.get(self.prefix + urlsafe_game_key)
+
+    def wait(self, urlsafe_game_key, since, timeout):
+        """Block until the game version is greater than since, or until the
+        timeout (seconds) runs out. Returns the last turn state seen, which is
+        None if nothing was ever published for the game."""
+        deadline = time.time() + timeout
+        while True:
+            state = self.current(urlsafe_game_key)
+            if state is not None and state['version'] > since:
+                return state
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return state
+            time.sleep(min(POLL_INTERVAL, remaining))
+
+
+class LocalTurnNotifier(object):
+    """In-process stand-in for MemcacheTurnNotifier for local runs and tests.
+    Waiting threads are woken by publish instead of polling."""
+
+    def __init__(self):
+        self._states = {}
+        self._changed = threading.Condition()
+
+    def publish(self, urlsafe_game_key, state):
+        """Store the turn state for a game unless a newer one is stored,
+        and wake any waiters"""
+        with self._changed:
+            stored = self._states.get(urlsafe_game_key)
+            if stored is not None and not is_newer(state, stored):
+                return
+            self._states[urlsafe_game_key] = state
+            self._changed.notify_all()
+
+    def current(self, urlsafe_game_key):
+        """Returns the latest turn state or None if it was never published"""
+        with self._changed:
+            return self._states.get(urlsafe_game_key)
+
+    def wait(self, urlsafe_game_key, since, timeout):
+        """Same contract as MemcacheTurnNotifier.wait"""
+        deadline = time.time() + timeout
+        with self._changed:
+            while True:
+                state = self._states.get(urlsafe_game_key)
+                if state is not None and state['version'] > since:
+                    return state
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return state
+                self._changed.wait(remaining)
+
+
+# swap for a LocalTurnNotifier to run without the App Engine services
+turn_notifier = MemcacheTurnNotifier()
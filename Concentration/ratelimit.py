@@ -0,0 +1,109 @@
+"""ratelimit.py - Per user, per client and per game rate limits for endpoint
+methods.
+
+Each limited method has a budget of calls per period for each scope in
+RATE_LIMITS - 'user' counts calls by request.user_name, 'game' by
+request.urlsafe_game_key and 'client' by the caller's remote address (the
+budget for methods whose requests don't name a user). Calls are counted in
+memcache with atomic increments, one counter per scope and fixed window. The
+bucket level is the current window's count plus the previous window's count
+weighted by how much of it still overlaps the last period - a sliding
+approximation of a token bucket that refills at limit / period calls a
+second and holds at most limit tokens. It needs no read-modify-write, so
+concurrent calls never lose a count. A rejected call takes its counts back
+out, so a client retrying while throttled doesn't keep its own bucket full.
+
+Throttled calls raise TooManyRequestsException (HTTP 429) before the method
+runs, so they cost no datastore access. If memcache is unavailable calls are
+let through."""
+
+import functools
+import time
+import endpoints
+from google.appengine.api import memcache
+
+# method name -> {scope: (calls, period in seconds)}
+RATE_LIMITS = {
+    'make_move_p1': {'client': (120, 60), 'game': (60, 60)},
+    'make_move_p2': {'user': (60, 60), 'game': (60, 60)},
+    'make_move_mp': {'user': (60, 60), 'game': (120, 60)},
+    'get_game_p1': {'client': (240, 60), 'game': (120, 60)},
+    'get_game_p2': {'client': (240, 60), 'game': (120, 60)},
+    'get_game_mp': {'client': (240, 60), 'game': (120, 60)},
+    'wait_for_turn_p2': {'client': (30, 60), 'game': (60, 60)},
+}
+
+# scope -> request field the calls are counted by ('client' is counted by
+# remote address)
+SCOPE_FIELDS = {'user': 'user_name', 'game': 'urlsafe_game_key'}
+
+
+class TooManyRequestsException(endpoints.ServiceException):
+    """Rate limit exceeded"""
+    http_status = 429
+
+
+def _counter_key(method_name, scope, value, period, window):
+    return 'rate:{0}:{1}:{2}:{3}:{4}'.format(
+        method_name, scope, value, period, window)
+
+
+def take(method_name, request, now=None, remote_address=None):
+    """Count a call to method_name against each of its scopes. Returns the
+    name of the first scope whose budget is used up, or None if the call is
+    allowed"""
+    limits = RATE_LIMITS.get(method_name)
+    if not limits:
+        return None
+    now = time.time() if now is None else now
+    # current window counter key -> (scope, previous window counter key,
+    # calls, fraction of the previous window inside the last period)
+    buckets = {}
+    for scope, (calls, period) in limits.items():
+        if scope == 'client':
+            value = remote_address
+        else:
+            value = getattr(request, SCOPE_FIELDS[scope], None)
+        if not value:
+            continue
+        window = int(now // period)
+        key = _counter_key(method_name, scope, value, period, window)
+        previous = _counter_key(method_name, scope, value, period, window - 1)
+        overlap = 1.0 - (now - window * period) / period
+        buckets[key] = (scope, previous, calls, overlap)
+    if not buckets:
+        return None
+    # counters outlive their window by a period, for the overlap
+    expiry = 2 * max(period for _, period in limits.values())
+    client = memcache.Client()
+    add_rpc = client.add_multi_async(dict.fromkeys(buckets, 0), time=expiry)
+    previous_rpc = client.get_multi_async(
+        [previous for _, previous, _, _ in buckets.values()])
+    add_rpc.get_result()
+    counts = client.offset_multi(dict.fromkeys(buckets, 1))
+    previous_counts = previous_rpc.get_result()
+    for key, (scope, previous, calls, overlap) in sorted(buckets.items()):
+        count = counts.get(key)
+        if count is None:
+            continue  # memcache unavailable - fail open
+        if count + previous_counts.get(previous, 0) * overlap > calls:
+            # the call isn't made - only admitted calls stay counted
+            client.offset_multi(dict.fromkeys(counts, -1))
+            return scope
+    return None
+
+
+def rate_limited(method):
+    """Decorator for ConcentrationGameApi methods - place it below
+    @endpoints.method. Limits come from RATE_LIMITS[method name]."""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        request_state = getattr(self, 'request_state', None)
+        scope = take(method.__name__, request,
+                     remote_address=getattr(request_state, 'remote_address',
+                                            None))
+        if scope:
+            raise TooManyRequestsException(
+                'Too many requests for this {0}, slow down!'.format(scope))
+        return method(self, request)
+    return wrapper
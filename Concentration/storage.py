@@ -0,0 +1,322 @@
+"""storage.py - Storage backends behind a small repository interface.
+
+The endpoints and the game logic persist games, scores and users through
+storage.repository instead of calling ndb directly - with batched primitives
+(get_multi, put_multi, delete_multi and a simple query), transactions (the
+compare-and-set saves of moves, ending games) and tasks queued with a
+transaction. So the game logic can run against:
+
+    NdbRepository: the datastore through ndb - the default.
+    MemoryRepository: in-process dict store, for local simulations.
+    SqliteRepository: in-process SQLite store, for local simulations that
+        need more data than fits in memory or persist between runs.
+
+Entities are the ndb model instances from models.py in every backend - the
+in-process backends store them as entity protobufs, exactly as the datastore
+would, and need no App Engine stubs. Their transactions run one at a time
+and apply their writes on commit; queued tasks are kept in the repository's
+tasks list for the simulation to run or drop. Matchmaking, tournaments and
+the leaderboard and stats rollups (run by tasks) stay on ndb.
+
+Queries take filters as (property name, operator, value) tuples with the
+operators in FILTER_OPS, an order list of property names (prefix '-' for
+descending) and optionally an ancestor key, which limits them to that
+entity group (strongly consistent on the datastore). Swap backends with
+storage.use(MemoryRepository())."""
+
+import itertools
+import operator
+import threading
+from google.appengine.api import taskqueue
+from google.appengine.datastore import entity_pb
+from google.appengine.ext import ndb
+
+FILTER_OPS = {'=': operator.eq,
+              '!=': operator.ne,
+              '<': operator.lt,
+              '<=': operator.le,
+              '>': operator.gt,
+              '>=': operator.ge}
+
+
+class Repository(object):
+    """Batched storage primitives"""
+
+    def get(self, key):
+        """Returns the entity for key or None"""
+        return self.get_multi([key])[0]
+
+    def get_multi(self, keys):
+        """Returns a list of entities (None where missing) in key order"""
+        raise NotImplementedError
+
+    def put_multi(self, entities):
+        """Saves entities, assigning keys where missing. Returns the keys."""
+        raise NotImplementedError
+
+    def delete_multi(self, keys):
+        raise NotImplementedError
+
+    def query(self, model, filters=(), order=(), limit=None, ancestor=None):
+        """Returns a list of model entities matching every filter, below
+        ancestor if given"""
+        raise NotImplementedError
+
+    def query_one(self, model, filters=(), order=()):
+        """Returns the first matching entity or None"""
+        results = self.query(model, filters, order, limit=1)
+        return results[0] if results else None
+
+    def transaction(self, func, retries=3):
+        """Runs func in a transaction (which may span entity groups) and
+        returns its result. func may be run again, up to retries times, if
+        the transaction collides with another.
+        Raises:
+            datastore_errors.TransactionFailedError: if it still collides."""
+        raise NotImplementedError
+
+    def queue_task(self, url, params):
+        """Queue a POST task - with the current transaction, if any, so it
+        is only queued if the transaction commits"""
+        raise NotImplementedError
+
+
+class NdbRepository(Repository):
+    """The datastore, through ndb"""
+
+    def get_multi(self, keys):
+        return ndb.get_multi(keys)
+
+    def put_multi(self, entities):
+        return ndb.put_multi(entities)
+
+    def delete_multi(self, keys):
+        ndb.delete_multi(keys)
+
+    def transaction(self, func, retries=3):
+        return ndb.transaction(func, retries=retries, xg=True)
+
+    def queue_task(self, url, params):
+        taskqueue.add(url=url, params=params,
+                      transactional=ndb.in_transaction())
+
+    def query(self, model, filters=(), order=(), limit=None, ancestor=None):
+        query = model.query(ancestor=ancestor)
+        for name, op, value in filters:
+            query = query.filter(FILTER_OPS[op](model._properties[name],
+                                                value))
+        for name in order:
+            if name.startswith('-'):
+                query = query.order(-model._properties[name[1:]])
+            else:
+                query = query.order(model._properties[name])
+        return query.fetch(limit)
+
+
+class _InProcessRepository(Repository):
+    """Shared parts of the in-process backends - entities are stored as
+    encoded entity protobufs and filtered / sorted in Python. Transactions
+    hold the store's lock, so they run one at a time, and buffer their
+    writes and tasks until they commit."""
+
+    def __init__(self):
+        self._adapter = ndb.ModelAdapter()
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self.tasks = []  # (url, params) of the queued tasks
+
+    def _pending(self):
+        """The current transaction's [(writes, deletes, tasks)], or None"""
+        return getattr(self._local, 'pending', None)
+
+    def put_multi(self, entities):
+        with self._lock:
+            keys = []
+            for entity in entities:
+                entity._prepare_for_put()  # auto_now properties
+                keys.append(self._assign_key(entity))
+            writes = [(key, self._encode(entity))
+                      for key, entity in zip(keys, entities)]
+            pending = self._pending()
+            if pending is not None:
+                pending[0].extend(writes)
+            else:
+                self._write(writes, [])
+            return keys
+
+    def delete_multi(self, keys):
+        with self._lock:
+            pending = self._pending()
+            if pending is not None:
+                pending[1].extend(keys)
+            else:
+                self._write([], keys)
+
+    def transaction(self, func, retries=3):
+        with self._lock:
+            if self._pending() is not None:
+                return func()  # nested - part of the outer transaction
+            self._local.pending = ([], [], [])
+            try:
+                result = func()
+                writes, deletes, tasks = self._local.pending
+            finally:
+                self._local.pending = None
+            self._write(writes, deletes)
+            self.tasks.extend(tasks)
+            return result
+
+    def queue_task(self, url, params):
+        with self._lock:
+            pending = self._pending()
+            (pending[2] if pending is not None else self.tasks).append(
+                (url, params))
+
+    def _write(self, writes, deletes):
+        """Store [(key, encoded entity)] and delete keys - call holding the
+        lock"""
+        raise NotImplementedError
+
+    def _encode(self, entity):
+        return self._adapter.entity_to_pb(entity).Encode()
+
+    def _decode(self, encoded):
+        if encoded is None:
+            return None
+        return self._adapter.pb_to_entity(entity_pb.EntityProto(encoded))
+
+    def _assign_key(self, entity):
+        if entity.key is None or entity.key.id() is None:
+            kind = entity._get_kind()
+            parent = entity.key.parent() if entity.key else None
+            entity.key = ndb.Key(kind, self._allocate_id(kind), parent=parent)
+        return entity.key
+
+    def _allocate_id(self, kind):
+        raise NotImplementedError
+
+    def _entities_of_kind(self, kind):
+        raise NotImplementedError
+
+    def query(self, model, filters=(), order=(), limit=None, ancestor=None):
+        results = []
+        for entity in self._entities_of_kind(model._get_kind()):
+            if ancestor is not None and not _has_ancestor(entity.key,
+                                                          ancestor):
+                continue
+            if all(_matches(entity, name, op, value)
+                   for name, op, value in filters):
+                results.append(entity)
+        # sort by the last order property first - python sorts are stable
+        for name in reversed(list(order)):
+            descending = name.startswith('-')
+            results.sort(key=operator.attrgetter(name.lstrip('-')),
+                         reverse=descending)
+        return results[:limit] if limit is not None else results
+
+
+def _has_ancestor(key, ancestor):
+    """An ancestor query includes the ancestor itself, like the datastore"""
+    while key is not None:
+        if key == ancestor:
+            return True
+        key = key.parent()
+    return False
+
+
+def _matches(entity, name, op, value):
+    """A filter matches a repeated property if it matches any of its values,
+    like a datastore filter"""
+    stored = getattr(entity, name)
+    if isinstance(stored, list):
+        return any(FILTER_OPS[op](item, value) for item in stored)
+    return FILTER_OPS[op](stored, value)
+
+
+class MemoryRepository(_InProcessRepository):
+    """In-process dict store"""
+
+    def __init__(self):
+        super(MemoryRepository, self).__init__()
+        self._entities = {}  # kind -> {key: encoded pb}
+        self._ids = itertools.count(1)
+
+    def _allocate_id(self, kind):
+        return next(self._ids)
+
+    def get_multi(self, keys):
+        with self._lock:
+            return [self._decode(self._entities.get(key.kind(), {}).get(key))
+                    for key in keys]
+
+    def _write(self, writes, deletes):
+        for key, encoded in writes:
+            self._entities.setdefault(key.kind(), {})[key] = encoded
+        for key in deletes:
+            self._entities.get(key.kind(), {}).pop(key, None)
+
+    def _entities_of_kind(self, kind):
+        with self._lock:
+            encoded = list(self._entities.get(kind, {}).values())
+        return [self._decode(pb) for pb in encoded]
+
+
+class SqliteRepository(_InProcessRepository):
+    """In-process SQLite store - a single table of encoded entities keyed by
+    the serialized ndb key. Pass a file name to keep the data between runs."""
+
+    def __init__(self, database=':memory:'):
+        super(SqliteRepository, self).__init__()
+        # imported here - only simulations need it, not the app's startup
+        import sqlite3
+        self._sqlite3 = sqlite3
+        self._db = sqlite3.connect(database, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS entities ('
+                         'key BLOB PRIMARY KEY, kind TEXT, pb BLOB)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS entities_kind '
+                         'ON entities (kind)')
+        self._db.execute('CREATE TABLE IF NOT EXISTS ids ('
+                         'id INTEGER PRIMARY KEY AUTOINCREMENT)')
+
+    def _allocate_id(self, kind):
+        return self._db.execute('INSERT INTO ids DEFAULT VALUES').lastrowid
+
+    def get_multi(self, keys):
+        binary = self._sqlite3.Binary
+        serialized = [binary(key.serialized()) for key in keys]
+        with self._lock:
+            found = {}
+            for start in range(0, len(serialized), 500):
+                batch = serialized[start:start + 500]
+                rows = self._db.execute(
+                    'SELECT key, pb FROM entities WHERE key IN ({0})'.format(
+                        ','.join('?' * len(batch))), batch)
+                found.update((bytes(key), bytes(pb)) for key, pb in rows)
+        return [self._decode(found.get(bytes(key))) for key in serialized]
+
+    def _write(self, writes, deletes):
+        binary = self._sqlite3.Binary
+        self._db.executemany(
+            'INSERT OR REPLACE INTO entities (key, kind, pb) '
+            'VALUES (?, ?, ?)',
+            [(binary(key.serialized()), key.kind(), binary(encoded))
+             for key, encoded in writes])
+        self._db.executemany(
+            'DELETE FROM entities WHERE key = ?',
+            [(binary(key.serialized()),) for key in deletes])
+        self._db.commit()
+
+    def _entities_of_kind(self, kind):
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT pb FROM entities WHERE kind = ?', (kind,)).fetchall()
+        return [self._decode(bytes(pb)) for pb, in rows]
+
+
+repository = NdbRepository()
+
+
+def use(new_repository):
+    """Switch the backend the endpoints and the game logic use"""
+    global repository
+    repository = new_repository
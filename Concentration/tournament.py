@@ -0,0 +1,259 @@
+"""tournament.py - Single elimination tournaments of two player games.
+
+A Tournament keeps its entrants, and each match of the bracket is a
+TournamentMatch entity with a key built from its position, so the
+standings are a single get_multi. Creating one loads the entrants with
+batched queries and saves every first round GameP2, the matches and the
+tournament with one put_multi (game keys are allocated up front so the
+matches can point at them). When a tournament game ends, save_game_results
+queues an advance task that moves the winner into their next match in a
+transaction over just those two matches, creating the next match's game as
+soon as both players are known."""
+
+from google.appengine.ext import ndb
+from models import User, GameP2, users_by_name
+from messages import TournamentForm, TournamentRoundForm, TournamentMatchForm
+
+
+class Tournament(ndb.Model):
+    """Tournament. entrants is [[user key id, user name], ...] in seed order.
+    The bracket is kept in TournamentMatch entities, so results of different
+    matches are saved in parallel - the tournament itself is only written
+    when it's created and when the final ends."""
+    name = ndb.StringProperty(required=True, indexed=False)
+    size = ndb.IntegerProperty(required=True, indexed=False)
+    entrants = ndb.JsonProperty(required=True)
+    champion = ndb.IntegerProperty(indexed=False)  # seed of the winner
+    status = ndb.StringProperty(default='running', indexed=False)
+    created = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+    def _name(self, seed):
+        return self.entrants[seed][1] if seed is not None else None
+
+    def match_key(self, round_number, match_number):
+        """Returns the key of a match of the bracket"""
+        return ndb.Key(TournamentMatch, '{0}-{1}-{2}'.format(
+            self.key.id(), round_number, match_number))
+
+    def get_bracket(self):
+        """Returns the bracket - a list of rounds, each a list of
+        TournamentMatch - with one get_multi"""
+        counts = _match_counts(len(self.entrants))
+        keys = [self.match_key(round_number, match_number)
+                for round_number, matches in enumerate(counts)
+                for match_number in range(matches)]
+        loaded = iter(ndb.get_multi(keys))
+        return [[next(loaded) for _ in range(matches)] for matches in counts]
+
+    def to_form(self, message, bracket=None):
+        """Returns a TournamentForm representation of the Tournament -
+        bracket is loaded if it isn't passed"""
+        if bracket is None:
+            bracket = self.get_bracket()
+        form = TournamentForm(urlsafe_key=self.key.urlsafe(),
+                              name=self.name,
+                              size=self.size,
+                              status=self.status,
+                              current_round=current_round(bracket),
+                              champion=self._name(self.champion),
+                              message=message)
+        for number, matches in enumerate(bracket):
+            form.rounds.append(TournamentRoundForm(
+                round=number,
+                matches=[TournamentMatchForm(
+                    player1=self._name(match.players[0]),
+                    player2=self._name(match.players[1]),
+                    urlsafe_game_key=match.game,
+                    winner=self._name(match.winner))
+                    for match in matches]))
+        return form
+
+
+class TournamentMatch(ndb.Model):
+    """A match of a tournament bracket, in an entity group of its own. players
+    is [seed, seed] - seeds index the tournament's entrants, None is a slot
+    not filled yet (or a first round bye). Match m of a round feeds slot
+    m % 2 of match m / 2 of the next."""
+    tournament = ndb.KeyProperty(required=True, kind=Tournament,
+                                 indexed=False)
+    round_number = ndb.IntegerProperty(required=True, indexed=False)
+    match_number = ndb.IntegerProperty(required=True, indexed=False)
+    players = ndb.JsonProperty(required=True)
+    game = ndb.StringProperty(indexed=False)  # urlsafe game key
+    winner = ndb.IntegerProperty(indexed=False)  # seed of the winner
+
+
+def current_round(bracket):
+    """Returns the first round with a match still to finish (the final if
+    every match has finished)"""
+    for number, matches in enumerate(bracket):
+        if any(match.winner is None for match in matches):
+            return number
+    return len(bracket) - 1
+
+
+def _match_counts(entrants):
+    """Returns the number of matches in each round for a number of
+    entrants"""
+    slots = 2
+    while slots < entrants:
+        slots *= 2
+    counts = []
+    while slots > 1:
+        slots /= 2
+        counts.append(slots)
+    return counts
+
+
+def _seed_order(slots):
+    """Returns the seeds 0 to slots - 1 in standard bracket order - read in
+    pairs, seed i meets seed slots - 1 - i in the first round, and seeds 0
+    and 1 can only meet in the final (0 to 3 in the semi finals, ...)"""
+    order = [0]
+    while len(order) < slots:
+        order = [seed for top in order
+                 for seed in (top, 2 * len(order) - 1 - top)]
+    return order
+
+
+def build_bracket(entrants):
+    """Returns an empty bracket for a number of entrants, seeded in
+    standard order. Seeds past the last entrant are byes, so the byes go to
+    the top seeds."""
+    slots = 2
+    while slots < entrants:
+        slots *= 2
+    order = [seed if seed < entrants else None for seed in _seed_order(slots)]
+    bracket = [[{'players': order[number:number + 2],
+                 'game': None,
+                 'winner': None}
+                for number in range(0, slots, 2)]]
+    matches = slots / 2
+    while matches > 1:
+        matches /= 2
+        bracket.append([{'players': [None, None], 'game': None,
+                         'winner': None} for _ in range(matches)])
+    return bracket
+
+
+def _set_winner(match, seed, next_match):
+    """Records a match winner and moves them into next_match (None for the
+    final). Returns whether next_match now has both players."""
+    match.winner = seed
+    if next_match is None:
+        return False
+    next_match.players[match.match_number % 2] = seed
+    return None not in next_match.players
+
+
+def _build_games(tournament, matches):
+    """Returns unsaved games, with keys, for matches and points the matches
+    at them"""
+    if not matches:
+        return []
+    first, _ = GameP2.allocate_ids(len(matches))
+    games = []
+    for offset, match in enumerate(matches):
+        user1, user2 = [ndb.Key(User, tournament.entrants[seed][0])
+                        for seed in match.players]
+        game = GameP2.build_game(user1, user2, tournament.size)
+        game.key = ndb.Key(GameP2, first + offset)
+        game.tournament = tournament.key
+        game.tournament_match = match.key
+        match.game = game.key.urlsafe()
+        games.append(game)
+    return games
+
+
+def create_tournament(name, user_names, size):
+    """Creates a tournament and its first round games. Returns the
+    tournament.
+    Raises:
+        ValueError: for an invalid board size or fewer than two different
+            players.
+        LookupError: if a user doesn't exist."""
+    if size not in [2, 4, 8]:
+        raise ValueError('Invalid board size. Valid sizes are 2,4,8.')
+    if len(user_names) < 2 or len(set(user_names)) != len(user_names):
+        raise ValueError('A tournament needs two or more different players.')
+    users = users_by_name(user_names)
+    missing = [user_name for user_name in user_names
+               if user_name not in users]
+    if missing:
+        raise LookupError('Users not found: {0}'.format(', '.join(missing)))
+    first, _ = Tournament.allocate_ids(1)
+    tournament = Tournament(
+        id=first,
+        name=name,
+        size=size,
+        entrants=[[users[user_name].key.id(), user_name]
+                  for user_name in user_names])
+    bracket = [[TournamentMatch(key=tournament.match_key(round_number,
+                                                         match_number),
+                                tournament=tournament.key,
+                                round_number=round_number,
+                                match_number=match_number,
+                                players=match['players'])
+                for match_number, match in enumerate(matches)]
+               for round_number, matches in enumerate(
+                   build_bracket(len(user_names)))]
+    ready = []
+    for match in bracket[0]:
+        if match.players[1] is None:
+            next_match = bracket[1][match.match_number / 2]
+            if _set_winner(match, match.players[0], next_match):
+                ready.append(next_match)
+        else:
+            ready.append(match)
+    games = _build_games(tournament, ready)
+    # turn state isn't published for the new games - get_game_p2 publishes
+    # it the first time each game is read
+    ndb.put_multi(games + [tournament] +
+                  [match for matches in bracket for match in matches])
+    return tournament
+
+
+def _match_winner(game, players):
+    """Returns the seed that wins a finished game. A tie (or a cancelled
+    game) goes to the player with more pairs, then the longer consecutive
+    run, then the higher seed."""
+    if game.winner in [1, 2]:
+        return players[game.winner - 1]
+    ranks = [(game.user1_pairs, game.user1_consec_turns, -players[0]),
+             (game.user2_pairs, game.user2_consec_turns, -players[1])]
+    return players[0] if ranks[0] > ranks[1] else players[1]
+
+
+def advance(urlsafe_game_key):
+    """Moves the winner of an ended tournament game into their next match,
+    creating its game if the opponent is already known. Does nothing if the
+    game was already advanced. Only the game's match and the next one are
+    written (and the tournament, when the final ends), so matches in
+    different parts of the bracket don't contend."""
+    game = ndb.Key(urlsafe=urlsafe_game_key).get()
+    if game is None or not game.tournament_match or not game.game_over:
+        return
+    tournament = game.tournament.get()
+
+    @ndb.transactional(xg=True)
+    def _advance():
+        match = game.tournament_match.get()
+        if match is None or match.winner is not None:
+            return
+        seed = _match_winner(game, match.players)
+        if match.round_number + 1 == len(
+                _match_counts(len(tournament.entrants))):
+            _set_winner(match, seed, None)
+            final = tournament.key.get()
+            final.champion = seed
+            final.status = 'done'
+            ndb.put_multi([match, final])
+            return
+        next_match = tournament.match_key(match.round_number + 1,
+                                          match.match_number / 2).get()
+        games = []
+        if _set_winner(match, seed, next_match):
+            games = _build_games(tournament, [next_match])
+        ndb.put_multi(games + [match, next_match])
+
+    _advance()
@@ -0,0 +1,120 @@
+"""userimport.py - Bulk user import, for onboarding another site's users.
+
+The input is newline delimited JSON, one {"name": ..., "email": ...} record
+per line (email is optional). Records are read in chunks of IMPORT_CHUNK:
+
+    - each chunk is deduplicated in memory - the first record for a name is
+      imported, later ones are reported as duplicates,
+    - its names are checked with one batched get of the keys imported users
+      are saved with (User id = name), and IN queries for the rest, which
+      find users created by create_user (auto ids),
+    - the new users are saved with one put_multi.
+
+An import stops between chunks once its time budget is spent and returns
+the line to resume from. Posting the same input again from that line is
+safe - users imported already are reported as existing, never created
+twice."""
+
+import itertools
+import json
+import time
+from google.appengine.ext import ndb
+from models import User, users_by_name
+
+IMPORT_CHUNK = 500  # records per batched lookup and put_multi
+TIME_BUDGET = 45  # seconds - well inside the 60 second request deadline
+MAX_NAME_BYTES = 500  # the longest key name the datastore allows
+MAX_EMAIL_BYTES = 1500  # the longest indexed string the datastore allows
+
+CREATED = 'created'
+EXISTS = 'exists'
+DUPLICATE = 'duplicate'
+INVALID = 'invalid'
+
+
+def _parse(line):
+    """Returns (name, email) for a record line.
+    Raises:
+        ValueError: if the line isn't a valid record."""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError('Record is not a JSON object')
+    name = record.get('name')
+    email = record.get('email')
+    if not isinstance(name, basestring) or not name.strip():
+        raise ValueError('Missing name')
+    if len(name.encode('utf-8')) > MAX_NAME_BYTES:
+        raise ValueError('Name is too long')
+    if name.startswith('__') and name.endswith('__'):
+        # the datastore reserves __*__ key names - the put would fail the
+        # whole chunk
+        raise ValueError('Reserved name')
+    if email is not None and not isinstance(email, basestring):
+        raise ValueError('Invalid email')
+    if email is not None and len(email.encode('utf-8')) > MAX_EMAIL_BYTES:
+        raise ValueError('Email is too long')
+    return name, email
+
+
+def _import_chunk(records, seen):
+    """Imports a chunk of (line number, line) records, skipping names in
+    seen and adding the chunk's names to it. Returns the records' results
+    in line order."""
+    results = []
+    new = []
+    for number, line in records:
+        if not line.strip():
+            continue
+        try:
+            name, email = _parse(line)
+        except ValueError as e:
+            results.append({'line': number, 'result': INVALID,
+                            'error': str(e)})
+            continue
+        if name in seen:
+            results.append({'line': number, 'name': name,
+                            'result': DUPLICATE})
+            continue
+        seen.add(name)
+        new.append((number, name, email))
+    names = [name for _, name, _ in new]
+    existing = set(user.name for user in
+                   ndb.get_multi([ndb.Key(User, name) for name in names])
+                   if user)
+    existing.update(users_by_name([name for name in names
+                                   if name not in existing]))
+    users = []
+    for number, name, email in new:
+        if name in existing:
+            results.append({'line': number, 'name': name, 'result': EXISTS})
+        else:
+            users.append(User(id=name, name=name, email=email))
+            results.append({'line': number, 'name': name,
+                            'result': CREATED})
+    ndb.put_multi(users)
+    results.sort(key=lambda result: result['line'])
+    return results
+
+
+def import_users(lines, offset=0, time_budget=TIME_BUDGET):
+    """Imports users from an iterable of record lines, starting at line
+    offset (from 0). Returns (results, next_offset) - a result per record
+    {'line', 'name', 'result', 'error'}, and the line to resume from, or
+    None once every line was read."""
+    started = time.time()
+    lines = itertools.islice(lines, offset, None)
+    seen = set()
+    results = []
+    number = offset
+    while True:
+        chunk = list(enumerate(itertools.islice(lines, IMPORT_CHUNK),
+                               number))
+        if not chunk:
+            return results, None
+        number += len(chunk)
+        results.extend(_import_chunk(chunk, seen))
+        if time.time() - started > time_budget:
+            following = next(lines, None)
+            if following is None:
+                return results, None
+            return results, number
@@ -0,0 +1,126 @@
+"""userstats.py - Per user statistics summary.
+
+A UserStats entity per user (keyed by the user's key id) holds running
+totals per game mode and board size, updated incrementally from the scores
+saved when games end. Reading a user's summary is a single get instead of
+pulling their whole score history.
+
+The result tasks that record scores run at least once, so each summary
+keeps the keys of the last RECORDED_SCORES scores it counted, saved in the
+same transaction, and skips a score it has counted already. A retry comes
+within minutes of the first run, long before its scores leave that list."""
+
+import datetime
+from google.appengine.ext import ndb
+from messages import UserStatsForm, ModeStatsForm
+
+# score kind -> game mode name used in the stats
+SCORE_MODES = {'ScoreP1': 'p1', 'ScoreP2': 'p2', 'ScoreMP': 'mp'}
+RECORDED_SCORES = 100  # score keys kept per user to skip retried scores
+
+
+class UserStats(ndb.Model):
+    """Statistics summary for a user. modes holds running totals as
+    {mode: {size: {games, wins, ties, total_turns, best_turns}}} - sizes are
+    string keys as stored in JSON. best_turns is the fewest turns taken in a
+    won game."""
+    user = ndb.KeyProperty(required=True, kind='User', indexed=False)
+    modes = ndb.JsonProperty(default={})
+    best_consec_turns = ndb.IntegerProperty(default=0, indexed=False)
+    # urlsafe keys of the last scores counted, oldest first
+    recorded = ndb.StringProperty(repeated=True, indexed=False)
+
+    def record(self, scores):
+        """Add the scores not counted yet to the running totals. Returns
+        True if any were added."""
+        recorded = set(self.recorded)
+        added = False
+        for score in scores:
+            key = score.key.urlsafe()
+            if key in recorded:
+                continue
+            self.add_score(score)
+            self.recorded.append(key)
+            recorded.add(key)
+            added = True
+        self.recorded = self.recorded[-RECORDED_SCORES:]
+        return added
+
+    def add_score(self, score):
+        """Add a saved score entity (ScoreP1, ScoreP2, ScoreMP or
+        ConsecutiveTurns) to the running totals"""
+        kind = score._get_kind()
+        if kind == 'ConsecutiveTurns':
+            self.best_consec_turns = max(self.best_consec_turns, score.turns)
+            return
+        sizes = self.modes.setdefault(SCORE_MODES[kind], {})
+        totals = sizes.setdefault(str(score.size), {
+            'games': 0, 'wins': 0, 'ties': 0, 'total_turns': 0,
+            'best_turns': None})
+        totals['games'] += 1
+        totals['total_turns'] += score.turns
+        if getattr(score, 'tie', False):
+            totals['ties'] += 1
+        elif score.won:
+            totals['wins'] += 1
+            if totals['best_turns'] is None or \
+                    score.turns < totals['best_turns']:
+                totals['best_turns'] = score.turns
+
+    def to_form(self, user_name):
+        form = UserStatsForm(user_name=user_name,
+                             best_consec_turns=self.best_consec_turns)
+        for mode in sorted(self.modes):
+            for size in sorted(self.modes[mode], key=int):
+                totals = self.modes[mode][size]
+                form.modes.append(ModeStatsForm(
+                    mode=mode,
+                    size=int(size),
+                    games=totals['games'],
+                    wins=totals['wins'],
+                    ties=totals['ties'],
+                    win_rate=float(totals['wins']) / totals['games'],
+                    average_turns=(float(totals['total_turns']) /
+                                   totals['games']),
+                    best_turns=totals['best_turns']))
+        return form
+
+
+def record_scores(entities):
+    """Add the scores in a list of saved entities to their users' stats -
+    one small transaction per user, run in parallel"""
+    by_user = {}
+    for entity in entities:
+        kind = entity._get_kind()
+        if kind in SCORE_MODES or kind == 'ConsecutiveTurns':
+            by_user.setdefault(entity.user, []).append(entity)
+    futures = [_add_scores_async(user, scores)
+               for user, scores in by_user.items()]
+    ndb.Future.wait_all(futures)
+    for future in futures:
+        future.check_success()
+
+
+@ndb.tasklet
+def _add_scores_async(user, scores):
+    key = ndb.Key(UserStats, user.id())
+
+    @ndb.tasklet
+    def _txn():
+        stats = yield key.get_async()
+        if stats is None:
+            stats = UserStats(key=key, user=user, modes={})
+        if stats.record(scores):
+            yield stats.put_async()
+
+    yield ndb.transaction_async(_txn)
+
+
+def rebuild(user, scores):
+    """Returns a fresh, unsaved UserStats for user from all of their score
+    entities - used by the bulk recompute job. The newest scores are the
+    ones kept as recorded, so a result task still to run skips them."""
+    stats = UserStats(id=user.id(), user=user, modes={})
+    stats.record(sorted(scores, key=lambda score: score.date or
+                        datetime.datetime.min))
+    return stats
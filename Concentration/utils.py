@@ -1,8 +1,11 @@
 """utils.py - File for collecting general utility functions. - taken from the
     Udacity Guess-a-Number skeleton project"""
 
+import operator
 from google.appengine.ext import ndb
 import endpoints
+from models import User, LEGACY_SCORES, merge_legacy_scores
+import storage
 
 
 def get_by_urlsafe(urlsafe, model):
@@ -28,9 +31,29 @@ def get_by_urlsafe(urlsafe, model):
         else:
             raise
 
-    entity = key.get()
+    entity = storage.repository.get(key)
     if not entity:
         return None
     if not isinstance(entity, model):
         raise ValueError('Incorrect Kind')
     return entity
+
+
+def get_user(user_name):
+    """Returns the User with the given name, or None if there isn't one"""
+    return storage.repository.query_one(User, [('name', '=', user_name)])
+
+
+def get_user_scores(model, user_key, order=()):
+    """Returns a user's scores of one kind (ScoreP1, ScoreP2, ScoreMP or
+    ConsecutiveTurns) sorted by order - an ancestor query on the user, so a
+    score is listed as soon as its game has ended. Root scores that haven't
+    been migrated under the user are merged in while LEGACY_SCORES is set."""
+    scores = storage.repository.query(model, order=order, ancestor=user_key)
+    if LEGACY_SCORES:
+        scores = merge_legacy_scores(scores, storage.repository.query(
+            model, [('user', '=', user_key)]))
+        for name in reversed(list(order)):
+            scores.sort(key=operator.attrgetter(name.lstrip('-')),
+                        reverse=name.startswith('-'))
+    return scores
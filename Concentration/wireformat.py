@@ -0,0 +1,110 @@
+"""wireformat.py - Compact "packed" response format for game state.
+
+Clients pick the format per request with the format parameter:
+
+    json (default): cards is a list of JSON strings {"(x, y)": pair}.
+    packed: cards is left empty and packed_cards holds one byte per board
+        cell in row major order (cell x * size + y) - the card's pair
+        number, or 0xFF once the pair has been found. History responses
+        carry packed_history instead of the move list: zlib compressed,
+        four bytes per move - player, first cell, second cell (each cell
+        x << 4 | y) and 1 if the move found a pair, else 0. Turns are the
+        move's position in the history, from 1.
+
+Bytes fields travel base64 encoded in the JSON body.
+tools/wireformat_benchmark.py compares the sizes and encode/decode times."""
+
+import functools
+import json
+import zlib
+import endpoints
+from messages import GameHistoryForms
+from models import FOUND_PAIR
+
+JSON = 'json'
+PACKED = 'packed'
+FORMATS = [JSON, PACKED]
+REMOVED = 0xFF
+
+
+def _parse_cell(cell):
+    """"(x, y)" -> (x, y)"""
+    x, y = cell.strip('()').split(',')
+    return int(x), int(y)
+
+
+def pack_cards(size, cards):
+    """Returns the packed board for a size x size board given the cards
+    still in play, as {cell: pair}"""
+    board = bytearray([REMOVED] * (size * size))
+    for cell, pair in cards.items():
+        x, y = _parse_cell(cell)
+        board[x * size + y] = pair
+    return bytes(board)
+
+
+def unpack_cards(size, packed):
+    """Returns {cell: pair} for the cards in play on a packed board"""
+    return dict((str((index // size, index % size)), pair)
+                for index, pair in enumerate(bytearray(packed))
+                if pair != REMOVED)
+
+
+def _pack_cell(cell):
+    x, y = _parse_cell(cell)
+    return x << 4 | y
+
+
+def pack_history(history):
+    """Returns the packed, compressed history for a list of GameHistoryForm"""
+    packed = bytearray()
+    for move in history:
+        packed.extend([move.player, _pack_cell(move.coord1),
+                       _pack_cell(move.coord2),
+                       int(move.result == FOUND_PAIR)])
+    return zlib.compress(bytes(packed))
+
+
+def unpack_history(packed):
+    """Returns [(turn, player, coord1, coord2, found), ...]"""
+    moves = bytearray(zlib.decompress(packed))
+    return [(i // 4 + 1, moves[i],
+             str((moves[i + 1] >> 4, moves[i + 1] & 0xF)),
+             str((moves[i + 2] >> 4, moves[i + 2] & 0xF)),
+             bool(moves[i + 3]))
+            for i in range(0, len(moves), 4)]
+
+
+def pack_form(form):
+    """Switches a game form or GameHistoryForms to the packed format, in
+    place, and returns it. Not modified game forms carry no cards and are
+    returned as they are."""
+    if isinstance(form, GameHistoryForms):
+        form.packed_history = pack_history(form.history)
+        form.history = []
+    elif form.size:
+        cards = {}
+        for card in form.cards:
+            cards.update(json.loads(card))
+        form.packed_cards = pack_cards(form.size, cards)
+        form.cards = []
+    return form
+
+
+def negotiated(method):
+    """Decorator for endpoint methods whose request has a format parameter -
+    place it below @endpoints.method. Packs the response for format=packed.
+    Raises BadRequestException (before the method runs) for an unknown
+    format."""
+    @functools.wraps(method)
+    def wrapper(self, request):
+        response_format = request.format or JSON
+        if response_format not in FORMATS:
+            raise endpoints.BadRequestException(
+                'Invalid format. Valid formats are {0}.'.format(
+                    ', '.join(FORMATS)))
+        response = method(self, request)
+        if response_format == PACKED:
+            pack_form(response)
+        return response
+    return wrapper
@@ -0,0 +1,204 @@
+"""writebehind.py - Opt-in write-behind saving for single player games.
+
+Moves of a write-behind game aren't saved to the datastore one by one. Each
+move is appended to a compact journal in memcache (just the two selected
+co-ordinates) and the game entity is only saved when the game ends, every
+FLUSH_EVERY moves or when the journal is older than FLUSH_INTERVAL seconds.
+Loading a game replays its journal on top of the last saved entity, so the
+journal doubles as crash recovery - it is only applied to the entity version
+it was started from. If memcache loses a journal the game falls back to the
+last saved state, losing at most FLUSH_EVERY moves. The lost moves were
+published with versions past the saved one, so a new journal numbers its
+moves from past the published turn state (or, if that isn't cached, past
+every version the lost journal could have reached) - a version never names
+two boards, for etags and the form cache.
+
+Every save compares the stored game version with the version the journal was
+started from, and a flush first claims the journal with a compare-and-set, so
+a move appended meanwhile (or a second flush) gets a ConcurrentMoveError
+instead of being lost. Starting a journal queues a flush task for
+FLUSH_INTERVAL later, so the moves of an abandoned game still reach the
+datastore."""
+
+import time
+from google.appengine.api import datastore_errors, memcache, taskqueue
+from google.appengine.ext import ndb
+from models import GameP1, ConcurrentMoveError
+import notify
+import storage
+from utils import get_by_urlsafe
+
+FLUSH_EVERY = 10  # moves
+FLUSH_INTERVAL = 30  # seconds
+JOURNAL_TTL = 86400  # seconds - unflushed moves older than this are lost
+
+
+class MoveJournal(object):
+    """Moves applied since a write-behind game was last saved"""
+
+    def __init__(self, urlsafe_game_key, version, moves=None, started=None,
+                 cas_client=None, base=None):
+        self.urlsafe_game_key = urlsafe_game_key
+        self.version = version  # version of the saved game entity
+        # game version the moves are numbered from
+        self.base = version if base is None else base
+        self.moves = moves or []
+        self.started = started or time.time()
+        self._client = cas_client  # set if the journal was read from cache
+
+    @staticmethod
+    def _cache_key(urlsafe_game_key):
+        return 'journal:' + urlsafe_game_key
+
+    @classmethod
+    def load(cls, urlsafe_game_key, game):
+        """Returns the journal for the game, replayed onto game. A journal
+        started from another version of the game (left behind by a flush
+        that couldn't delete it) is ignored, and replaced by the first
+        append. A new journal moves game.version to its base."""
+        client = memcache.Client()
+        cached = client.gets(cls._cache_key(urlsafe_game_key))
+        if cached is None or cached['version'] != game.version:
+            journal = cls(urlsafe_game_key, game.version,
+                          cas_client=client if cached else None,
+                          base=start_version(urlsafe_game_key, game.version))
+            game.version = journal.base
+            return journal
+        journal = cls(urlsafe_game_key, cached['version'], cached['moves'],
+                      cached['started'], cas_client=client,
+                      base=cached.get('base'))
+        game.version = journal.base
+        for selection1, selection2 in journal.moves:
+            game.apply_move(selection1, selection2)
+        return journal
+
+    def append(self, selection1, selection2):
+        """Records a move and saves the journal. Raises ConcurrentMoveError
+        if another request changed the journal since it was loaded."""
+        self.moves.append((selection1, selection2))
+        value = {'version': self.version,
+                 'base': self.base,
+                 'moves': self.moves,
+                 'started': self.started}
+        cache_key = self._cache_key(self.urlsafe_game_key)
+        if self._client is not None:
+            saved = self._client.cas(cache_key, value, time=JOURNAL_TTL)
+        else:
+            saved = memcache.add(cache_key, value, time=JOURNAL_TTL)
+        if not saved:
+            raise ConcurrentMoveError()
+        if len(self.moves) == 1:
+            queue_flush(self.urlsafe_game_key, self.version)
+
+    def claim(self):
+        """Rewrites the cached journal as it is, so any request that loaded
+        it before can no longer append to it. Raises ConcurrentMoveError if
+        another request changed it first."""
+        if self._client is None or not self.moves:
+            return
+        value = {'version': self.version,
+                 'base': self.base,
+                 'moves': self.moves,
+                 'started': self.started}
+        if not self._client.cas(self._cache_key(self.urlsafe_game_key),
+                                value, time=JOURNAL_TTL):
+            raise ConcurrentMoveError()
+
+    def flush_due(self):
+        """True when the next move should save the game entity instead of
+        being journalled"""
+        return (len(self.moves) + 1 >= FLUSH_EVERY or
+                time.time() - self.started >= FLUSH_INTERVAL)
+
+    def clear(self):
+        """Drop the journal - call after the game entity has been saved"""
+        memcache.delete(self._cache_key(self.urlsafe_game_key))
+
+
+def start_version(urlsafe_game_key, saved_version):
+    """The version a new journal for a game saved at saved_version numbers
+    its moves from - past any version published for moves of a lost
+    journal"""
+    state = notify.turn_notifier.current(urlsafe_game_key)
+    if state is None:
+        # a lost journal's moves can't have gone further than this
+        return saved_version + FLUSH_EVERY
+    return max(saved_version, state['version'])
+
+
+def load_game(urlsafe_game_key):
+    """Returns the single player game with any unsaved moves applied, or None
+    if the game doesn't exist"""
+    game, journal = load_game_and_journal(urlsafe_game_key)
+    return game
+
+
+def load_game_and_journal(urlsafe_game_key):
+    """Returns (game, journal) - journal is None for games that aren't
+    write-behind or are already over"""
+    game = get_by_urlsafe(urlsafe_game_key, GameP1)
+    if not game or not game.write_behind or game.game_over:
+        return game, None
+    return game, MoveJournal.load(urlsafe_game_key, game)
+
+
+def queue_flush(urlsafe_game_key, version):
+    """Queue the flush of a journal started from version of a game, for
+    FLUSH_INTERVAL from now - named, so a journal is only flushed once"""
+    try:
+        taskqueue.add(url='/tasks/flush_journal',
+                      name='flush-{0}-{1}'.format(
+                          ndb.Key(urlsafe=urlsafe_game_key).id(), version),
+                      params={'game': urlsafe_game_key},
+                      countdown=FLUSH_INTERVAL)
+    except (taskqueue.TaskAlreadyExistsError,
+            taskqueue.TombstonedTaskError):
+        pass
+
+
+def put_if_saved_version(game, saved_version):
+    """Saves the game only if the stored copy is still at saved_version.
+    Raises ConcurrentMoveError if another request saved the game first."""
+    def _compare_and_put():
+        stored = storage.repository.get(game.key)
+        if stored is None or stored.version != saved_version:
+            raise ConcurrentMoveError()
+        storage.repository.put_multi([game])
+    try:
+        storage.repository.transaction(_compare_and_put, retries=0)
+    except datastore_errors.TransactionFailedError:
+        raise ConcurrentMoveError()
+
+
+def flush(game, journal):
+    """Save a write-behind game with its journalled moves applied and drop
+    the journal. Raises ConcurrentMoveError if another request changed the
+    journal or saved the game first."""
+    journal.claim()
+    put_if_saved_version(game, journal.version)
+    journal.clear()
+
+
+def flush_abandoned(urlsafe_game_key):
+    """Flush a game's journal if it is older than FLUSH_INTERVAL - run by
+    the task queue_flush queues. Raises ConcurrentMoveError (so the task is
+    retried) if a move got in the way."""
+    game, journal = load_game_and_journal(urlsafe_game_key)
+    if journal is None or not journal.moves or \
+            time.time() - journal.started < FLUSH_INTERVAL:
+        return
+    flush(game, journal)
+
+
+def save_move(game, journal, selection1, selection2):
+    """Save a move applied to game. Games without a journal are saved
+    straight away, write-behind games only every so often. Raises
+    ConcurrentMoveError if another request saved the game first."""
+    if journal is None:
+        # apply_move bumped the version of the saved game by one
+        put_if_saved_version(game, game.version - 1)
+        return
+    if journal.flush_due():
+        flush(game, journal)
+    else:
+        journal.append(selection1, selection2)
@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+"""index_cost.py - Datastore index write cost report for the Concentration
+models.
+
+Reads the app's source with the ast module (nothing is imported, so no SDK is
+needed):
+
+    - the ndb models and their properties, and whether each is indexed,
+    - the properties the app's queries filter or sort on - ndb queries
+      (Model.prop comparisons, .order(), .IN()) and storage.repository
+      query / query_one calls with (name, op, value) filters and order names,
+    - the composite indexes in index.yaml.
+
+For every model it lists the indexed properties no query uses, and the write
+operations a put costs with the datastore's per-operation pricing: a new
+entity costs 2 writes + 2 per indexed property value + 1 per composite index
+entry, and an update 1 write + 4 per changed indexed property value + 2 per
+changed composite index entry. For the game models the update cost is for
+one move, using the properties a move changes (MOVE_UPDATES).
+
+Usage:
+    python tools/index_cost.py [--app Concentration]
+"""
+
+import argparse
+import ast
+import os
+import re
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+
+# properties always stored unindexed
+UNINDEXED_TYPES = ['JsonProperty', 'PickleProperty', 'TextProperty',
+                   'BlobProperty', 'LocalStructuredProperty']
+
+# properties a single move changes, per game model
+MOVE_UPDATES = {
+    'GameP1': ['pairs_won', 'turns', 'consec_turns', 'consec_turns_temp',
+               'card_map', 'card_graveyard', 'game_history', 'version',
+               'last_move'],
+    'GameP2': ['user1_turns', 'user1_pairs', 'user1_consec_turns',
+               'user1_consec_temp', 'turns', 'card_map', 'card_graveyard',
+               'current_turn', 'game_history', 'version', 'last_move'],
+    'GameMP': ['seat_turns', 'seat_pairs', 'seat_consec_turns',
+               'seat_consec_temp', 'turns', 'card_map', 'card_graveyard',
+               'current_seat', 'game_history', 'version', 'last_move'],
+}
+
+
+def _string(node):
+    """The value of a string literal node, or None"""
+    if isinstance(node, ast.Str):
+        return node.s
+    value = getattr(node, 'value', None)
+    if type(node).__name__ == 'Constant' and isinstance(value, str):
+        return value
+    return None
+
+
+def _strings(node):
+    """The values of a list / tuple of string literals, or []"""
+    if isinstance(node, (ast.List, ast.Tuple)):
+        return [value for value in map(_string, node.elts)
+                if value is not None]
+    return []
+
+
+class Model(object):
+    def __init__(self, name):
+        self.name = name
+        self.properties = {}  # name -> (type, indexed, repeated)
+        self.queried = set()
+
+    def indexed(self):
+        return sorted(name for name, (_, indexed, _) in
+                      self.properties.items() if indexed)
+
+
+def read_models(trees):
+    """Returns {class name: Model} for the ndb.Model subclasses"""
+    models = {}
+    for tree in trees.values():
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.ClassDef):
+                continue
+            if not any(isinstance(base, ast.Attribute) and
+                       base.attr == 'Model' for base in node.bases):
+                continue
+            model = models[node.name] = Model(node.name)
+            for statement in node.body:
+                if not (isinstance(statement, ast.Assign) and
+                        isinstance(statement.value, ast.Call) and
+                        isinstance(statement.value.func, ast.Attribute) and
+                        statement.value.func.attr.endswith('Property')):
+                    continue
+                kind = statement.value.func.attr
+                options = dict((keyword.arg, keyword.value)
+                               for keyword in statement.value.keywords)
+                indexed = kind not in UNINDEXED_TYPES
+                if 'indexed' in options:
+                    indexed = getattr(options['indexed'], 'id', None) != \
+                        'False' and getattr(options['indexed'], 'value',
+                                            True) is not False
+                repeated = 'repeated' in options
+                for target in statement.targets:
+                    model.properties[target.id] = (kind, indexed, repeated)
+    return models
+
+
+def read_queries(trees, models):
+    """Marks the properties used by queries on models"""
+    def mark(receiver, prop):
+        if receiver in models:
+            if prop in models[receiver].properties:
+                models[receiver].queried.add(prop)
+            return
+        # a variable holding one of several models - count the models that
+        # index the property
+        for model in models.values():
+            if prop in model.indexed():
+                model.queried.add(prop)
+
+    def mark_attribute(node):
+        if isinstance(node, ast.UnaryOp):
+            node = node.operand
+        if isinstance(node, ast.Attribute) and \
+                isinstance(node.value, ast.Name):
+            mark(node.value.id, node.attr)
+
+    for tree in trees.values():
+        # names bound by `for name in ['a', 'b']` loops
+        loop_values = {}
+        for node in ast.walk(tree):
+            if isinstance(node, ast.For) and isinstance(node.target,
+                                                        ast.Name):
+                loop_values.setdefault(node.target.id, []).extend(
+                    _strings(node.iter))
+        for node in ast.walk(tree):
+            if not isinstance(node, ast.Call) or \
+                    not isinstance(node.func, ast.Attribute):
+                continue
+            method = node.func.attr
+            if method in ['query', 'filter']:
+                # Model.query(Model.prop == value, ...) / .filter(...)
+                for arg in node.args:
+                    for part in ast.walk(arg):
+                        if isinstance(part, ast.Compare):
+                            mark_attribute(part.left)
+            if method == 'order':
+                for arg in node.args:
+                    mark_attribute(arg)
+            elif method == 'IN':
+                mark_attribute(node.func.value)
+            elif method in ['query', 'query_one'] and node.args and \
+                    isinstance(node.args[0], ast.Name):
+                # storage.repository.query(Model, filters, order)
+                names = []
+                filters = node.args[1] if len(node.args) > 1 else None
+                for keyword in node.keywords:
+                    if keyword.arg == 'filters':
+                        filters = keyword.value
+                if isinstance(filters, ast.List):
+                    for condition in filters.elts:
+                        if isinstance(condition, ast.Tuple):
+                            first = condition.elts[0]
+                            names.append(_string(first))
+                            if isinstance(first, ast.Name):
+                                names.extend(loop_values.get(first.id, []))
+                order = node.args[2] if len(node.args) > 2 else None
+                for keyword in node.keywords:
+                    if keyword.arg == 'order':
+                        order = keyword.value
+                if order is not None:
+                    names.extend(_strings(order))
+                for name in names:
+                    if name:
+                        mark(node.args[0].id, name.lstrip('-'))
+
+
+def read_composites(app_dir, models):
+    """Returns {kind: [[property, ...], ...]} from index.yaml, and marks the
+    properties as queried"""
+    composites = {}
+    path = os.path.join(app_dir, 'index.yaml')
+    if not os.path.exists(path):
+        return composites
+    kind = None
+    with open(path) as index_file:
+        for line in index_file:
+            line = line.split('#')[0].rstrip()
+            match = re.match(r'^- kind:\s*(\w+)', line)
+            if match:
+                kind = match.group(1)
+                composites.setdefault(kind, []).append([])
+                continue
+            match = re.match(r'^\s+- name:\s*(\w+)', line)
+            if match and kind:
+                composites[kind][-1].append(match.group(1))
+                if kind in models and match.group(1) in \
+                        models[kind].properties:
+                    models[kind].queried.add(match.group(1))
+    return composites
+
+
+def write_costs(model, composites):
+    """Returns (new entity writes, writes per move or None)"""
+    indexed = model.indexed()
+    new = 2 + 2 * len(indexed) + len(composites.get(model.name, []))
+    changed = MOVE_UPDATES.get(model.name)
+    if changed is None:
+        return new, None
+    move = 1 + 4 * len([name for name in indexed if name in changed])
+    move += 2 * len([index for index in composites.get(model.name, [])
+                     if set(index) & set(changed)])
+    return new, move
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--app', default=APP_DIR, help='app directory')
+    args = parser.parse_args()
+    trees = {}
+    for name in sorted(os.listdir(args.app)):
+        if name.endswith('.py'):
+            with open(os.path.join(args.app, name)) as source:
+                trees[name] = ast.parse(source.read(), name)
+    models = read_models(trees)
+    read_queries(trees, models)
+    composites = read_composites(args.app, models)
+    print('Writes per put (repeated properties counted as one value)')
+    print('{0:<20} {1:>8} {2:>8} {3:>10} {4:>10}'.format(
+        'model', 'indexed', 'queried', 'new put', 'per move'))
+    for name in sorted(models):
+        model = models[name]
+        new, move = write_costs(model, composites)
+        print('{0:<20} {1:>8} {2:>8} {3:>10} {4:>10}'.format(
+            name, len(model.indexed()), len(model.queried), new,
+            '-' if move is None else move))
+    print('')
+    print('Indexed properties no query uses')
+    for name in sorted(models):
+        unused = [prop for prop in models[name].indexed()
+                  if prop not in models[name].queried]
+        if unused:
+            print('  {0}: {1}'.format(name, ', '.join(unused)))
+    print('')
+    print('Queried properties that are not indexed (check these by hand - '
+          'queries on them return nothing)')
+    for name in sorted(models):
+        missing = sorted(prop for prop in models[name].queried
+                         if prop not in models[name].indexed())
+        if missing:
+            print('  {0}: {1}'.format(name, ', '.join(missing)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""move_stress.py - Concurrency stress test for two player moves.
+
+Plays two player games on the App Engine testbed stubs where every move is
+raced: each round fires --threads parallel make_move_p2 calls for the player
+whose turn it is, all based on the same game version. The compare-and-set
+save (VersionedGame.put_if_version) must let exactly one of them through per
+version and reject the rest with a ConflictException. Once the game is over
+it checks the saved game is consistent:
+
+    - every version from 1 to the final version was won by exactly one call,
+    - the history, turn counters and version agree,
+    - card_map and card_graveyard split the board between them, and the
+      graveyard holds matching pairs only, as many as the players' pairs.
+
+The rate limits are switched off for the run (they would throttle the
+threads, which all hit the same game). Exits with status 1 on a failure.
+
+Usage:
+    python tools/move_stress.py --sdk ~/google-cloud-sdk/platform/\
+google_appengine [--games 5] [--size 4] [--threads 8]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import threading
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+# the messages of a move that was applied (anything else left the game as it
+# was - not your turn, invalid selection, game over)
+MOVE_MESSAGES = ["Found a pair!!", "The pair doesn't match ...",
+                 "Congratulations you found the last pair - Game Over!!"]
+
+
+def race(service, game, threads):
+    """Fires threads parallel moves at the game's current version. Returns
+    (versions won by applied moves, number of conflicts, other errors)"""
+    import endpoints
+    from api import MAKE_MOVE_REQUEST_P2
+    cells = sorted(json.loads(game.card_map))
+    player = game.user1 if game.current_turn == 1 else game.user2
+    user_name = player.get().name
+    request_class = MAKE_MOVE_REQUEST_P2.combined_message_class
+    start = threading.Event()
+    results = []
+    lock = threading.Lock()
+
+    def move():
+        cell1, cell2 = random.sample(cells, 2)
+        (x1, y1), (x2, y2) = [json.loads(cell.replace('(', '[')
+                                         .replace(')', ']'))
+                              for cell in (cell1, cell2)]
+        request = request_class(urlsafe_game_key=game.key.urlsafe(),
+                                x1=x1, y1=y1, x2=x2, y2=y2,
+                                user_name=user_name,
+                                version=game.version)
+        start.wait()
+        try:
+            form = service.make_move_p2(request)
+            outcome = ('moved', form.version) \
+                if form.message in MOVE_MESSAGES else ('no move', None)
+        except endpoints.ConflictException:
+            outcome = ('conflict', None)
+        except Exception as e:
+            outcome = ('error', repr(e))
+        with lock:
+            results.append(outcome)
+
+    workers = [threading.Thread(target=move) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join()
+    won = [value for outcome, value in results if outcome == 'moved']
+    conflicts = len([1 for outcome, _ in results if outcome == 'conflict'])
+    errors = [value for outcome, value in results if outcome == 'error']
+    return won, conflicts, errors
+
+
+def check_game(game, won):
+    """Returns a list of consistency failures of a finished game"""
+    failures = []
+    if sorted(won) != range(1, game.version + 1):
+        failures.append('versions won {0} for final version {1}'.format(
+            sorted(won), game.version))
+    if not len(game.game_history) == game.turns == game.version:
+        failures.append('history {0}, turns {1}, version {2}'.format(
+            len(game.game_history), game.turns, game.version))
+    if game.user1_turns + game.user2_turns != game.turns:
+        failures.append('player turns {0} + {1} != turns {2}'.format(
+            game.user1_turns, game.user2_turns, game.turns))
+    card_map = json.loads(game.card_map)
+    graveyard = json.loads(game.card_graveyard)
+    if set(card_map) & set(graveyard) or \
+            len(card_map) + len(graveyard) != game.size * game.size:
+        failures.append('card_map and card_graveyard overlap or miss cells')
+    values = sorted(graveyard.values())
+    if values[::2] != values[1::2]:
+        failures.append('graveyard holds unmatched cards')
+    if game.user1_pairs + game.user2_pairs != len(graveyard) / 2:
+        failures.append('pairs {0} + {1} != graveyard pairs {2}'.format(
+            game.user1_pairs, game.user2_pairs, len(graveyard) / 2))
+    if card_map or not game.game_over:
+        failures.append('game not over with {0} cards left'.format(
+            len(card_map)))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK (google_appengine) dir')
+    parser.add_argument('--games', type=int, default=5)
+    parser.add_argument('--size', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    args = parser.parse_args()
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    os.environ.setdefault('APPLICATION_ID', 'concentration-api')
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    failed = False
+    try:
+        import api
+        import ratelimit
+        from models import User, GameP2
+        ratelimit.RATE_LIMITS.clear()
+        service = api.ConcentrationGameApi()
+        random.seed(0)
+        users = [User(name='player{0}'.format(i)) for i in (1, 2)]
+        for user in users:
+            user.put()
+        for number in range(args.games):
+            game = GameP2.new_game(users[0].key, users[1].key, args.size)
+            won, conflicts, errors = [], 0, []
+            while not game.game_over:
+                round_won, round_conflicts, round_errors = race(
+                    service, game, args.threads)
+                won.extend(round_won)
+                conflicts += round_conflicts
+                errors.extend(round_errors)
+                game = game.key.get()
+            failures = check_game(game, won) + errors
+            failed = failed or bool(failures)
+            print('game {0}: {1} moves, {2} conflicts - {3}'.format(
+                number + 1, game.version, conflicts,
+                'ok' if not failures else 'FAILED'))
+            for failure in failures:
+                print('    ' + failure)
+    finally:
+        bed.deactivate()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
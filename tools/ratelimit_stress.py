@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""ratelimit_stress.py - Concurrency test for the ratelimit.py budgets.
+
+Runs rounds of --threads parallel ratelimit.take calls for one user against
+the App Engine memcache stub, all at the same moment. Each round is one
+period after the last, half way through the next window, so half of the
+previous window still counts. For every round it checks:
+
+    - at most as many calls are admitted as the bucket has room for - the
+      budget less the previous window's admitted calls weighted by its
+      overlap (the first round has the whole budget),
+    - the window's counter holds the admitted calls only - rejected calls
+      are taken back out.
+
+Exits with status 1 on a failure.
+
+Usage:
+    python tools/ratelimit_stress.py --sdk ~/google-cloud-sdk/platform/\
+google_appengine [--limit 20] [--period 60] [--threads 60] [--rounds 4]
+"""
+
+import argparse
+import collections
+import os
+import sys
+import threading
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+METHOD = 'stress'  # the RATE_LIMITS entry the run adds
+Request = collections.namedtuple('Request', ['user_name'])
+
+
+def race(ratelimit, threads, now):
+    """Fires threads parallel take calls at time now. Returns the number of
+    calls admitted"""
+    request = Request(user_name='player1')
+    start = threading.Event()
+    results = []
+    lock = threading.Lock()
+
+    def call():
+        start.wait()
+        scope = ratelimit.take(METHOD, request, now=now)
+        with lock:
+            results.append(scope)
+
+    workers = [threading.Thread(target=call) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    start.set()
+    for worker in workers:
+        worker.join()
+    return results.count(None)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK (google_appengine) dir')
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--period', type=int, default=60)
+    parser.add_argument('--threads', type=int, default=60)
+    parser.add_argument('--rounds', type=int, default=4)
+    args = parser.parse_args()
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    os.environ.setdefault('APPLICATION_ID', 'concentration-api')
+    from google.appengine.api import memcache
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_memcache_stub()
+    failed = False
+    try:
+        import ratelimit
+        ratelimit.RATE_LIMITS[METHOD] = {'user': (args.limit, args.period)}
+        # start half way through a window - each round is then half way
+        # through the next one
+        now = 1000 * args.period + args.period / 2.0
+        previous = 0
+        for number in range(args.rounds):
+            admitted = race(ratelimit, args.threads, now)
+            room = int(args.limit - previous * 0.5)
+            window = int(now // args.period)
+            counted = memcache.get(ratelimit._counter_key(
+                METHOD, 'user', 'player1', args.period, window))
+            failures = []
+            if admitted > room:
+                failures.append('admitted {0} calls with room for {1}'.format(
+                    admitted, room))
+            if counted != admitted:
+                failures.append('counter holds {0} for {1} admitted'.format(
+                    counted, admitted))
+            failed = failed or bool(failures)
+            print('round {0}: {1} of {2} calls admitted, room {3} - '
+                  '{4}'.format(number + 1, admitted, args.threads, room,
+                               'ok' if not failures else 'FAILED'))
+            for failure in failures:
+                print('    ' + failure)
+            previous = admitted
+            now += args.period
+    finally:
+        bed.deactivate()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
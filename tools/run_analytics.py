@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+
+"""run_analytics.py - Runs a sharded analytics job (analytics.py) locally on
+the App Engine testbed stubs.
+
+Seeds the datastore stub with simulated users and scores, starts the job
+through the /tasks/start_analytics handler, then drains the task queue stub
+by running each queued task against the main.py handlers until the job is
+done, and prints the result.
+
+Usage:
+    python tools/run_analytics.py --sdk ~/google-cloud-sdk/platform/\
+google_appengine --analysis p2_outcomes [--shards 8] [--users 200]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+
+
+def seed(users, games):
+    """Saves users with random records and a mix of scores for each kind"""
+    from google.appengine.ext import ndb
+    from models import User, ScoreP1, ScoreP2, ConsecutiveTurns
+    entities = []
+    for i in range(users):
+        wins, ties, losses = [random.randint(0, 20) for _ in range(3)]
+        entities.append(User(name='user{0}'.format(i),
+                             games=wins + ties + losses,
+                             wins=wins, ties=ties, losses=losses,
+                             user_ranking=100.0 * wins / max(losses, 1)))
+    user_keys = ndb.put_multi(entities)
+    entities = []
+    now = datetime.datetime.now()
+    for _ in range(games):
+        size = random.choice([2, 4, 8])
+        pairs = size * size / 2
+        user1, user2 = random.sample(user_keys, 2)
+        turns = random.randint(pairs, pairs * 4)
+        entities.append(ScoreP1(parent=user1, user=user1, date=now,
+                                won=random.random() < .6,
+                                turns=turns, pairs=pairs, size=size))
+        tie = random.random() < .1
+        won = random.random() < .5
+        for user, user_won in [(user1, won), (user2, not won)]:
+            entities.append(ScoreP2(parent=user, user=user, date=now,
+                                    won=user_won and not tie, tie=tie,
+                                    turns=turns / 2, pairs=pairs / 2,
+                                    size=size))
+        entities.append(ConsecutiveTurns(parent=user1, user=user1, size=size,
+                                         turns=random.randint(1, pairs)))
+    ndb.put_multi(entities)
+
+
+def drain(bed, app):
+    """Run queued tasks against the app until the queue is empty. Returns the
+    number of tasks run."""
+    stub = bed.get_stub('taskqueue')
+    ran = 0
+    while True:
+        tasks = stub.get_filtered_tasks()
+        if not tasks:
+            return ran
+        for task in tasks:
+            stub.DeleteTask('default', task.name)
+            response = app.get_response(task.url, POST=task.payload)
+            if response.status_int != 200:
+                raise RuntimeError('{0} failed: {1}'.format(task.url,
+                                                            response.status))
+            ran += 1
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK (google_appengine) dir')
+    parser.add_argument('--analysis', default='p2_outcomes')
+    parser.add_argument('--shards', type=int, default=8)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--games', type=int, default=2000)
+    args = parser.parse_args()
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    os.environ.setdefault('APPLICATION_ID', 'concentration-api')
+    from google.appengine.datastore import datastore_stub_util
+    from google.appengine.ext import testbed
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub(
+        consistency_policy=datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+            probability=1))
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    try:
+        import analytics
+        import main as handlers
+        random.seed(0)
+        seed(args.users, args.games)
+        handlers.app.get_response('/tasks/start_analytics', POST={
+            'analysis': args.analysis, 'shards': args.shards})
+        ran = drain(bed, handlers.app)
+        job = analytics.AnalyticsJob.query().get()
+        print('{0}: {1} shards, {2} tasks, status {3}'.format(
+            job.analysis, job.shard_count, ran, job.status))
+        print(json.dumps(job.result, indent=2, sort_keys=True))
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
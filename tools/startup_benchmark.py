@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+
+"""startup_benchmark.py - Measures instance startup (import) time of the
+Concentration app entry points, per module.
+
+Each entry point (api, main by default) is imported in a fresh interpreter
+with __import__ wrapped, so every module imported along the way is timed the
+first time it loads. The report lists inclusive time (the module and
+everything it pulled in) and self time (the module's own top level code).
+
+Usage:
+    python tools/startup_benchmark.py --sdk ~/google-cloud-sdk/platform/\
+google_appengine [--entry api] [--entry main] [--top 25]
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+
+# runs in the child interpreter - prints a JSON list of
+# [module, inclusive seconds, self seconds] in load order
+_CHILD = r'''
+import sys, time, json
+sdk, app_dir, entry = sys.argv[1:4]
+if sdk:
+    sys.path.insert(0, sdk)
+    import dev_appserver
+    dev_appserver.fix_sys_path()
+sys.path.insert(0, app_dir)
+try:
+    import __builtin__ as builtins
+except ImportError:
+    import builtins
+real_import = builtins.__import__
+timings = []
+stack = []
+
+def timed_import(name, *args, **kwargs):
+    if name in sys.modules:
+        return real_import(name, *args, **kwargs)
+    stack.append(0.0)
+    start = time.time()
+    try:
+        return real_import(name, *args, **kwargs)
+    finally:
+        elapsed = time.time() - start
+        children = stack.pop()
+        if stack:
+            stack[-1] += elapsed
+        timings.append([name, elapsed, elapsed - children])
+
+builtins.__import__ = timed_import
+start = time.time()
+__import__(entry)
+total = time.time() - start
+builtins.__import__ = real_import
+print(json.dumps({'total': total, 'modules': timings}))
+'''
+
+
+def measure(python, sdk, entry):
+    """Returns the child's timings for importing entry"""
+    output = subprocess.check_output(
+        [python, '-c', _CHILD, sdk or '', APP_DIR, entry])
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK (google_appengine) dir')
+    parser.add_argument('--entry', action='append',
+                        help='module to import, repeatable (api, main)')
+    parser.add_argument('--top', type=int, default=25,
+                        help='modules listed per entry point')
+    parser.add_argument('--runs', type=int, default=3,
+                        help='runs per entry point - the fastest is kept')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter to benchmark with (python 2.7)')
+    args = parser.parse_args()
+    for entry in args.entry or ['api', 'main']:
+        runs = [measure(args.python, args.sdk, entry)
+                for _ in range(args.runs)]
+        best = min(runs, key=lambda run: run['total'])
+        print('{0}: {1:.1f} ms total, {2} modules loaded'.format(
+            entry, best['total'] * 1000, len(best['modules'])))
+        print('  {0:<48} {1:>10} {2:>10}'.format(
+            'module', 'incl ms', 'self ms'))
+        modules = sorted(best['modules'], key=lambda m: m[2], reverse=True)
+        for name, inclusive, own in modules[:args.top]:
+            print('  {0:<48} {1:>10.1f} {2:>10.1f}'.format(
+                name, inclusive * 1000, own * 1000))
+        print('')
+
+
+if __name__ == '__main__':
+    main()
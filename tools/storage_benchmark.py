@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+"""storage_benchmark.py - Compares the storage backends in storage.py side by
+side: batched put, batched get and a filtered, ordered query over simulated
+single player games and scores, and multiplayer games played move by move
+through the game logic (new_game, apply_move, the compare-and-set
+put_if_version and end_game, which saves the scores and queues the result
+tasks).
+
+The ndb backend runs against the App Engine testbed stubs (so it measures
+the stub overhead, not the production datastore); the memory and SQLite
+backends run in-process.
+
+Usage:
+    python tools/storage_benchmark.py --sdk ~/google-cloud-sdk/platform/\
+google_appengine [--games 1000] [--batch 100] [--played 50]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+
+
+def simulate(repository, games, batch, users):
+    """Saves a number of finished single player games and their scores via the
+    repository in batches, reads them back and queries each user's scores.
+    Returns {operation: seconds}"""
+    from google.appengine.ext import ndb
+    from models import GameP1, ScoreP1, new_card_map
+    timings = dict.fromkeys(['put_multi', 'get_multi', 'query'], 0.0)
+    user_keys = [ndb.Key('User', i + 1) for i in range(users)]
+    keys = []
+    for start in range(0, games, batch):
+        entities = []
+        for _ in range(min(batch, games - start)):
+            size = random.choice([2, 4, 8])
+            card_map = new_card_map(size)
+            game = GameP1(user=random.choice(user_keys),
+                          size=size,
+                          card_pairs=len(card_map) / 2,
+                          card_map=json.dumps(card_map),
+                          card_graveyard=json.dumps({}))
+            # play it out - every move finds a pair
+            cells = sorted(card_map, key=card_map.get)
+            for i in range(0, len(cells), 2):
+                game.apply_move(cells[i], cells[i + 1])
+            entities.append(game)
+            entities.append(ScoreP1(parent=game.user,
+                                    user=game.user,
+                                    date=datetime.datetime.now(),
+                                    won=True, turns=game.turns,
+                                    pairs=game.pairs_won, size=game.size))
+        started = time.time()
+        keys.extend(repository.put_multi(entities))
+        timings['put_multi'] += time.time() - started
+    for start in range(0, len(keys), batch):
+        started = time.time()
+        repository.get_multi(keys[start:start + batch])
+        timings['get_multi'] += time.time() - started
+    for user in user_keys:
+        started = time.time()
+        repository.query(ScoreP1, order=['turns'], ancestor=user)
+        timings['query'] += time.time() - started
+    return timings
+
+
+def play(repository, games, users):
+    """Plays a number of three player games on random moves through the game
+    logic, with the repository as the storage backend. Returns the number of
+    moves and the seconds taken"""
+    import storage
+    from models import User, GameMP
+    previous = storage.repository
+    storage.use(repository)
+    try:
+        user_keys = repository.put_multi(
+            [User(name='player{0}'.format(i)) for i in range(users)])
+        moves = 0
+        started = time.time()
+        for _ in range(games):
+            game = GameMP.new_game(random.sample(user_keys, 3),
+                                   random.choice([2, 4]))
+            while not game.game_over:
+                cells = sorted(json.loads(game.card_map))
+                selection1, selection2 = random.sample(cells, 2)
+                expected_version = game.version
+                game.apply_move(game.current_seat, selection1, selection2)
+                game.put_if_version(expected_version)
+                moves += 1
+                if sum(game.seat_pairs) == game.card_pairs:
+                    game.end_game()
+        return moves, time.time() - started
+    finally:
+        storage.use(previous)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK (google_appengine) dir')
+    parser.add_argument('--games', type=int, default=1000)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--played', type=int, default=50,
+                        help='games played through the game logic')
+    parser.add_argument('--sqlite', default=':memory:',
+                        help='SQLite database file')
+    args = parser.parse_args()
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    os.environ.setdefault('APPLICATION_ID', 'concentration-api')
+    from google.appengine.ext import testbed
+    import storage
+
+    bed = testbed.Testbed()
+    bed.activate()
+    bed.init_datastore_v3_stub()
+    bed.init_memcache_stub()
+    bed.init_taskqueue_stub(root_path=APP_DIR)
+    backends = [('ndb (testbed stubs)', storage.NdbRepository()),
+                ('memory', storage.MemoryRepository()),
+                ('sqlite', storage.SqliteRepository(args.sqlite))]
+    print('{0} games, batches of {1}, {2} users'.format(
+        args.games, args.batch, args.users))
+    print('{0:<22} {1:>12} {2:>12} {3:>12}'.format(
+        'backend', 'put ms', 'get ms', 'query ms'))
+    try:
+        for name, repository in backends:
+            random.seed(0)
+            timings = simulate(repository, args.games, args.batch, args.users)
+            print('{0:<22} {1:>12.1f} {2:>12.1f} {3:>12.1f}'.format(
+                name, timings['put_multi'] * 1000,
+                timings['get_multi'] * 1000, timings['query'] * 1000))
+        print('')
+        print('{0} games played'.format(args.played))
+        print('{0:<22} {1:>12} {2:>12}'.format('backend', 'moves',
+                                               'moves/s'))
+        for name, repository in backends:
+            random.seed(0)
+            moves, seconds = play(repository, args.played, args.users)
+            print('{0:<22} {1:>12} {2:>12.0f}'.format(name, moves,
+                                                      moves / seconds))
+    finally:
+        bed.deactivate()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+
+"""wireformat_benchmark.py - Compares the json and packed response formats
+(wireformat.py) for every board size: payload bytes and the time to encode a
+response and decode it back to a card map / move list on the client.
+
+Each size plays out a simulated two player game with random moves. The game
+form is measured at the start and half way through, and the history once the
+game is over.
+
+Usage:
+    python tools/wireformat_benchmark.py --sdk ~/google-cloud-sdk/platform/\
+google_appengine [--repeat 1000]
+"""
+
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+APP_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', 'Concentration')
+# a typical urlsafe GameP2 key
+GAME_KEY = 'ahFzfmNvbmNlbnRyYXRpb24tYXBpchMLEgZHYW1lUDIYgICAgICAgAoM'
+
+
+def play(size):
+    """Returns the card maps after every move of a random game, and its
+    history as GameHistoryForms"""
+    from messages import GameHistoryForm
+    from models import new_card_map
+    cards = new_card_map(size)
+    boards = [dict(cards)]
+    history = []
+    player = 1
+    while cards:
+        cell1, cell2 = random.sample(sorted(cards), 2)
+        if cards[cell1] == cards[cell2]:
+            result = 'Found a pair!!'
+            del cards[cell1], cards[cell2]
+        else:
+            result = "The pair doesn't match ..."
+            player = 3 - player
+        history.append(GameHistoryForm(turn=len(history) + 1, player=player,
+                                       coord1=cell1, coord2=cell2,
+                                       result=result))
+        boards.append(dict(cards))
+    return boards, history
+
+
+def game_form(size, cards):
+    from messages import GameFormP2
+    return GameFormP2(urlsafe_key=GAME_KEY,
+                      user_name1='player one', user_name2='player two',
+                      user_name1_turns=3, user_name2_turns=3,
+                      user_name1_pairs=1, user_name2_pairs=1,
+                      user_name1_consec_turns=1, user_name2_consec_turns=1,
+                      turns=6, current_turn=1, size=size, game_over=False,
+                      message='Time to make a move!', version=6, etag='"6"',
+                      cards=[json.dumps({cell: pair})
+                             for cell, pair in cards.items()])
+
+
+def measure(make_form, response_format, decode, repeat):
+    """Returns (bytes, microseconds per encode + client decode)"""
+    from protorpc import protojson
+    import wireformat
+    started = time.time()
+    for _ in range(repeat):
+        form = make_form()
+        if response_format == wireformat.PACKED:
+            wireformat.pack_form(form)
+        payload = protojson.encode_message(form)
+        decode(protojson.decode_message(type(form), payload))
+    elapsed = (time.time() - started) / repeat
+    return len(payload), elapsed * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sdk', help='App Engine SDK (google_appengine) dir')
+    parser.add_argument('--repeat', type=int, default=1000)
+    args = parser.parse_args()
+    if args.sdk:
+        sys.path.insert(0, args.sdk)
+        import dev_appserver
+        dev_appserver.fix_sys_path()
+    sys.path.insert(0, APP_DIR)
+    from messages import GameHistoryForms
+    import wireformat
+
+    def decode_cards(form):
+        if form.packed_cards:
+            return wireformat.unpack_cards(form.size, form.packed_cards)
+        cards = {}
+        for card in form.cards:
+            cards.update(json.loads(card))
+        return cards
+
+    def decode_history(form):
+        if form.packed_history:
+            return wireformat.unpack_history(form.packed_history)
+        return [(move.turn, move.player, move.coord1, move.coord2,
+                 move.result) for move in form.history]
+
+    random.seed(0)
+    print('{0:<24} {1:>10} {2:>10} {3:>12} {4:>12}'.format(
+        'response', 'json B', 'packed B', 'json us', 'packed us'))
+    for size in [2, 4, 8]:
+        boards, history = play(size)
+        cases = [
+            ('{0}x{0} board, start'.format(size),
+             lambda: game_form(size, boards[0]), decode_cards),
+            ('{0}x{0} board, mid game'.format(size),
+             lambda: game_form(size, boards[len(boards) / 2]), decode_cards),
+            ('{0}x{0} history ({1})'.format(size, len(history)),
+             lambda: GameHistoryForms(history=list(history)), decode_history),
+        ]
+        for name, make_form, decode in cases:
+            json_bytes, json_us = measure(make_form, wireformat.JSON, decode,
+                                          args.repeat)
+            packed_bytes, packed_us = measure(make_form, wireformat.PACKED,
+                                              decode, args.repeat)
+            print('{0:<24} {1:>10} {2:>10} {3:>12.1f} {4:>12.1f}'.format(
+                name, json_bytes, packed_bytes, json_us, packed_us))
+
+
+if __name__ == '__main__':
+    main()